@@ -1,4 +1,4 @@
-from django.http.response import HttpResponseRedirect
+from django.http.response import HttpResponse, HttpResponseRedirect
 
 from rest_framework.decorators import action
 from rest_framework.viewsets import ReadOnlyModelViewSet
@@ -14,6 +14,11 @@ from easydmp.dmpt.models import Template
 from easydmp.dmpt.models import Section
 from easydmp.dmpt.models import Question
 from easydmp.dmpt.models import CannedAnswer
+from easydmp.dmpt.rendering import get_rendering_error, queue_rendering
+
+
+# Seconds to wait before asking for a graph that is being rendered
+GRAPH_RETRY_AFTER = 5
 
 
 class TemplateViewSet(ReadOnlyModelViewSet):
@@ -22,7 +27,7 @@ class TemplateViewSet(ReadOnlyModelViewSet):
 
 
 class SectionViewSet(ReadOnlyModelViewSet):
-    queryset = Section.objects.all()
+    queryset = Section.objects.select_related('template')
     serializer_class = SectionSerializer
 
     @action(detail=True, methods=['get'], renderer_classes=[
@@ -37,9 +42,18 @@ class SectionViewSet(ReadOnlyModelViewSet):
         if format not in supported_formats:
             format = 'pdf'
         section = self.get_object()
-        section.refresh_cached_dotsource(format)
-        urlpath = section.get_cached_dotsource_urlpath(format)
-        return HttpResponseRedirect(urlpath)
+        if section.is_cached_dotsource_fresh(format):
+            urlpath = section.get_cached_dotsource_urlpath(format)
+            return HttpResponseRedirect(urlpath)
+        error = get_rendering_error(section.pk, format)
+        if error:
+            return HttpResponse('Rendering the graph failed: {}'.format(error),
+                                status=500, content_type='text/plain')
+        # Without a worker pool, cache_graphs has to render it
+        queue_rendering(section.pk, format)
+        response = HttpResponse(status=202)
+        response['Retry-After'] = str(GRAPH_RETRY_AFTER)
+        return response
 
 
 class QuestionViewSet(ReadOnlyModelViewSet):
@@ -0,0 +1,154 @@
+"""Copy templates, or some of their sections, in a fixed number of queries
+
+Cloning object by object costs several queries per question, canned answer,
+node and edge. Here, everything to be copied is loaded up front, the copies
+are built in memory and inserted with one ``bulk_create`` per table, in
+dependency order: sections, FSAs, nodes and edges (see ``flow.cloning``),
+questions, canned answers and EEStore mounts. Foreign keys are remapped
+through dicts from old to new primary keys.
+
+``bulk_create`` skips ``save()`` and signals, so nothing here may depend on
+them.
+"""
+
+from django.apps import apps
+from django.db import transaction
+from django.utils.timezone import now as tznow
+
+from easydmp.lib.models import bulk_create_with_pks, update_fk_by_pk
+from flow.cloning import clone_fsas
+
+
+__all__ = [
+    'clone_sections',
+    'clone_template',
+]
+
+
+def _copy_fields(obj, exclude=()):
+    "Return the concrete field values of <obj> except its pk and <exclude>"
+    values = {}
+    for field in obj._meta.concrete_fields:
+        if field.primary_key or field.name in exclude:
+            continue
+        values[field.attname] = getattr(obj, field.attname)
+    return values
+
+
+def _clone_fsas(questions, section_map):
+    """Clone the FSAs of <questions>, once per section using them
+
+    Returns maps from (old section pk, old node/edge pk) to new node/edge pk.
+    """
+    keys = []  # (old section pk, old fsa)
+    for question in questions:
+        if question.node_id:
+            key = (question.section_id, question.node.fsa)
+            if key not in keys:
+                keys.append(key)
+
+    cloned = clone_fsas(
+        (fsa, 's{}-{}'.format(section_map[section_pk].pk, fsa.slug))
+        for section_pk, fsa in keys
+    )
+    node_map = {}
+    edge_map = {}
+    for (section_pk, _), clone in zip(keys, cloned):
+        node_map.update(((section_pk, old), new) for old, new in clone.nodes.items())
+        edge_map.update(((section_pk, old), new) for old, new in clone.edges.items())
+    return node_map, edge_map
+
+
+def _clone_eestore_mounts(question_map):
+    EEStoreMount = apps.get_model('eestore', 'EEStoreMount')
+    Sources = EEStoreMount.sources.through
+
+    mounts = list(EEStoreMount.objects.filter(question_id__in=question_map).order_by('pk'))
+    new_mounts = [EEStoreMount(question_id=question_map[mount.question_id],
+                               eestore_type_id=mount.eestore_type_id)
+                  for mount in mounts]
+    bulk_create_with_pks(EEStoreMount, new_mounts, ['question'])
+    mount_map = {old.pk: new.pk for old, new in zip(mounts, new_mounts)}
+    sources = Sources.objects.filter(eestoremount_id__in=mount_map)
+    Sources.objects.bulk_create(
+        Sources(eestoremount_id=mount_map[source.eestoremount_id],
+                eestoresource_id=source.eestoresource_id)
+        for source in sources
+    )
+
+
+@transaction.atomic
+def clone_sections(sections, template):
+    """Copy <sections> into <template>
+
+    Copies questions, canned answers, EEStore mounts, FSAs, nodes and edges.
+    Super sections are kept if they are copied too. Returns a dict from the
+    old sections' pks to the new sections.
+    """
+    Section = apps.get_model('dmpt', 'Section')
+    Question = apps.get_model('dmpt', 'Question')
+    CannedAnswer = apps.get_model('dmpt', 'CannedAnswer')
+    now = tznow()
+
+    sections = list(sections)
+    section_map = {}
+    for section in sections:
+        values = _copy_fields(section, exclude=('template', 'super_section'))
+        section_map[section.pk] = Section(template=template, **values)
+    bulk_create_with_pks(Section, section_map.values(), ['template', 'position'])
+    update_fk_by_pk(Section, 'super_section', {
+        section_map[section.pk].pk: section_map[section.super_section_id].pk
+        for section in sections
+        if section.super_section_id in section_map
+    })
+    for section in sections:
+        if section.super_section_id in section_map:
+            section_map[section.pk].super_section = section_map[section.super_section_id]
+
+    questions = list(Question.objects
+                     .filter(section_id__in=section_map)
+                     .select_related('node__fsa')
+                     .order_by('pk'))
+    node_map, edge_map = _clone_fsas(questions, section_map)
+
+    new_questions = []
+    for question in questions:
+        values = _copy_fields(question, exclude=('section', 'node'))
+        new_questions.append(Question(
+            section=section_map[question.section_id],
+            node_id=node_map.get((question.section_id, question.node_id), None),
+            **values
+        ))
+    bulk_create_with_pks(Question, new_questions, ['section', 'position'])
+    question_map = {old.pk: new.pk for old, new in zip(questions, new_questions)}
+    question_sections = {question.pk: question.section_id for question in questions}
+
+    canned_answers = CannedAnswer.objects.filter(question_id__in=question_map).order_by('pk')
+    new_canned_answers = []
+    for ca in canned_answers:
+        values = _copy_fields(ca, exclude=('question', 'edge'))
+        edge_key = (question_sections[ca.question_id], ca.edge_id)
+        new_canned_answers.append(CannedAnswer(
+            question_id=question_map[ca.question_id],
+            edge_id=edge_map.get(edge_key, None) if ca.edge_id else None,
+            **values
+        ))
+    CannedAnswer.objects.bulk_create(new_canned_answers)
+
+    _clone_eestore_mounts(question_map)
+    # bulk_create sends no signals, see touch_template_via_section()
+    template.__class__.objects.filter(pk=template.pk).update(modified=now)
+    return section_map
+
+
+@transaction.atomic
+def clone_template(template, title, version):
+    """Copy <template> and give it <title> and <version>
+
+    The copy is not published. See ``clone_sections()`` for what is copied.
+    """
+    Template = apps.get_model('dmpt', 'Template')
+    values = _copy_fields(template, exclude=('title', 'version', 'published'))
+    new = Template.objects.create(title=title, version=version, **values)
+    clone_sections(template.sections.order_by('position', 'pk'), new)
+    return new
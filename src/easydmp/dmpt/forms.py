@@ -550,4 +550,4 @@ def make_form(question, **kwargs):
     form = form_type(**kwargs)
     if not question.optional and isinstance(form, forms.BaseFormSet):
         form.validate_min = True
-    return form_type(**kwargs)
+    return form
@@ -0,0 +1,480 @@
+"""Compiled, in-memory view of the structure of a template
+
+Walking a template through the ORM costs several queries per step: finding
+the following questions, checking for nodes and edges, mapping answers to
+nodes and hopping across sections. A ``TemplateGraph`` loads the sections,
+questions, nodes and edges of a template once, and answers the same
+questions from plain dicts.
+
+The graph also indexes the canned answers of every question, so that canned
+text can be looked up without a query per question, and the order and tree
+of the sections, so that moving between sections is a lookup.
+
+Graphs are immutable and cached per template revision, that is: the primary
+key of the template and its ``modified`` timestamp. Any change to the
+template, its sections, questions, canned answers, nodes or edges bumps
+``Template.modified``, so a stale graph is never looked up again.
+
+The model instances held by a graph are shared between everyone using the
+same revision, treat them as read only. Everything a graph knows is worked
+out when it is built, including the canned answer index attached to its
+questions, so that threads sharing it never write to it.
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.apps import apps
+from django.db.models import Q
+
+from flow.errors import FSANoDataError
+
+from .errors import TemplateDesignError
+from .paths import is_complete_path
+
+
+__all__ = [
+    'TemplateGraph',
+    'get_template_graph',
+]
+
+
+class TemplateGraph:
+    """Immutable snapshot of the structure of a :model:`dmpt.Template`
+
+    Build with ``TemplateGraph.compile()``, or better, fetch a cached copy
+    with ``get_template_graph()``.
+    """
+
+    def __init__(self, template_pk, stamp, sections, questions, nodes, edges,
+                 canned_answers=()):
+        self.template_pk = template_pk
+        self.stamp = stamp
+        self.sections = tuple(sections)
+        self._sections = OrderedDict((s.pk, s) for s in self.sections)
+        self._section_positions = {s.pk: i for i, s in enumerate(self.sections)}
+
+        self._questions = OrderedDict()
+        self._questions_by_section = OrderedDict((s.pk, []) for s in self.sections)
+        self._questions_by_node = {}
+        for question in questions:
+            self._questions[question.pk] = question
+            self._questions_by_section[question.section_id].append(question)
+            if question.node_id:
+                self._questions_by_node[question.node_id] = question
+        self.question_pks = frozenset(self._questions)
+        self._question_positions = {}
+        for section_pk, section_questions in self._questions_by_section.items():
+            self._questions_by_section[section_pk] = tuple(section_questions)
+            for i, question in enumerate(section_questions):
+                self._question_positions[question.pk] = i
+
+        # The section tree, and for every position in the section order the
+        # nearest question at or after it, and at or before it
+        self._sub_sections = OrderedDict((s.pk, []) for s in self.sections)
+        for section in self.sections:
+            if section.super_section_id in self._sub_sections:
+                self._sub_sections[section.super_section_id].append(section)
+        self._first_question_from = [None] * (len(self.sections) + 1)
+        for i in range(len(self.sections) - 1, -1, -1):
+            questions = self._questions_by_section[self.sections[i].pk]
+            self._first_question_from[i] = questions[0] if questions else self._first_question_from[i+1]
+        self._last_question_upto = [None] * (len(self.sections) + 1)
+        for i, section in enumerate(self.sections):
+            questions = self._questions_by_section[section.pk]
+            self._last_question_upto[i+1] = questions[-1] if questions else self._last_question_upto[i]
+
+        # question pk -> {choice -> canned text}, first canned answer wins
+        self._canned_answers = {pk: OrderedDict() for pk in self._questions}
+        for question_pk, choice, canned_text in canned_answers:
+            self._canned_answers[question_pk].setdefault(choice, canned_text)
+        for question in self._questions.values():
+            question._canned_answer_index = self._canned_answers[question.pk]
+
+        self._nodes = {node.pk: node for node in nodes}
+        self._next_edges = {}
+        self._prev_edges = {}
+        for condition, prev_node_pk, next_node_pk in edges:
+            if prev_node_pk:
+                self._next_edges.setdefault(prev_node_pk, []).append(
+                    (condition, next_node_pk))
+            if next_node_pk:
+                self._prev_edges.setdefault(next_node_pk, []).append(
+                    (condition, prev_node_pk))
+
+        # Built now rather than when first needed, since the graph is shared
+        # between threads
+        self._adjacency = {
+            section.pk: {
+                question.pk: self.get_potential_next_question_pks(question)
+                for question in self._questions_by_section[section.pk]
+            }
+            for section in self.sections
+        }
+
+    def __repr__(self):
+        return '<TemplateGraph: template {} @ {}>'.format(self.template_pk, self.stamp)
+
+    @classmethod
+    def compile(cls, template_pk, stamp=None):
+        """Load the structure of the template with pk <template_pk>
+
+        Costs a fixed number of queries regardless of the size of the
+        template.
+        """
+        Section = apps.get_model('dmpt', 'Section')
+        Question = apps.get_model('dmpt', 'Question')
+        Node = apps.get_model('flow', 'Node')
+        Edge = apps.get_model('flow', 'Edge')
+
+        sections = Section.objects.filter(template_id=template_pk).order_by('position')
+        questions = list(Question.objects
+                         .typed()
+                         .filter(section__template_id=template_pk)
+                         .order_by('section__position', 'position'))
+        fsa_pks = set(q.node.fsa_id for q in questions if q.node)
+        nodes = Node.objects.filter(fsa_id__in=fsa_pks)
+        edges = (Edge.objects
+                 .filter(Q(prev_node__fsa_id__in=fsa_pks) | Q(next_node__fsa_id__in=fsa_pks))
+                 .order_by('pk')
+                 .values_list('condition', 'prev_node_id', 'next_node_id'))
+        canned_answers = [(q.pk, ca.choice, ca.canned_text)
+                          for q in questions for ca in q.canned_answers.all()]
+        return cls(template_pk, stamp, sections, questions, nodes, edges,
+                   canned_answers)
+
+    # sections
+
+    def get_section(self, section_pk):
+        return self._sections[section_pk]
+
+    def get_section_and_super_sections(self, section_pk):
+        "Return the section with pk <section_pk> followed by its ancestors"
+        sections = []
+        while section_pk:
+            section = self.get_section(section_pk)
+            sections.append(section)
+            section_pk = section.super_section_id
+        return sections
+
+    def get_next_section(self, section_pk):
+        "Return the section after the section with pk <section_pk>, if any"
+        index = self._section_positions[section_pk] + 1
+        return self.sections[index] if index < len(self.sections) else None
+
+    def get_prev_section(self, section_pk):
+        "Return the section before the section with pk <section_pk>, if any"
+        index = self._section_positions[section_pk]
+        return self.sections[index-1] if index else None
+
+    def get_topmost_section(self, section_pk):
+        return self.get_section_and_super_sections(section_pk)[-1]
+
+    def get_section_and_sub_sections(self, section_pk):
+        "Return the section with pk <section_pk> followed by everything below it"
+        sections = [self.get_section(section_pk)]
+        for section in sections:
+            sections.extend(self._sub_sections[section.pk])
+        return sections
+
+    def get_sub_sections(self, section_pk):
+        "Return the sections directly below a section, ordered by position"
+        return tuple(self._sub_sections[section_pk])
+
+    def get_top_sections(self):
+        "Return the sections that have no super section, ordered by position"
+        return tuple(s for s in self.sections if s.section_depth == 1)
+
+    # questions
+
+    def get_question(self, question_pk):
+        return self._questions[int(question_pk)]
+
+    def get_canned_answers(self, question_pk):
+        "Map the choices of a question to canned texts, in order"
+        return self._canned_answers[int(question_pk)]
+
+    def get_questions_in_section(self, section_pk):
+        "Return the questions of a section, ordered by position"
+        return self._questions_by_section.get(section_pk, ())
+
+    def find_minimal_path(self, section_pk, data=None):
+        "Mirrors ``Section.find_minimal_path``"
+        questions = self.get_questions_in_section(section_pk)
+        answered_pks = set(int(pk) for pk in (data or {}))
+        return [q for q in questions if q.obligatory or q.pk in answered_pks]
+
+    def get_all_following_questions(self, question):
+        "Return all questions in the same section with higher position"
+        index = self._question_positions[question.pk]
+        return self.get_questions_in_section(question.section_id)[index+1:]
+
+    def get_all_preceding_questions(self, question):
+        "Return all questions in the same section with lower position"
+        index = self._question_positions[question.pk]
+        return self.get_questions_in_section(question.section_id)[:index]
+
+    def get_potential_prev_questions(self, question):
+        preceding_questions = self.get_all_preceding_questions(question)
+        if not preceding_questions:
+            return ()
+
+        prev_pos_question = preceding_questions[-1]
+        if prev_pos_question.obligatory:
+            return (prev_pos_question,)
+        all_prev_oblig_questions = [q for q in preceding_questions if q.obligatory]
+        if not all_prev_oblig_questions:
+            return ()
+        prev_oblig_question = all_prev_oblig_questions[-1]
+        return tuple(q for q in preceding_questions
+                     if q.position >= prev_oblig_question.position)
+
+    def get_first_question(self, section_pk):
+        "Return the first question of a section, if any"
+        questions = self.get_questions_in_section(section_pk)
+        return questions[0] if questions else None
+
+    def get_last_question(self, section_pk):
+        "Return the last question of a section, if any"
+        questions = self.get_questions_in_section(section_pk)
+        return questions[-1] if questions else None
+
+    def get_first_question_from(self, section_pk):
+        "Return the first question of a section or of the first non-empty section after it"
+        return self._first_question_from[self._section_positions[section_pk]]
+
+    def get_last_question_upto(self, section_pk):
+        "Return the last question of a section or of the last non-empty section before it"
+        return self._last_question_upto[self._section_positions[section_pk] + 1]
+
+    def get_first_question_in_next_section(self, question):
+        index = self._section_positions[question.section_id]
+        return self._first_question_from[index+1]
+
+    def get_last_question_in_prev_section(self, question):
+        index = self._section_positions[question.section_id]
+        return self._last_question_upto[index]
+
+    # nodes and edges
+
+    def get_payload(self, node_pk):
+        "Return the question hooked up to the node with pk <node_pk>"
+        try:
+            return self._questions_by_node[node_pk]
+        except KeyError:
+            error = 'Error in template design: node ({}) is not hooked up to a question'
+            raise TemplateDesignError(error.format(self._nodes.get(node_pk, node_pk)))
+
+    def map_answers_to_nodes(self, answers):
+        "Convert question pks to node slugs, and choices to conditions"
+        data = {}
+        for question_pk, answer in (answers or {}).items():
+            question = self._questions.get(int(question_pk), None)
+            if question is None or not question.node_id:
+                continue
+            condition = question.map_choice_to_condition(answer)
+            data[str(self._nodes[question.node_id].slug)] = condition
+        return data
+
+    def get_next_node(self, node_pk, data):
+        "Mirrors ``flow.models.Node.get_next_node``, but returns a pk"
+        if not data:
+            raise FSANoDataError
+        edges = self._next_edges.get(node_pk, ())
+        next_nodes = set(next_pk for _, next_pk in edges)
+        if len(next_nodes) == 1:  # simple node
+            return next_nodes.pop()
+        if len(next_nodes) > 1:  # complex node
+            node = self._nodes[node_pk]
+            depends = self._nodes[node.depends_id] if node.depends_id else node
+            condition = data[str(depends.slug)]
+            for edge_condition, next_pk in edges:
+                if edge_condition == condition:
+                    return next_pk
+        # end node or overridden
+        return None
+
+    def get_prev_node(self, node_pk, data):
+        "Mirrors ``flow.models.Node.get_prev_node``, but returns a pk"
+        if not data:
+            raise FSANoDataError
+        edges = self._prev_edges.get(node_pk, ())
+        prev_nodes = set(prev_pk for _, prev_pk in edges)
+        if len(prev_nodes) == 1:  # simple node
+            return prev_nodes.pop()
+        if len(prev_nodes) > 1:  # complex node
+            for edge_condition, prev_pk in edges:
+                if prev_pk is None:
+                    continue
+                prev_slug = self._nodes[prev_pk].slug
+                if prev_slug in data and edge_condition == data[prev_slug]:
+                    return prev_pk
+        # start node or overridden
+        return None
+
+    # paths
+
+    def get_potential_next_question_pks(self, question):
+        """Return the pks of the potential next questions of <question>
+
+        Mirrors ``Question.get_potential_next_questions``. ``None`` means that
+        the section may end after <question>.
+        """
+        following_questions = self.get_all_following_questions(question)
+        if not following_questions:
+            return set()
+        edges = self._next_edges.get(question.node_id, ())
+        if not question.node_id or not edges:
+            return set([following_questions[0].pk])
+        next_pks = set()
+        for _, next_node_pk in edges:
+            payload = self._questions_by_node.get(next_node_pk, None)
+            next_pks.add(payload.pk if payload else None)
+        return next_pks
+
+    def get_potential_next_questions_with_edge(self, question):
+        """Return the potential next questions of <question>, with conditions
+
+        Mirrors ``Question.get_potential_next_questions_with_edge``: a set
+        of (condition, question) where the question is ``None`` if the
+        section may end after <question>.
+        """
+        following_questions = self.get_all_following_questions(question)
+        if not following_questions:
+            return set()
+        if not question.node_id:
+            return set([('->', following_questions[0])])
+        edges = self._next_edges.get(question.node_id, ())
+        if not edges:
+            return set([('=>', following_questions[0])])
+        return set((condition, self._questions_by_node.get(next_node_pk, None))
+                   for condition, next_node_pk in edges)
+
+    def get_section_adjacency(self, section_pk):
+        """Return the question graph of a section as an adjacency dict
+
+        Computed once per section and graph, that is: per template revision.
+        """
+        return self._adjacency[section_pk]
+
+    def is_complete_path(self, section_pk, question_pks):
+        """Check that the <question_pks> form a path through a section
+
+        The path must start with the first question of the section.
+        """
+        questions = self.get_questions_in_section(section_pk)
+        if not questions:
+            return False
+        adjacency = self.get_section_adjacency(section_pk)
+        return is_complete_path(adjacency, questions[0].pk, question_pks)
+
+    # validation
+
+    def find_validity_of_questions(self, section_pk, data):
+        "Mirrors ``Section.find_validity_of_questions``"
+        valids = set()
+        invalids = set()
+        for question in self.get_questions_in_section(section_pk):
+            try:
+                valid = question.validate_data(data)
+            except AttributeError:
+                valid = False
+            if valid:
+                valids.add(question.pk)
+            else:
+                invalids.add(question.pk)
+        return (valids, invalids)
+
+    def validate_section_data(self, section_pk, data):
+        "Mirrors ``Section.validate_data``"
+        if not data:
+            return False
+        if not self.get_questions_in_section(section_pk):
+            return True
+        valids, invalids = self.find_validity_of_questions(section_pk, data)
+        return self.is_section_valid(section_pk, valids, invalids)
+
+    def is_section_valid(self, section_pk, valids, invalids):
+        """Whether a section is valid, given the validity of its questions
+
+        <valids> and <invalids> are as returned by
+        ``find_validity_of_questions()``, which is the costly part.
+        """
+        if not invalids:
+            return True
+        return self.is_complete_path(section_pk, valids)
+
+    # navigation
+
+    def get_next_question(self, question, answers=None, in_section=False):
+        "Mirrors ``Question.get_next_question`` without touching the database"
+        question = self.get_question(question.pk)
+        following_questions = self.get_all_following_questions(question)
+        if not following_questions:
+            return self.get_first_question_in_next_section(question)
+
+        if not question.node_id:
+            return following_questions[0]
+
+        node = self._nodes[question.node_id]
+        if node.end and not in_section:
+            # Break out of section because fsa.end == True
+            return self.get_first_question_in_next_section(question)
+
+        if not self._next_edges.get(node.pk):
+            return following_questions[0]
+
+        data = self.map_answers_to_nodes(answers)
+        next_node_pk = self.get_next_node(node.pk, data)
+        if next_node_pk:
+            # Break out of section because fsa.end == True
+            if self._nodes[next_node_pk].end and not in_section:
+                return self.get_first_question_in_next_section(question)
+            # Not at the end, get payload
+            return self.get_payload(next_node_pk)
+
+        return None
+
+    def get_prev_question(self, question, answers=None, in_section=False):
+        "Mirrors ``Question.get_prev_question`` without touching the database"
+        question = self.get_question(question.pk)
+        preceding_questions = self.get_potential_prev_questions(question)
+        if not preceding_questions:
+            if not in_section:
+                return self.get_last_question_in_prev_section(question)
+            return None
+
+        if len(preceding_questions) == 1:
+            return preceding_questions[0]
+
+        # Walk forward from previous obligatory question
+        if not question.node_id or self._nodes[question.node_id].start:
+            return preceding_questions[-1]
+
+        data = self.map_answers_to_nodes(answers)
+        prev_node_pk = self.get_prev_node(question.node_id, data)
+        if prev_node_pk:
+            return self.get_payload(prev_node_pk)
+
+        return preceding_questions[-1]
+
+
+@lru_cache(maxsize=64)
+def _get_compiled_graph(template_pk, stamp):
+    return TemplateGraph.compile(template_pk, stamp)
+
+
+def get_template_graph(template):
+    """Return the cached ``TemplateGraph`` of <template>
+
+    <template> is either a :model:`dmpt.Template` or the pk of one. If an
+    instance is given, its ``modified`` timestamp is trusted, so only pass in
+    freshly fetched instances. A pk costs one query, for the timestamp.
+    """
+    Template = apps.get_model('dmpt', 'Template')
+    if isinstance(template, Template):
+        template_pk, stamp = template.pk, template.modified
+    else:
+        template_pk = template
+        stamp = Template.objects.filter(pk=template_pk).values_list('modified', flat=True).get()
+    return _get_compiled_graph(template_pk, stamp)
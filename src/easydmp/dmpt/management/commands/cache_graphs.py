@@ -1,6 +1,20 @@
+import os
+import time
+
 from django.core.management.base import BaseCommand, CommandError
 
 from easydmp.dmpt.models import Section
+from easydmp.dmpt.rendering import render_section_graph
+from easydmp.utils.workers import process_pool
+
+
+def render(args):
+    section_pk, format = args
+    try:
+        render_section_graph(section_pk, format)
+    except Exception as e:
+        return (section_pk, format, str(e))
+    return (section_pk, format, None)
 
 
 class Command(BaseCommand):
@@ -24,16 +38,40 @@ class Command(BaseCommand):
                                     help='Cache all templates',
                                     dest='all_templates',
                                     )
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes, 1 means no pool (default: number of CPUs)')
 
     def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
         formats = options['formats']
-        templates = options['templates']
+        jobs = options['jobs']
+        if jobs < 1:
+            raise CommandError('--jobs must be at least 1')
 
         if options['all_templates']:
             sections = Section.objects.all()
         else:
             sections = Section.objects.filter(template__id__in=options['templates'])
+        section_pks = sections.order_by('pk').values_list('pk', flat=True)
+        tasks = [(pk, format) for format in formats for pk in section_pks]
+
+        start = time.monotonic()
+        if jobs == 1 or len(tasks) < 2:
+            results = map(render, tasks)
+            failed = self.process_results(results)
+        else:
+            with process_pool(jobs) as pool:
+                results = pool.imap_unordered(render, tasks)
+                failed = self.process_results(results)
+        elapsed = time.monotonic() - start
+        self.stdout.write('{} graphs in {:.2f}s, {} failed'.format(len(tasks), elapsed, failed))
 
-        for format in formats:
-            for s in sections:
-                s.refresh_cached_dotsource(format)
+    def process_results(self, results):
+        failed = 0
+        for section_pk, format, error in results:
+            if error:
+                failed += 1
+                self.stderr.write('Section {} as {}: {}'.format(section_pk, format, error))
+            elif self.verbosity > 1:
+                self.stdout.write('Section {} as {}'.format(section_pk, format))
+        return failed
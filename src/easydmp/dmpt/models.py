@@ -20,14 +20,21 @@ from django.contrib.admin.utils import NestedObjects
 from django.db import models
 from django.db import router
 from django.db import transaction
+from django.db.models import Prefetch
+from django.db.models.query import ModelIterable
+from django.db.models.signals import post_delete, post_save
 from django.forms import model_to_dict
 from django.template import engines, Context
 from django.utils.encoding import force_text
 from django.utils.safestring import mark_safe
 from django.utils.html import format_html, escape
 from django.utils.text import slugify
+from django.utils.timezone import now as tznow
 
+from .cloning import clone_sections, clone_template
 from .errors import TemplateDesignError
+from .graph import get_template_graph
+from .paths import dfs_paths
 from .utils import DeletionMixin
 from .utils import RenumberMixin
 from .utils import print_url
@@ -67,34 +74,6 @@ INPUT_TYPES = (
 )
 
 
-def dfs_paths(graph, start):
-    """Find all paths in  DAG graph, return a generator of lists
-
-    Input: adjacency list in a dict:
-
-    {
-        node1: set([node1, node2, node3]),
-        node2: set([node2, node3]),
-        node3: set(),
-    }
-    """
-    stack = [(start, [start])]
-    visited = set()
-    while stack:
-        # loop detection
-        if start in visited:
-            error = 'Graph is not a DAG, there\'s a loop for node "{}"'
-            raise TypeError(error.format(start))
-        (vertex, path) = stack.pop()
-        if not graph.get(vertex, None):
-            yield path
-        for next in graph[vertex] - set(path):
-            if not next:
-                yield path + [next]
-            else:
-                stack.append((next, path + [next]))
-
-
 def copy_user_permissions(orig, other):
     """Copy user permissions from one instance to another of the same class
 
@@ -157,7 +136,7 @@ class TemplateQuerySet(models.QuerySet):
         )
 
 
-class Template(DeletionMixin, RenumberMixin, models.Model):
+class Template(DeletionMixin, RenumberMixin, ModifiedTimestampModel):
     title = models.CharField(max_length=255)
     abbreviation = models.CharField(max_length=8, blank=True)
     description = models.TextField(blank=True)
@@ -200,24 +179,9 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
         """Clone the template and give it <title> and <version>
 
         Also recursively clones all sections, questions, canned answers,
-        EEStore mounts, FSAs, nodes and edges."""
+        EEStore mounts, FSAs, nodes and edges. See ``easydmp.dmpt.cloning``."""
         assert title and version, "Both title and version must be given"
-        self_dict = model_to_dict(self, exclude=['id', 'pk', 'title',
-                                                 'version', 'published'])
-        new = self.__class__.objects.create(
-            title=title,
-            version=version,
-            **self_dict
-        )
-        # clone sections, which clones questions, canned answers, fsas and eestore mounts
-        section_mapping = {}
-        for section in self.sections.all():
-            new_section = section.clone(new)
-            section_mapping[section] = new_section
-        for old_section, new_section in section_mapping.items():
-            if old_section.super_section:
-                new_section.super_section = section_mapping[old_section.super_section]
-                new_section.save()
+        new = clone_template(self, title=title, version=version)
         copy_permissions(self, new)
         return new
 
@@ -249,42 +213,46 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
 
     @property
     def first_section(self):
-        return Section.objects.filter(template=self).order_by('position')[0]
+        return get_template_graph(self).sections[0]
 
     @property
     def last_section(self):
-        return Section.objects.filter(template=self).order_by('-position')[0]
+        return get_template_graph(self).sections[-1]
 
     @property
     def first_question(self):
-        section = self.first_section
-        return section.first_question
+        graph = get_template_graph(self)
+        return graph.get_first_question_from(graph.sections[0].pk)
 
     @property
     def last_question(self):
-        section = self.last_section
-        return section.last_question
-
-    def generate_canned_text(self, data):
-        texts = []
-        for section in self.sections.order_by('position'):
-            canned_text = section.generate_canned_text(data)
+        graph = get_template_graph(self)
+        return graph.get_last_question_upto(graph.sections[-1].pk)
+
+    def iter_canned_text(self, data):
+        "Generate the canned text one section at a time"
+        graph = get_template_graph(self)
+        for section in graph.sections:
+            canned_text = section.generate_canned_text(data, graph)
             section_dict = model_to_dict(section, exclude=('_state', '_template_cache'))
             section_dict['introductory_text'] = mark_safe(section_dict['introductory_text'])
-            texts.append({
+            yield {
                 'section': section_dict,
                 'text': canned_text,
-            })
-        return texts
+            }
+
+    def generate_canned_text(self, data):
+        return list(self.iter_canned_text(data))
 
     def get_summary(self, data, valid_section_ids=()):
         summary = OrderedDict()
         data = deepcopy(data)  # 1/2 Make absolutely sure we're working on a copy
-        for section in self.sections.order_by('position'):
+        graph = get_template_graph(self)
+        for section in graph.sections:
             section_summary = OrderedDict()
-            for question in section.find_minimal_path(data):
+            # Typed, with the canned answers preloaded
+            for question in graph.find_minimal_path(section.pk, data):
                 value = {}
-                question = question.get_instance()
                 answer = data.get(str(question.pk), None)
                 if not answer or answer.get('choice', None) is None:
                     value['answer'] = None
@@ -304,7 +272,7 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
                     'section': section,
                     'full_title': section.full_title(),
                     'pk': section.pk,
-                    'first_question': section.get_first_question(),
+                    'first_question': graph.get_first_question(section.pk),
                     'introductory_text': mark_safe(section.introductory_text),
                     'comment': mark_safe(section.comment),
                 }
@@ -314,11 +282,12 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
     def list_unknown_questions(self, plan):
         "List out all question pks of a plan that are unknown in the template"
         assert self == plan.template, "Mrong template for plan"
-        question_pks = self.questions.values_list('pk', flat=True)
+        question_pks = get_template_graph(self).question_pks
         data_pks = set(int(k) for k in plan.data)
         return data_pks.difference(question_pks)
 
-    def validate_plan(self, plan, recalculate=True):
+    def check_plan_data(self, plan):
+        "Check that there is data and that it belongs to this template"
         wrong_pks = [str(pk) for pk in self.list_unknown_questions(plan)]
         if wrong_pks:
             error = 'The plan {} contains nonsense data: template has no questions for: {}'
@@ -329,29 +298,64 @@ class Template(DeletionMixin, RenumberMixin, models.Model):
             error = 'The plan {} ({}) has no data: invalid'
             LOG.error(error.format(plan, plan.pk))
             return False
+        return True
+
+    def validate_plan(self, plan, recalculate=True):
+        """Validate the entire plan
+
+        With <recalculate>, the validity of every question and section is
+        recalculated and stored, as a batch. Without, the stored count of
+        valid sections is used.
+        """
+        if not self.check_plan_data(plan):
+            return False
+        graph = get_template_graph(self)
         if recalculate:
-            for section in self.sections.all():
-                valids, invalids = section.find_validity_of_questions(plan.data)
+            for section in graph.sections:
+                valids, invalids = graph.find_validity_of_questions(section.pk, plan.data)
                 section.set_validity_of_questions(plan, valids, invalids)
             valids, invalids = self.find_validity_of_sections(plan.data)
             self.set_validity_of_sections(plan, valids, invalids)
-        if plan.section_validity.filter(valid=True).count() == plan.template.sections.count():
-            return True
-        return False
+        return plan.valid_section_count == len(graph.sections)
+
+    def validate_plan_question(self, plan, question):
+        """Revalidate only what an answer to <question> may have changed
+
+        That is the validity of the question, its section and the super
+        sections of that. The count of valid sections of the plan is
+        adjusted accordingly.
+        """
+        if not self.check_plan_data(plan):
+            return False
+        graph = get_template_graph(self)
+        question = graph.get_question(question.pk)
+        if question.validate_data(plan.data):
+            plan.set_questions_as_valid(question.pk)
+        else:
+            plan.set_questions_as_invalid(question.pk)
+        valids = set()
+        invalids = set()
+        for section in graph.get_section_and_super_sections(question.section_id):
+            if graph.validate_section_data(section.pk, plan.data):
+                valids.add(section.pk)
+            else:
+                invalids.add(section.pk)
+        plan.update_section_validities(valids, invalids)
+        return plan.valid_section_count == len(graph.sections)
 
     def find_validity_of_sections(self, data):
         valid_sections = set()
         invalid_sections = set()
-        for section in self.sections.all():
-            if section.validate_data(data):
+        graph = get_template_graph(self)
+        for section in graph.sections:
+            if graph.validate_section_data(section.pk, data):
                 valid_sections.add(section.pk)
             else:
                 invalid_sections.add(section.pk)
         return (valid_sections, invalid_sections)
 
     def set_validity_of_sections(self, plan, valids, invalids):
-        plan.set_sections_as_valid(*valids)
-        plan.set_sections_as_invalid(*invalids)
+        plan.update_section_validities(valids, invalids, recount=True)
 
     def validate_data(self, data):
         if not data:
@@ -426,50 +430,13 @@ class Section(DeletionMixin, RenumberMixin, ModifiedTimestampModel):
             return '{} {}'.format(self.label, self.title)
         return self.title
 
-    @transaction.atomic
     def clone(self, template):
         """Make a complete copy of the section and put it in <template>
 
         Copies questions, canned answers, EEStore mounts, FSAs, nodes and edges.
+        See ``easydmp.dmpt.cloning``.
         """
-        self_dict = model_to_dict(self, exclude=['id', 'pk', 'template', 'super_section'])
-        new = self.__class__.objects.create(template=template, **self_dict)
-        question_mapping = {}
-        for question in self.questions.all():
-            question_mapping[question] = question.clone(new)
-        self.clone_fsas(question_mapping, new)
-        return new
-
-    @transaction.atomic
-    def clone_fsas(self, question_mapping, section):
-        """Clone FSAs, which also clones nodes and edges
-
-        Hook up nodes and edges of the FSAs to questions and canned answers."""
-        node_questions = self.questions.prefetch_related('canned_answers').filter(node__isnull=False)
-        fsas = [q.node.fsa for q in node_questions.distinct()]
-        fsa_mapping = {}
-        # clone fsa
-        for fsa in fsas:
-            title = 's{}-{}'.format(section.pk, fsa.slug)
-            fsa_mapping[fsa] = fsa.clone(title)
-        # hook up new questions to new fsa nodes
-        Edge = apps.get_model('flow', 'Edge')
-        edge_qs = Edge.objects.select_related('prev_node')
-        for question in node_questions:
-            node = question.node
-            new_fsa = fsa_mapping[node.fsa]
-            new_node = new_fsa.nodes.get(slug=node.slug)
-            new_question = question_mapping[question]
-            new_question.node = new_node
-            new_question.save()
-            # hook up new canned answers to new fsa edges
-            old_edges = edge_qs.filter(prev_node=question.node)
-            new_edges = edge_qs.filter(prev_node=new_question.node)
-            edge_mapping = {edge: new_edges.get(condition=edge.condition) for edge in old_edges}
-            for ca in question.canned_answers.filter(edge__isnull=False):
-                new_ca = new_question.canned_answers.get(choice=ca.choice)
-                new_ca.edge = edge_mapping[ca.edge]
-                new_ca.save()
+        return clone_sections([self], template)[self.pk]
 
     def collect(self, **kwargs):
         collector = super().collect(**kwargs)
@@ -489,42 +456,31 @@ class Section(DeletionMixin, RenumberMixin, ModifiedTimestampModel):
         questions = self.questions.order_by('position')
         self._renumber_positions(questions)
 
+    def get_graph(self):
+        "Return the ``TemplateGraph`` of the current revision of the template"
+        return get_template_graph(self.template_id)
+
     def get_first_question(self):
-        if self.questions.exists():
-            return self.questions.order_by('position')[0]
-        return None
+        return self.get_graph().get_first_question(self.pk)
 
     @property
     def first_question(self):
-        first_question = self.get_first_question()
-        if first_question:
-            return first_question
-        # See if there is a next section in case this one has no questions
-        next_section = self.get_next_section()
-        if next_section:
-            return next_section.first_question
-        return None
+        # Falls through to the next non-empty section
+        return self.get_graph().get_first_question_from(self.pk)
 
     def get_last_question(self, in_section=False):
-        if self.questions.exists():
-            return self.questions.order_by('-position')[0]
-        return None
+        return self.get_graph().get_last_question(self.pk)
 
     @property
     def last_question(self):
-        last_question = self.get_last_question()
-        if last_question:
-            return last_question
-        # See if there is a prev section in case this one has no questions
-        prev_section = self.get_prev_section()
-        if prev_section:
-            return prev_section.last_question
-        return None
+        # Falls through to the previous non-empty section
+        return self.get_graph().get_last_question_upto(self.pk)
 
-    def generate_canned_text(self, data):
+    def generate_canned_text(self, data, graph=None):
         texts = []
-        for question in self.questions.order_by('position'):
-            answer = question.get_instance().generate_canned_text(data)
+        graph = graph or get_template_graph(self.template_id)
+        for question in graph.get_questions_in_section(self.pk):
+            answer = question.generate_canned_text(data)
             if not isinstance(answer.get('text', ''), bool):
                 texts.append(answer)
         return texts
@@ -533,59 +489,31 @@ class Section(DeletionMixin, RenumberMixin, ModifiedTimestampModel):
         return Section.objects.filter(template=self.template, position__gt=self.position)
 
     def get_next_section(self):
-        next_sections = self.get_all_next_sections().order_by('position')
-        if next_sections.exists():
-            return next_sections[0]
-        return None
+        return self.get_graph().get_next_section(self.pk)
 
     def get_all_prev_sections(self):
         return Section.objects.filter(template=self.template, position__lt=self.position)
 
     def get_prev_section(self):
-        prev_sections = self.get_all_prev_sections().order_by('-position')
-        if prev_sections.exists():
-            return prev_sections[0]
-        return None
+        return self.get_graph().get_prev_section(self.pk)
 
     def get_topmost_section(self):
-        obj = self
-        while obj.super_section is not None:
-            obj = obj.super_section
-        return obj
+        if self.super_section_id is None:
+            return self
+        return self.get_graph().get_topmost_section(self.pk)
 
     def find_validity_of_questions(self, data):
         assert data, 'No data, cannot validate'
-        questions = self.questions.all()
-        valids = set()
-        invalids = set()
-        for question in questions:
-            question = question.get_instance()
-            try:
-                valid = question.validate_data(data)
-            except AttributeError:
-                valid = False
-            if valid:
-                valids.add(question.pk)
-            else:
-                invalids.add(question.pk)
-        return (valids, invalids)
+        graph = get_template_graph(self.template_id)
+        return graph.find_validity_of_questions(self.pk, data)
 
     def set_validity_of_questions(self, plan, valids, invalids):
         plan.set_questions_as_valid(*valids)
         plan.set_questions_as_invalid(*invalids)
 
     def validate_data(self, data):
-        if not data:
-            return False
-        if not self.questions.exists():
-            return True
-        valids, invalids = self.find_validity_of_questions(data)
-        if not invalids:
-            return True
-        for path in self.find_all_paths():
-            if valids == set(path):
-                return True
-        return False
+        graph = get_template_graph(self.template_id)
+        return graph.validate_section_data(self.pk, data)
 
     def find_minimal_path(self, data=None):
         minimal_qs = self.questions.filter(obligatory=True).order_by('position')
@@ -611,22 +539,26 @@ class Section(DeletionMixin, RenumberMixin, ModifiedTimestampModel):
     def generate_dotsource(self):
         global gv
         dot = gv.Digraph()
+        graph = get_template_graph(self.template_id)
 
         s_kwargs = {'shape': 'doublecircle'}
         s_start_id = 's-{}-start'.format(self.pk)
         dot.node(s_start_id, label='Start', **s_kwargs)
         s_end_id = 's-{}-end'.format(self.pk)
         dot.node(s_end_id, label='End', **s_kwargs)
-        for question in self.questions.order_by('position'):
+        questions = graph.get_questions_in_section(self.pk)
+        for question in questions:
             q_kwargs = {}
             q_kwargs['label'] = fill(str(question), 20)
             q_id = 'q{}'.format(question.pk)
-            if question.pk == self.get_first_question().pk:
+            if question.pk == questions[0].pk:
                 dot.edge(s_start_id, q_id, **s_kwargs)
             dot.node(q_id, **q_kwargs)
-            next_questions = question.get_potential_next_questions_with_edge()
+            next_questions = graph.get_potential_next_questions_with_edge(question)
             if next_questions:
-                for choice, next_question in next_questions:
+                # Sorted, so that unchanged sections give identical dotsource
+                for choice, next_question in sorted(
+                        next_questions, key=lambda c_q: (c_q[0], c_q[1].pk if c_q[1] else 0)):
                     if next_question:
                         nq_id = 'q{}'.format(next_question.pk)
                     else:
@@ -648,7 +580,8 @@ class Section(DeletionMixin, RenumberMixin, ModifiedTimestampModel):
         _prep_dotsource(root_directory)
         if not dotsource:
             dotsource = self.generate_dotsource()
-        return render_dotsource_to_file(format, filename, dotsource, root_directory, sub_directory, mode=0o755)
+        return render_dotsource_to_file(format, filename, dotsource, root_directory, sub_directory, mode=0o755,
+                                        cache_directory=self.GRAPHVIZ_TMPDIR)
 
     def get_cached_dotsource_filename(self, format='pdf'):
         return 'section-{}.{}'.format(self.pk, format)
@@ -657,32 +590,47 @@ class Section(DeletionMixin, RenumberMixin, ModifiedTimestampModel):
         filename = self.get_cached_dotsource_filename(format)
         return '{}cached/dmpt/{}'.format(settings.STATIC_URL, filename)
 
-    def refresh_cached_dotsource(self, format='pdf'):
-        assert format in ('pdf', 'svg', 'dot', 'png'), 'Unsupported format: {}'.format(format)
-        filename = self.get_cached_dotsource_filename(format)
+    def _get_cached_dotsource_paths(self, format):
+        "Return where the cached file is written to and copied to"
         subdirectory = 'cached/dmpt'
+        filename = self.get_cached_dotsource_filename(format)
         apppath = Path(__file__).parent.joinpath('static').resolve()
         apppath = apppath.joinpath(subdirectory)
-        apppath.mkdir(mode=0o755, parents=True, exist_ok=True)
         sitepath = Path(settings.STATIC_ROOT).resolve().joinpath(subdirectory)
-        sitepath.mkdir(mode=0o755, parents=True, exist_ok=True)
-        filepath = apppath.joinpath(filename)
+        return apppath.joinpath(filename), sitepath.joinpath(filename)
+
+    def is_cached_dotsource_fresh(self, format='pdf'):
+        """Check that the cached file is newer than the section
+
+        Changes to the questions, nodes and edges of a section bump the
+        ``modified`` of its template, so that is checked too.
+        """
+        filepath, sitefilepath = self._get_cached_dotsource_paths(format)
         try:
-            modified = os.path.getmtime(filepath)
+            modified = min(os.path.getmtime(filepath), os.path.getmtime(sitefilepath))
         except FileNotFoundError:
-            modified = 0.0
-        if modified < self.modified.timestamp():
-            if format == 'dot':
-                dotsource = self.generate_dotsource()
-                with open(filepath, 'w') as Dotfile:
-                    Dotfile.write(dotsource)
-            else:
-                self.render_dotsource_to_file(
-                    format,
-                    filename.rstrip('.'+format),
-                    root_directory=apppath,
-                )
-            sitepath.joinpath(filename).write_bytes(filepath.read_bytes())
+            return False
+        changed = max(self.modified, self.template.modified)
+        return modified >= changed.timestamp()
+
+    def refresh_cached_dotsource(self, format='pdf'):
+        assert format in ('pdf', 'svg', 'dot', 'png'), 'Unsupported format: {}'.format(format)
+        if self.is_cached_dotsource_fresh(format):
+            return
+        filepath, sitefilepath = self._get_cached_dotsource_paths(format)
+        filepath.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        sitefilepath.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        if format == 'dot':
+            dotsource = self.generate_dotsource()
+            with open(filepath, 'w') as Dotfile:
+                Dotfile.write(dotsource)
+        else:
+            self.render_dotsource_to_file(
+                format,
+                filepath.stem,
+                root_directory=filepath.parent,
+            )
+        sitefilepath.write_bytes(filepath.read_bytes())
 
 
 class NoCheckMixin:
@@ -710,6 +658,49 @@ class SimpleFramingTextMixin:
         return False
 
 
+class QuestionQuerySet(models.QuerySet):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._typed = False
+
+    def _clone(self, **kwargs):
+        kwargs.setdefault('_typed', self._typed)
+        return super()._clone(**kwargs)
+
+    def _yields_typed_questions(self):
+        # Not when asked for values() and the like
+        return self._typed and issubclass(self._iterable_class, ModelIterable)
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super()._fetch_all()
+        if fetched and self._yields_typed_questions():
+            for question in self._result_cache:
+                question.get_instance()
+
+    def iterator(self):
+        questions = super().iterator()
+        if self._yields_typed_questions():
+            return (question.get_instance() for question in questions)
+        return questions
+
+    def typed(self):
+        """Load questions as their subtypes, with what they need preloaded
+
+        The node, the canned answers in order and any eestore mount and its
+        sources come along, so that the questions can be used in a loop
+        without lazy loading.
+        """
+        return (self
+                .select_related('node', 'eestore__eestore_type')
+                .prefetch_related(
+                    Prefetch('canned_answers', queryset=CannedAnswer.objects.order()),
+                    'eestore__sources',
+                )
+                ._clone(_typed=True))
+
+
 class Question(DeletionMixin, RenumberMixin, models.Model):
     """The database representation of a question
 
@@ -753,6 +744,8 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
                                 blank=True, null=True,
                                 on_delete=models.SET_NULL)
 
+    objects = QuestionQuerySet.as_manager()
+
     class Meta:
         unique_together = ('section', 'position')
         ordering = ('section', 'position')
@@ -811,7 +804,8 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
         The subtype is stored in the attribute `input_type`
         """
         cls = self.get_class()
-        self.__class__ = cls
+        if self.__class__ is not cls:
+            self.__class__ = cls
         return self
 
     def get_choices(self):
@@ -848,20 +842,38 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
         answer['text'] = canned
         return answer
 
+    def get_canned_answer_index(self):
+        """Map choices to canned texts, in order
+
+        Questions belonging to a ``TemplateGraph`` have the index attached,
+        questions loaded with ``Question.objects.typed()`` have the canned
+        answers prefetched, other questions cost a query.
+        """
+        index = getattr(self, '_canned_answer_index', None)
+        if index is None:
+            if 'canned_answers' in getattr(self, '_prefetched_objects_cache', {}):
+                pairs = ((ca.choice, ca.canned_text) for ca in self.canned_answers.all())
+            else:
+                pairs = self.canned_answers.order().values_list('choice', 'canned_text')
+            index = OrderedDict()
+            for choice, canned_text in pairs:
+                index.setdefault(choice, canned_text)
+        return index
+
     def get_canned_answer(self, answer, frame=None, **kwargs):
         if not answer:
             return self.get_optional_canned_answer()
 
-        if not self.canned_answers.exists():
+        canned_answers = self.get_canned_answer_index()
+        if not canned_answers:
             return ''
 
-        if self.canned_answers.count() == 1:
-            return self.canned_answers.get().canned_text
+        if len(canned_answers) == 1:
+            return next(iter(canned_answers.values()))
 
         choice = self._serialize_condition(answer)
-        canned = self.canned_answers.filter(choice=choice)
-        if canned:
-            return canned[0].canned_text or answer
+        if choice in canned_answers:
+            return canned_answers[choice] or answer
         return ''
 
     def pprint(self, value):
@@ -912,20 +924,12 @@ class Question(DeletionMixin, RenumberMixin, models.Model):
         return data
 
     def get_first_question_in_next_section(self):
-        next_section = self.section.get_next_section()
-        while next_section:
-            if next_section.questions.exists():
-                return next_section.first_question
-            next_section = next_section.get_next_section()
-        return None
+        graph = get_template_graph(self.section.template_id)
+        return graph.get_first_question_in_next_section(self)
 
     def get_last_question_in_prev_section(self):
-        prev_section = self.section.get_prev_section()
-        while prev_section:
-            if prev_section.questions.exists():
-                return prev_section.last_question
-            prev_section = prev_section.get_prev_section()
-        return None
+        graph = get_template_graph(self.section.template_id)
+        return graph.get_last_question_in_prev_section(self)
 
     def get_all_following_questions(self):
         "Return a qs of all questions in the same section with higher pos"
@@ -1128,7 +1132,7 @@ class ChoiceQuestion(Question):
         return answer
 
     def get_choices(self):
-        choices = self.canned_answers.order().values_list('choice', 'canned_text')
+        choices = self.get_canned_answer_index().items()
         fixed_choices = []
         for (k, v) in choices:
             if not v:
@@ -1179,7 +1183,7 @@ class MultipleChoiceOneTextQuestion(Question):
         return pprint_list(value['choice'])
 
     def get_choices(self):
-        choices = tuple(self.canned_answers.order().values_list('choice', 'choice'))
+        choices = tuple((choice, choice) for choice in self.get_canned_answer_index())
         return choices
 
     def validate_choice(self, data):
@@ -1283,9 +1287,9 @@ class EEStoreMixin:
         return self.get_canned_answer(value['choice'], frame=False)
 
     def get_choices(self):
-        if self.eestore.sources.exists():
-            sources = self.eestore.sources.all()
-        else:
+        # Uses the prefetched sources if loaded with Question.objects.typed()
+        sources = list(self.eestore.sources.all())
+        if not sources:
             sources = self.eestore.eestore_type.sources.all()
         qs = EEStoreCache.objects.filter(source__in=sources)
         choices = qs.values_list('eestore_pid', 'name')
@@ -1774,3 +1778,46 @@ class CannedAnswer(DeletionMixin, models.Model):
         condition = self.convert_choice_to_condition()
         self.edge.condition = condition
         self.edge.save()
+
+
+# Keep Template.modified current, so that cached TemplateGraphs of older
+# revisions of the template are never looked up again.
+# See easydmp.dmpt.graph
+
+
+def _touch_templates(**lookup):
+    Template.objects.filter(**lookup).update(modified=tznow())
+
+
+def touch_template_via_section(sender, instance, **kwargs):
+    _touch_templates(pk=instance.template_id)
+
+
+def touch_template_via_question(sender, instance, **kwargs):
+    _touch_templates(sections__pk=instance.section_id)
+
+
+def touch_template_via_question_fk(sender, instance, **kwargs):
+    _touch_templates(sections__questions__pk=instance.question_id)
+
+
+def touch_template_via_node(sender, instance, **kwargs):
+    _touch_templates(sections__questions__node__fsa_id=instance.fsa_id)
+
+
+def touch_template_via_edge(sender, instance, **kwargs):
+    node_pks = set((instance.prev_node_id, instance.next_node_id))
+    node_pks.discard(None)
+    if node_pks:
+        _touch_templates(sections__questions__node__fsa__nodes__pk__in=node_pks)
+
+
+for signal in (post_save, post_delete):
+    signal.connect(touch_template_via_section, sender=Section)
+    # Signals are sent with the proxy class as sender
+    for question_class in set(INPUT_TYPE_MAP.values()) | {Question}:
+        signal.connect(touch_template_via_question, sender=question_class)
+    signal.connect(touch_template_via_question_fk, sender=CannedAnswer)
+    signal.connect(touch_template_via_question_fk, sender='eestore.EEStoreMount')
+    signal.connect(touch_template_via_node, sender='flow.Node')
+    signal.connect(touch_template_via_edge, sender='flow.Edge')
@@ -0,0 +1,106 @@
+"""Path analysis for the question graphs of sections
+
+The graphs are adjacency lists in a dict, mapping a question pk to the set of
+pks of the questions that might come next. ``None`` in a set marks that the
+path may end there. See ``TemplateGraph.get_section_adjacency()``.
+"""
+
+
+__all__ = [
+    'dfs_paths',
+    'is_complete_path',
+]
+
+
+class _LoopFound(Exception):
+    pass
+
+
+def dfs_paths(graph, start):
+    """Find all paths in  DAG graph, return a generator of lists
+
+    Input: adjacency list in a dict:
+
+    {
+        node1: set([node1, node2, node3]),
+        node2: set([node2, node3]),
+        node3: set(),
+    }
+    """
+    stack = [(start, [start])]
+    visited = set()
+    while stack:
+        # loop detection
+        if start in visited:
+            error = 'Graph is not a DAG, there\'s a loop for node "{}"'
+            raise TypeError(error.format(start))
+        (vertex, path) = stack.pop()
+        if not graph.get(vertex, None):
+            yield path
+        for next in graph[vertex] - set(path):
+            if not next:
+                yield path + [next]
+            else:
+                stack.append((next, path + [next]))
+
+
+def _may_end_at(graph, vertex):
+    nexts = graph.get(vertex, None)
+    return not nexts or None in nexts
+
+
+def _longest_path_within(graph, start, members):
+    """Count the vertices of the longest path from <start> to an end
+
+    Only vertices in <members> may be visited. Returns -1 if no such path
+    exists. Runs in O(V+E) by dynamic programming over the DAG, raises
+    ``_LoopFound`` if the graph turns out not to be a DAG.
+    """
+    longest = {}
+    on_path = set()
+    stack = [(start, False)]
+    while stack:
+        vertex, expanded = stack.pop()
+        if expanded:
+            on_path.discard(vertex)
+            best = 1 if _may_end_at(graph, vertex) else -1
+            for next in graph.get(vertex, None) or ():
+                if next in members and longest[next] > 0:
+                    best = max(best, longest[next] + 1)
+            longest[vertex] = best
+            continue
+        if vertex in longest:
+            continue
+        on_path.add(vertex)
+        stack.append((vertex, True))
+        for next in graph.get(vertex, None) or ():
+            if next is None or next not in members:
+                continue
+            if next in on_path:
+                raise _LoopFound(next)
+            if next not in longest:
+                stack.append((next, False))
+    return longest[start]
+
+
+def is_complete_path(graph, start, members):
+    """Check whether some path from <start> visits exactly the <members>
+
+    Gives the same answer as comparing <members> to every path generated by
+    ``dfs_paths(graph, start)``, with any trailing ``None`` removed, but
+    without listing the paths. Falls back to listing them if the graph is
+    not a DAG.
+    """
+    members = set(members)
+    if start not in members:
+        return False
+    try:
+        return _longest_path_within(graph, start, members) == len(members)
+    except _LoopFound:
+        pass
+    for path in dfs_paths(graph, start):
+        if not path[-1]:
+            path = path[:-1]
+        if members == set(path):
+            return True
+    return False
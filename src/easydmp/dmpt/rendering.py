@@ -0,0 +1,98 @@
+"""Render section graphs in the background
+
+Rendering a graph runs graphviz in a subprocess, which is too slow and too
+heavy to do while a web request waits. The graph API only serves files
+that are already cached; on a miss it asks for them to be rendered here,
+by a small thread pool in the web process, and tells the client to come
+back later. The management command ``cache_graphs`` renders in bulk.
+
+The size of the pool is set with ``EASYDMP_GRAPH_RENDER_WORKERS``; with 0
+there is no pool, and graphs are only rendered by ``cache_graphs``. Failed
+renderings are remembered for ``FAILURE_TTL`` seconds, so that clients get
+an error instead of being told to come back forever.
+"""
+
+import logging
+import threading
+import time
+
+from easydmp.utils.workers import WorkerPool
+
+
+__all__ = [
+    'get_rendering_error',
+    'queue_rendering',
+    'render_section_graph',
+]
+
+# Seconds before a failed rendering may be tried again
+FAILURE_TTL = 300
+
+LOG = logging.getLogger(__name__)
+
+_pool = WorkerPool('EASYDMP_GRAPH_RENDER_WORKERS')
+_lock = threading.Lock()
+_pending = set()
+_failed = {}  # (section pk, format) -> (monotonic time, error)
+
+
+def render_section_graph(section_pk, format):
+    "Refresh the cached graph of the section with pk <section_pk>"
+    from .models import Section
+
+    section = Section.objects.select_related('template').get(pk=section_pk)
+    section.refresh_cached_dotsource(format)
+
+
+def get_rendering_error(section_pk, format):
+    "Return why the graph last failed to render, if it did so recently"
+    key = (section_pk, format)
+    with _lock:
+        failure = _failed.get(key, None)
+        if failure is None:
+            return None
+        failed_at, error = failure
+        if time.monotonic() - failed_at > FAILURE_TTL:
+            del _failed[key]
+            return None
+        return error
+
+
+def _forget_old_failures(now):
+    for key, (failed_at, _) in list(_failed.items()):
+        if now - failed_at > FAILURE_TTL:
+            del _failed[key]
+
+
+def _render(key):
+    try:
+        render_section_graph(*key)
+    except Exception as e:
+        LOG.exception('Rendering graph of section %s as %s failed', *key)
+        now = time.monotonic()
+        with _lock:
+            # Sections that are never asked for again must not pile up
+            _forget_old_failures(now)
+            _failed[key] = (now, str(e) or repr(e))
+    else:
+        with _lock:
+            _failed.pop(key, None)
+    finally:
+        with _lock:
+            _pending.discard(key)
+
+
+def queue_rendering(section_pk, format):
+    """Have the worker pool render the graph of a section
+
+    A graph already waiting to be rendered is not queued twice. Returns
+    whether the graph will be rendered.
+    """
+    if not _pool.size:
+        return False
+    key = (section_pk, format)
+    with _lock:
+        if key in _pending:
+            return True
+        _pending.add(key)
+    return _pool.submit(_render, key)
@@ -4,13 +4,10 @@ from django.conf import settings
 from django.db import models
 from django.db import transaction
 
-from jsonfield import JSONField
+from easydmp.lib.fields import JSONField
 
 from .client import EEStoreServer, EEStoreRepo
 
-# With postgres 9.4+, use this instead
-# from django.contrib.postgres.fields import JSONField
-
 EESTORE_API_ROOT = 'https://eestore.paas2.uninett.no/api'
 
 
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-18 13:41
+from __future__ import unicode_literals
+
+from django.db import migrations
+import easydmp.lib.fields
+import jsonfield.encoder
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eventlog', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='eventlog',
+            name='data',
+            field=easydmp.lib.fields.JSONField(default={}, dump_kwargs={'cls': jsonfield.encoder.JSONEncoder, 'separators': (',', ':')}, load_kwargs={}),
+        ),
+    ]
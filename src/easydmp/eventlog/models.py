@@ -6,7 +6,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.timezone import now as tznow
 
-from jsonfield import JSONField
+from easydmp.lib.fields import JSONField
 
 
 GFK_MAPPER = {
@@ -0,0 +1,135 @@
+import json
+
+import jsonfield
+from django.db.models import Func, Lookup, Transform
+from django.db.models.lookups import Exact
+
+
+__all__ = [
+    'JSONField',
+    'RemoveKey',
+    'has_json_functions',
+]
+
+# Databases with the JSON operators or functions used here. The SQL is
+# SQLite's, which MySQL does not quite share (JSON_TYPE takes no path there)
+JSON_VENDORS = {'postgresql', 'sqlite'}
+
+
+def json_path(keys):
+    "Convert a sequence of object keys to a JSON path, for SQLite"
+    return '$' + ''.join('.' + json.dumps(str(key)) for key in keys)
+
+
+def has_json_functions(connection):
+    "Whether the lookups and expressions in this module work on <connection>"
+    return connection.vendor in JSON_VENDORS
+
+
+class JSONField(jsonfield.JSONField):
+    """JSON, stored natively where the database has a type for it
+
+    PostgreSQL gets a ``jsonb`` column. Elsewhere the value is stored as text
+    like ``jsonfield.JSONField`` does, and queried with the JSON functions of
+    the database, JSON1 on SQLite.
+
+    Keys of objects can be looked up, for instance
+    ``filter(data__12__choice='Yes')``, and checked for with
+    ``filter(data__has_key='12')``. Keys are always strings, also when they
+    look like numbers.
+    """
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'jsonb'
+        return super().db_type(connection)
+
+    def from_db_value(self, value, expression, connection, context=None):
+        # psycopg2 decodes jsonb by itself
+        if value is not None and not isinstance(value, (str, bytes, bytearray)):
+            return value
+        return super().from_db_value(value, expression, connection, context)
+
+    def get_transform(self, name):
+        transform = super().get_transform(name)
+        if transform:
+            return transform
+        return KeyTransformFactory(name)
+
+
+class KeyTransform(Transform):
+    "The value of a key of a JSON object, as JSON"
+
+    def __init__(self, key, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key = str(key)
+
+    def get_path(self):
+        "Return the underlying column and the keys leading from it to here"
+        keys = [self.key]
+        lhs = self.lhs
+        while isinstance(lhs, KeyTransform):
+            keys.insert(0, lhs.key)
+            lhs = lhs.lhs
+        return lhs, keys
+
+    def as_sql(self, compiler, connection):
+        lhs, keys = self.get_path()
+        sql, params = compiler.compile(lhs)
+        return 'JSON_EXTRACT(%s, %%s)' % sql, params + [json_path(keys)]
+
+    def as_postgresql(self, compiler, connection):
+        lhs, keys = self.get_path()
+        sql, params = compiler.compile(lhs)
+        return '(%s #> %%s)' % sql, params + [keys]
+
+
+class KeyTransformFactory:
+
+    def __init__(self, key):
+        self.key = key
+
+    def __call__(self, *args, **kwargs):
+        return KeyTransform(self.key, *args, **kwargs)
+
+
+@KeyTransform.register_lookup
+class KeyTransformExact(Exact):
+    "Compare JSON with JSON, not with its text"
+
+    def process_rhs(self, compiler, connection):
+        rhs, params = super().process_rhs(compiler, connection)
+        if connection.vendor == 'postgresql':
+            return '%s::jsonb' % rhs, params
+        # Turns JSON text into the same kind of value JSON_EXTRACT returns
+        return "JSON_EXTRACT(%s, '$')" % rhs, params
+
+
+@JSONField.register_lookup
+class HasKey(Lookup):
+    lookup_name = 'has_key'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        return 'JSON_TYPE(%s, %%s) IS NOT NULL' % lhs, params + [json_path([self.rhs])]
+
+    def as_postgresql(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        return '%s ? %%s' % lhs, params + [str(self.rhs)]
+
+
+class RemoveKey(Func):
+    "The JSON object <expression>, without the key <key>"
+
+    def __init__(self, expression, key, **extra):
+        super().__init__(expression, **extra)
+        self.key = str(key)
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.get_source_expressions()[0])
+        return 'JSON_REMOVE(%s, %%s)' % sql, params + [json_path([self.key])]
+
+    def as_postgresql(self, compiler, connection):
+        sql, params = compiler.compile(self.get_source_expressions()[0])
+        return '(%s - %%s)' % sql, params + [self.key]
@@ -1,11 +1,17 @@
 # encoding: utf-8
 
+import hashlib
+import os
+import shutil
 import tempfile
 from pathlib import PurePath, Path
 
 import graphviz as gv
 
 
+RENDER_CACHE_SUBDIRECTORY = 'rendered'
+
+
 def _prep_dotsource(graphviz_tmpdir):
     """Create workdir for graphviz"""
     path = Path(graphviz_tmpdir)
@@ -30,7 +36,39 @@ def view_dotsource(format, dotsource, graphviz_tmpdir, cleanup=True):
     graph.view(filename=tempfile.mktemp('.{}'.format(format)), cleanup=cleanup)
 
 
-def render_dotsource_to_file(format, filename, dotsource, root_directory, directory='', mode=0o750):
+def hash_dotsource(dotsource):
+    return hashlib.sha256(dotsource.encode('utf-8')).hexdigest()
+
+
+def render_dotsource_cached(format, dotsource, cache_directory, mode=0o750):
+    """Render <dotsource> to <format>, unless it has been done before
+
+    Rendered files are stored in the subdirectory "rendered" of
+    <cache_directory>, named by the sha256 of the dotsource, so identical
+    graphs are only ever rendered once. Returns the path of the rendered
+    file.
+    """
+    cache_directory = Path(cache_directory).resolve() / RENDER_CACHE_SUBDIRECTORY
+    cache_directory.mkdir(mode=mode, exist_ok=True, parents=True)
+    digest = hash_dotsource(dotsource)
+    full_path = cache_directory / '{}.{}'.format(digest, format)
+    if full_path.exists():
+        return full_path
+    # Render under a unique name and move into place, so that concurrent
+    # renderings of the same graph never see a half-written file
+    with tempfile.TemporaryDirectory(dir=str(cache_directory)) as workdir:
+        graph = gv.Source(
+            source=dotsource,
+            format=format,
+            filename=digest,
+            directory=workdir,
+        )
+        rendered = graph.render(cleanup=True)
+        os.replace(rendered, str(full_path))
+    return full_path
+
+
+def render_dotsource_to_file(format, filename, dotsource, root_directory, directory='', mode=0o750, cache_directory=None):
     """Generate and store a file of the fsa structure
 
     This will create a file at <filename> on the computer this software
@@ -42,6 +80,8 @@ def render_dotsource_to_file(format, filename, dotsource, root_directory, direct
     root_directory: parent directory to generate files in. Never set by end user
     directory: directory within parent directory o generate files in. May be set by user
     mode: mode of directory. Default: 0o750
+    cache_directory: where to keep rendered files for reuse, see
+        ``render_dotsource_cached()``. Default: <root_directory>
     """
     _prep_dotsource(root_directory)
     extension = '.' + format
@@ -61,12 +101,7 @@ def render_dotsource_to_file(format, filename, dotsource, root_directory, direct
     except ValueError:
         directory = root_directory
     directory.mkdir(mode=mode, exist_ok=True, parents=True)
-    graph = gv.Source(
-        source=dotsource,
-        format=format,
-        filename=filename,
-        directory=str(directory),
-    )
-    graph.render(cleanup=True)
+    rendered = render_dotsource_cached(format, dotsource, cache_directory or root_directory, mode)
     full_path = directory / PurePath(filename).with_suffix(extension)
+    shutil.copyfile(str(rendered), str(full_path))
     return full_path
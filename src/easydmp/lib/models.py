@@ -1,4 +1,7 @@
-from django.db import models
+from operator import attrgetter
+
+from django.db import IntegrityError, connection, connections, models, transaction
+from django.db.models import Case, IntegerField, Max, When
 
 
 class ModifiedTimestampModel(models.Model):
@@ -6,3 +9,79 @@ class ModifiedTimestampModel(models.Model):
 
     class Meta:
         abstract = True
+
+
+def bulk_create_with_pks(model, objs, key_fields=None):
+    """Insert <objs> in one go and make sure they get their primary keys
+
+    Not every database returns the keys of bulk inserted rows. Then the rows
+    inserted after the highest key seen beforehand are looked up again, and
+    matched to <objs> on <key_fields>. Other connections may insert rows
+    meanwhile, so the values of <key_fields> must tell the new rows apart
+    from any other rows, like the fields of a unique constraint. Without
+    <key_fields>, the objects are saved one by one instead.
+    """
+    objs = list(objs)
+    if not objs:
+        return objs
+    if connection.features.can_return_ids_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    if not key_fields:
+        with transaction.atomic():
+            for obj in objs:
+                obj.save(force_insert=True)
+        return objs
+    attnames = [model._meta.get_field(name).attname for name in key_fields]
+    get_key = attrgetter(*attnames)
+    by_key = {}
+    for obj in objs:
+        if by_key.setdefault(get_key(obj), obj) is not obj:
+            raise ValueError('Objects with the same {}: {}'.format(key_fields, get_key(obj)))
+    # Failing halfway must undo the insert, but needs no savepoint of its own
+    with transaction.atomic(savepoint=False):
+        last_pk = model.objects.aggregate(last_pk=Max('pk'))['last_pk'] or 0
+        model.objects.bulk_create(objs)
+        rows = model.objects.filter(pk__gt=last_pk).values_list('pk', *attnames)
+        found = 0
+        for pk, *key in rows:
+            key = key[0] if len(key) == 1 else tuple(key)
+            obj = by_key.get(key, None)
+            if obj is None:
+                continue
+            if obj.pk is not None:
+                raise IntegrityError('Cannot tell new {} rows apart by {}'.format(
+                    model._meta.label, key_fields))
+            obj.pk = pk
+            found += 1
+        if found != len(objs):
+            raise IntegrityError('Lost track of new {} rows'.format(model._meta.label))
+    return objs
+
+
+def max_rows_per_query(params_per_row, rows, using='default'):
+    """Cap <rows> so that a query with <params_per_row> each fits the database
+
+    SQLite, for one, refuses queries with more than 999 parameters. A couple
+    of parameters are left over for the rest of the query.
+    """
+    db = connections[using]
+    max_params = getattr(db.features, 'max_query_params', None)
+    if max_params is None and db.vendor == 'sqlite':
+        # Older Djangos do not know, this is SQLite's default limit
+        max_params = 999
+    if max_params is None:
+        return rows
+    return max(1, min(rows, (max_params - 2) // params_per_row))
+
+
+def update_fk_by_pk(model, fieldname, mapping):
+    "Set foreign key <fieldname> of the rows of <model> per {pk: value} <mapping>"
+    items = list(mapping.items())
+    # A When and the IN list per row
+    batch_size = max_rows_per_query(3, len(items))
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i + batch_size]
+        whens = [When(pk=pk, then=value) for pk, value in batch]
+        model.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+            **{fieldname: Case(*whens, output_field=IntegerField())}
+        )
@@ -4,6 +4,7 @@ from easydmp.lib.admin import FakeBooleanFilter
 from easydmp.lib.admin import PublishedFilter
 
 from .models import Plan, PlanComment
+from .models import PublishingJob
 from .models import PlanAccess
 
 
@@ -46,11 +47,20 @@ class PlanAdmin(admin.ModelAdmin):
 
     def publish(self, request, queryset):
         for q in queryset.filter(locked__isnull=True, published__isnull=True):
-            q.publish(request.user)
-            self.message_user(request, 'Successfully published "{}"'.format(str(q)))
+            if q.queue_publishing(request.user):
+                self.message_user(request, 'Queued "{}" for publishing'.format(str(q)))
     publish.short_description = 'Publish plans'
 
 
+@admin.register(PublishingJob)
+class PublishingJobAdmin(admin.ModelAdmin):
+    list_display = ['plan', 'status', 'requested_by', 'added', 'finished']
+    list_filter = ['status']
+    search_fields = ['plan__title']
+    readonly_fields = ['plan', 'timestamp', 'requested_by', 'added', 'started',
+                       'finished', 'error']
+
+
 @admin.register(PlanComment)
 class PlanCommentAdmin(admin.ModelAdmin):
     list_display = ['plan', 'question', 'added_by', 'added']
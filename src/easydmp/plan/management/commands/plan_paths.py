@@ -0,0 +1,129 @@
+import csv
+import json
+from itertools import groupby, islice
+from operator import itemgetter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from easydmp.dmpt.errors import TemplateDesignError
+from easydmp.dmpt.graph import get_template_graph
+from easydmp.plan.models import Plan
+from flow.errors import FSANoStartnodeError
+from flow.evaluation import PathEvaluator
+from flow.models import FSA, get_transition_table
+
+
+CHUNK_SIZE = 1000
+FIELDS = ('plan', 'template', 'section', 'fsa', 'complete', 'nodes', 'questions')
+
+
+class TemplateFSAs:
+    "The FSAs of a template, with what is needed to evaluate plans against them"
+
+    def __init__(self, template_pk):
+        self.graph = get_template_graph(template_pk)
+        self.fsas = {}  # fsa pk -> (section pk, table, evaluator)
+        self.fsa_of_question = {}
+        for section in self.graph.sections:
+            for question in self.graph.get_questions_in_section(section.pk):
+                if not question.node_id:
+                    continue
+                fsa_pk = question.node.fsa_id
+                self.fsa_of_question[question.pk] = fsa_pk
+                if fsa_pk in self.fsas:
+                    continue
+                table = get_transition_table(fsa_pk)
+                try:
+                    evaluator = PathEvaluator(table)
+                except FSANoStartnodeError:
+                    continue
+                self.fsas[fsa_pk] = (section.pk, table, evaluator)
+        self.slugs = dict(FSA.objects.filter(pk__in=self.fsas).values_list('pk', 'slug'))
+
+    def split_data(self, data):
+        "Convert the answers of a plan to node data, per FSA"
+        per_fsa = {}
+        for question_pk, answer in (data or {}).items():
+            fsa_pk = self.fsa_of_question.get(int(question_pk), None)
+            if fsa_pk not in self.fsas:
+                continue
+            question = self.graph.get_question(int(question_pk))
+            condition = question.map_choice_to_condition(answer)
+            per_fsa.setdefault(fsa_pk, {})[str(question.node.slug)] = condition
+        return per_fsa
+
+    def get_question_pks(self, table, node_slugs):
+        question_pks = []
+        for slug in node_slugs:
+            try:
+                question_pks.append(self.graph.get_payload(table.slugs[slug]).pk)
+            except TemplateDesignError:
+                pass
+        return question_pks
+
+
+class Command(BaseCommand):
+    help = "Write the path each plan took through each FSA, as CSV or JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-t', '--template', type=int, action='append',
+                            default=[], dest='templates',
+                            help='Only plans of this template (id), repeatable')
+        parser.add_argument('-f', '--format', choices=('csv', 'jsonl'), default='csv')
+        parser.add_argument('-o', '--output', help='Write to this file instead of stdout')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of plans to evaluate at once (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        plans = Plan.objects.all()
+        if options['templates']:
+            plans = plans.filter(template_id__in=options['templates'])
+        plans = plans.order_by('template_id', 'pk').values_list('template_id', 'pk', 'data')
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as out:
+                self.write(out, plans, options['format'], options['chunk_size'])
+        else:
+            self.write(self.stdout, plans, options['format'], options['chunk_size'])
+
+    def write(self, out, plans, format, chunk_size):
+        if format == 'csv':
+            writer = csv.DictWriter(out, FIELDS, lineterminator='\n')
+            writer.writeheader()
+            write_row = writer.writerow
+        else:
+            def write_row(row):
+                out.write(json.dumps(row) + '\n')
+        for row in self.iter_rows(plans, chunk_size):
+            if format == 'csv':
+                row['nodes'] = ' '.join(row['nodes'])
+                row['questions'] = ' '.join(str(pk) for pk in row['questions'])
+            write_row(row)
+
+    def iter_rows(self, plans, chunk_size):
+        "Generate a row per plan and FSA, for FSAs the plan has answers for"
+        for template_pk, template_plans in groupby(plans.iterator(), key=itemgetter(0)):
+            fsas = TemplateFSAs(template_pk)
+            while True:
+                chunk = list(islice(template_plans, chunk_size))
+                if not chunk:
+                    break
+                data_per_fsa = {}
+                for _, plan_pk, data in chunk:
+                    for fsa_pk, fsa_data in fsas.split_data(data).items():
+                        data_per_fsa.setdefault(fsa_pk, []).append((plan_pk, fsa_data))
+                for fsa_pk, items in data_per_fsa.items():
+                    section_pk, table, evaluator = fsas.fsas[fsa_pk]
+                    fsa_slug = fsas.slugs[fsa_pk]
+                    for path in evaluator.evaluate_chunk(items):
+                        yield {
+                            'plan': path.key,
+                            'template': template_pk,
+                            'section': section_pk,
+                            'fsa': fsa_slug,
+                            'complete': path.complete,
+                            'nodes': path.nodes,
+                            'questions': fsas.get_question_pks(table, path.nodes),
+                        }
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from easydmp.plan.models import PublishingJob
+from easydmp.plan.publishing import run_queued_jobs
+
+
+class Command(BaseCommand):
+    help = "Publish the plans queued for publishing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--limit', type=int, default=None,
+                            help='Run at most this many jobs')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Queue failed jobs again first')
+        parser.add_argument('--timeout', type=int, default=None,
+                            help='Queue jobs running for longer than this many seconds again '
+                            '(default: EASYDMP_PUBLISHING_TIMEOUT)')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            retried = (PublishingJob.objects
+                       .filter(status=PublishingJob.FAILED)
+                       .update(status=PublishingJob.QUEUED, error='',
+                               started=None, finished=None))
+            if options['verbosity'] > 1:
+                self.stdout.write('Queued {} failed jobs again'.format(retried))
+        stale = PublishingJob.objects.requeue_stale(options['timeout'])
+        if options['verbosity'] > 1:
+            self.stdout.write('Queued {} stale jobs again'.format(stale))
+        start = time.monotonic()
+        succeeded, failed = run_queued_jobs(options['limit'])
+        elapsed = time.monotonic() - start
+        self.stdout.write('Published {} plans, {} failed, in {:.2f}s'.format(
+            succeeded, failed, elapsed))
@@ -0,0 +1,211 @@
+from collections import defaultdict
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import BooleanField, Case, PositiveIntegerField, Q, Value, When
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import make_aware, is_naive, now as tznow
+
+from easydmp.dmpt.graph import get_template_graph
+from easydmp.lib.models import max_rows_per_query
+from easydmp.plan.models import Plan, QuestionValidity, SectionValidity
+from easydmp.utils.workers import process_pool
+
+
+CHUNK_SIZE = 100
+
+
+def validate_plan_data(graph, data):
+    """Find the validity of all questions and sections of a plan
+
+    Returns a tuple of valid question pks and valid section pks, or None if
+    the data is empty or does not belong to the template of <graph>.
+    """
+    if not data:
+        return None
+    if set(int(k) for k in data).difference(graph.question_pks):
+        return None
+    valid_questions = set()
+    valid_sections = set()
+    for section in graph.sections:
+        valids, invalids = graph.find_validity_of_questions(section.pk, data)
+        valid_questions.update(valids)
+        if graph.is_section_valid(section.pk, valids, invalids):
+            valid_sections.add(section.pk)
+    return (valid_questions, valid_sections)
+
+
+def validate_chunk(args):
+    """Validate the plans of a template with pks from <first_pk> to <last_pk>
+
+    Plans modified before <since> are skipped, if given. Each worker reads
+    its own plans, so their data never passes through the parent.
+    """
+    template_pk, first_pk, last_pk, since = args
+    graph = get_template_graph(template_pk)
+    plans = Plan.objects.filter(template_id=template_pk, pk__gte=first_pk, pk__lte=last_pk)
+    if since:
+        plans = plans.filter(modified__gte=since)
+    plans = plans.order_by('pk').values_list('pk', 'data')
+    return (template_pk, [(plan_pk, validate_plan_data(graph, data)) for plan_pk, data in plans])
+
+
+class Command(BaseCommand):
+    help = "Recalculate the validity of plans, in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-t', '--template', type=int, action='append',
+                            default=[], dest='templates',
+                            help='Only revalidate plans of this template (id), repeatable')
+        parser.add_argument('-s', '--since',
+                            help='Only revalidate plans modified since this date or datetime (ISO 8601)')
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes, 1 means no pool (default: number of CPUs)')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='Report what would change without writing anything')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of plans to validate at once (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.dry_run = options['dry_run']
+        jobs = options['jobs']
+        if jobs < 1:
+            raise CommandError('--jobs must be at least 1')
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        since = self.parse_since(options['since']) if options['since'] else None
+        plans = Plan.objects.all()
+        if options['templates']:
+            plans = plans.filter(template_id__in=options['templates'])
+        if since:
+            plans = plans.filter(modified__gte=since)
+        plans = plans.order_by('template_id', 'pk').values_list('template_id', 'pk')
+
+        # Only the pks are read here, the workers read the data
+        by_template = defaultdict(list)
+        for template_pk, plan_pk in plans.iterator():
+            by_template[template_pk].append(plan_pk)
+        total = sum(len(plan_pks) for plan_pks in by_template.values())
+        chunks = []
+        for template_pk, plan_pks in by_template.items():
+            for i in range(0, len(plan_pks), chunk_size):
+                pks = plan_pks[i:i+chunk_size]
+                chunks.append((template_pk, pks[0], pks[-1], since))
+
+        self.counts = defaultdict(int)
+        start = time.monotonic()
+        if jobs == 1 or len(chunks) < 2:
+            results = map(validate_chunk, chunks)
+            self.process_results(results, total)
+        else:
+            with process_pool(jobs) as pool:
+                results = pool.imap_unordered(validate_chunk, chunks)
+                self.process_results(results, total)
+        elapsed = time.monotonic() - start
+
+        rate = total / elapsed if elapsed else 0.0
+        summary = '{} plans of {} templates in {:.2f}s ({:.1f} plans/sec): {} changed, {} without usable data'
+        if self.dry_run:
+            summary += ' (dry run, nothing written)'
+        self.stdout.write(summary.format(total, len(by_template), elapsed, rate,
+                                         self.counts['changed'], self.counts['unusable']))
+
+    def parse_since(self, value):
+        since = parse_datetime(value)
+        if since is None:
+            date = parse_date(value)
+            if date is None:
+                raise CommandError('Could not parse --since: {}'.format(value))
+            since = parse_datetime(date.isoformat() + 'T00:00')
+        if settings.USE_TZ and is_naive(since):
+            since = make_aware(since)
+        return since
+
+    def process_results(self, results, total):
+        done = 0
+        for template_pk, result in results:
+            self.write_chunk(template_pk, result)
+            done += len(result)
+            if self.verbosity > 1:
+                self.stdout.write('{}/{} plans'.format(done, total))
+
+    def write_chunk(self, template_pk, result):
+        graph = get_template_graph(template_pk)
+        # The When of a plan lists all its valid questions or sections
+        params_per_plan = max(len(graph.question_pks), len(graph.sections)) + 3
+        batch_size = max_rows_per_query(params_per_plan, len(result))
+        for i in range(0, len(result), batch_size):
+            self.write_batch(graph, result[i:i+batch_size])
+
+    def write_batch(self, graph, result):
+        plan_pks = [plan_pk for plan_pk, _ in result]
+        usable = [plan_pk for plan_pk, validities in result if validities is not None]
+        old = dict(Plan.objects.filter(pk__in=plan_pks).values_list('pk', 'valid'))
+        plan_whens = []
+        count_whens = []
+        question_whens = []
+        section_whens = []
+        for plan_pk, validities in result:
+            if validities is None:
+                self.counts['unusable'] += 1
+                valid = False
+            else:
+                valid_questions, valid_sections = validities
+                valid = len(valid_sections) == len(graph.sections)
+                question_whens.append(When(Q(plan_id=plan_pk, question_id__in=valid_questions),
+                                           then=Value(True)))
+                section_whens.append(When(Q(plan_id=plan_pk, section_id__in=valid_sections),
+                                          then=Value(True)))
+                count_whens.append(When(pk=plan_pk, then=Value(len(valid_sections))))
+            if old.get(plan_pk) is not valid:
+                self.counts['changed'] += 1
+            plan_whens.append(When(pk=plan_pk, then=Value(valid)))
+        if self.dry_run:
+            return
+
+        with transaction.atomic():
+            if usable:
+                self.create_missing_rows(graph, usable)
+                (QuestionValidity.objects
+                 .filter(plan_id__in=usable)
+                 .update(valid=Case(*question_whens, default=Value(False),
+                                    output_field=BooleanField())))
+                (SectionValidity.objects
+                 .filter(plan_id__in=usable)
+                 .update(valid=Case(*section_whens, default=Value(False),
+                                    output_field=BooleanField())))
+                (Plan.objects
+                 .filter(pk__in=usable)
+                 .update(valid_section_count=Case(*count_whens,
+                                                  output_field=PositiveIntegerField())))
+            (Plan.objects
+             .filter(pk__in=plan_pks)
+             .update(valid=Case(*plan_whens, output_field=BooleanField()),
+                     last_validated=tznow()))
+
+    def create_missing_rows(self, graph, plan_pks):
+        "Plans predating a question or section lack validity rows for them"
+        existing = set(QuestionValidity.objects
+                       .filter(plan_id__in=plan_pks)
+                       .values_list('plan_id', 'question_id'))
+        QuestionValidity.objects.bulk_create(
+            QuestionValidity(plan_id=plan_pk, question_id=question_pk, valid=False)
+            for plan_pk in plan_pks
+            for question_pk in graph.question_pks
+            if (plan_pk, question_pk) not in existing
+        )
+        existing = set(SectionValidity.objects
+                       .filter(plan_id__in=plan_pks)
+                       .values_list('plan_id', 'section_id'))
+        SectionValidity.objects.bulk_create(
+            SectionValidity(plan_id=plan_pk, section_id=section.pk, valid=False)
+            for plan_pk in plan_pks
+            for section in graph.sections
+            if (plan_pk, section.pk) not in existing
+        )
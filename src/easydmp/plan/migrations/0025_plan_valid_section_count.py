@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_valid_sections(apps, schema_editor):
+    Plan = apps.get_model('plan', 'Plan')
+    SectionValidity = apps.get_model('plan', 'SectionValidity')
+    counts = (SectionValidity.objects
+              .filter(valid=True)
+              .values('plan')
+              .annotate(count=Count('pk'))
+              .values_list('plan', 'count'))
+    for plan_pk, count in counts:
+        Plan.objects.filter(pk=plan_pk).update(valid_section_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plan', '0024_cleanup_plan_editor_groups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plan',
+            name='valid_section_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_valid_sections, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-18 13:38
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import jsonfield.encoder
+import jsonfield.fields
+
+
+def create_history(apps, schema_editor):
+    """Start the answer history with the current and previous answers
+
+    When they were answered is not known, so both get the time the plan
+    was last modified.
+    """
+    Plan = apps.get_model('plan', 'Plan')
+    AnswerRevision = apps.get_model('plan', 'AnswerRevision')
+    plans = Plan.objects.values_list('pk', 'data', 'previous_data', 'modified', 'modified_by')
+    for plan_pk, data, previous_data, modified, modified_by in plans.iterator():
+        revisions = []
+        for question_pk, choice in (data or {}).items():
+            revision = 1
+            previous = (previous_data or {}).get(question_pk, None)
+            if previous and previous != choice:
+                revisions.append(AnswerRevision(
+                    plan_id=plan_pk, question_id=int(question_pk), revision=1,
+                    choice=previous, added=modified, added_by_id=modified_by,
+                ))
+                revision = 2
+            revisions.append(AnswerRevision(
+                plan_id=plan_pk, question_id=int(question_pk), revision=revision,
+                choice=choice, added=modified, added_by_id=modified_by,
+            ))
+        AnswerRevision.objects.bulk_create(revisions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dmpt', '0028_template_modified'),
+        ('plan', '0026_publishingjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revision', models.PositiveIntegerField()),
+                ('choice', jsonfield.fields.JSONField(blank=True, dump_kwargs={'cls': jsonfield.encoder.JSONEncoder, 'separators': (',', ':')}, load_kwargs={}, null=True)),
+                ('added', models.DateTimeField(default=django.utils.timezone.now)),
+                ('added_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_revisions', to='plan.Plan')),
+                ('question', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='dmpt.Question')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='answerrevision',
+            index=models.Index(fields=['plan', 'added'], name='plan_answer_plan_id_50f683_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='answerrevision',
+            unique_together=set([('plan', 'question', 'revision')]),
+        ),
+        migrations.RunPython(create_history, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-18 13:41
+from __future__ import unicode_literals
+
+from django.db import migrations
+import easydmp.lib.fields
+import jsonfield.encoder
+
+
+def create_gin_index(apps, schema_editor):
+    # Only PostgreSQL can index the keys of a JSON column
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX plan_plan_data_gin ON plan_plan USING gin (data)'
+        )
+
+
+def drop_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS plan_plan_data_gin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plan', '0027_answerrevision'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='answerrevision',
+            name='choice',
+            field=easydmp.lib.fields.JSONField(blank=True, dump_kwargs={'cls': jsonfield.encoder.JSONEncoder, 'separators': (',', ':')}, load_kwargs={}, null=True),
+        ),
+        migrations.AlterField(
+            model_name='plan',
+            name='data',
+            field=easydmp.lib.fields.JSONField(default={}, dump_kwargs={'cls': jsonfield.encoder.JSONEncoder, 'separators': (',', ':')}, load_kwargs={}),
+        ),
+        migrations.AlterField(
+            model_name='plan',
+            name='previous_data',
+            field=easydmp.lib.fields.JSONField(default={}, dump_kwargs={'cls': jsonfield.encoder.JSONEncoder, 'separators': (',', ':')}, load_kwargs={}),
+        ),
+        migrations.RunPython(create_gin_index, drop_gin_index),
+    ]
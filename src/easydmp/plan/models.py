@@ -1,25 +1,28 @@
 import logging
 from copy import deepcopy
+from datetime import timedelta
+from itertools import islice
+import time
 from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, F, Max, Q, Value, When
+from django.db.models.signals import pre_delete
 from django.forms import model_to_dict
 from django.template.loader import render_to_string
 from django.utils.timezone import now as tznow
 
-from jsonfield import JSONField
-
-# With postgres 9.4+, use this instead
-# from django.contrib.postgres.fields import JSONField
-
 from flow.modelmixins import ClonableModel
 
 from easydmp.dmpt.forms import make_form
+from easydmp.dmpt.graph import get_template_graph
 from easydmp.dmpt.utils import DeletionMixin
+from easydmp.lib.fields import JSONField, RemoveKey, has_json_functions
+from easydmp.lib.models import max_rows_per_query
 
-from .utils import purge_answer
 from .utils import get_editors_for_plan
 
 
@@ -27,20 +30,61 @@ LOG = logging.getLogger(__name__)
 GENERATED_HTML_TEMPLATE = 'easydmp/plan/generated_plan.html'
 
 
+def get_or_create_validities(model, plan, fieldname, pks, valids=()):
+    """Return the validity rows of <plan> for <pks>, by pk
+
+    <model> is QuestionValidity or SectionValidity and <fieldname> the
+    attname of its question or section. Missing rows are created in bulk,
+    valid if their pk is in <valids>. Other requests may create the same
+    rows meanwhile, so the rows are always selected again after inserting.
+    """
+    pks = set(pks)
+    lookup = {'plan': plan, fieldname + '__in': pks}
+    for _ in range(3):
+        rows = {getattr(row, fieldname): row for row in model.objects.filter(**lookup)}
+        missing = pks - set(rows)
+        if not missing:
+            return rows
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create(
+                    model(plan=plan, valid=pk in valids, **{fieldname: pk})
+                    for pk in missing
+                )
+        except IntegrityError:
+            # Some were created by someone else, try again with the rest
+            continue
+    return {getattr(row, fieldname): row for row in model.objects.filter(**lookup)}
+
+
 class Answer():
     "Helper-class combining a Question and a Plan"
 
-    def __init__(self, question, plan):
+    def __init__(self, question, plan, question_validity=None, section_validity=None):
         self.question = question.get_instance()
         self.plan = plan
         # IMPORTANT: json casts ints to string as keys in dicts, so use strings
         self.question_id = str(self.question.pk)
         self.has_notes = self.question.has_notes
         self.section = self.question.section
-        self.question_validity = self.get_question_validity()
-        self.section_validity = self.get_section_validity()
+        self.question_validity = question_validity or self.get_question_validity()
+        self.section_validity = section_validity or self.get_section_validity()
         self.current_choice = plan.data.get(self.question_id, {})
 
+    @classmethod
+    def for_questions(cls, questions, plan):
+        """Make an Answer for each of <questions>, in order
+
+        The validities of all the questions and of their sections are
+        fetched with one query each, missing ones are created in bulk.
+        """
+        questions = list(questions)
+        qvs = get_or_create_validities(QuestionValidity, plan, 'question_id',
+                                       (q.pk for q in questions))
+        svs = get_or_create_validities(SectionValidity, plan, 'section_id',
+                                       (q.section_id for q in questions))
+        return [cls(q, plan, qvs[q.pk], svs[q.section_id]) for q in questions]
+
     def get_question_validity(self):
         qv, _ = QuestionValidity.objects.get_or_create(
             plan=self.plan,
@@ -67,19 +111,8 @@ class Answer():
         if self.current_choice != choice:
             LOG.debug('q%s/p%s: saving changes',
                       self.question_id, self.plan.pk)
-            self.plan.modified_by = saved_by
-            self.plan.previous_data[self.question_id] = self.current_choice
-            self.plan.data[self.question_id] = choice
-            self.plan.save(question=self.question)
-            LOG.debug('q%s/p%s: setting question valid',
-                      self.question_id, self.plan.pk)
-            self.question_validity.valid = True
-            self.question_validity.save()
-            if not self.section_validity.valid and self.section.validate_data(self.plan.data):
-                LOG.debug('q%s/p%s: setting section valid',
-                          self.question_id, self.plan.pk)
-                self.section_validity.valid = True
-                self.section_validity.save()
+            # Also revalidates the question and its section(s)
+            self.plan.save_choices({self.question_id: choice}, saved_by)
 
     def set_invalid(self):
         if self.question_validity.valid:
@@ -87,15 +120,105 @@ class Answer():
             self.question_validity.valid = False
             self.question_validity.save()
             self.section_validity.valid = False
-            self.section_validity.save()
+            self.plan.update_section_validities(set(), {self.section.pk})
+            self.plan.valid = False
+            self.plan.save()
 
 
 class PlanQuerySet(models.QuerySet):
 
-    def purge_answer(self, question_pk):
-        qs = self.all()
-        for plan in qs:
-            purge_answer(plan, question_pk)
+    def answered(self, question_pk):
+        "Plans with an answer to the question with pk <question_pk>"
+        return self.filter(data__has_key=str(question_pk))
+
+    def with_choice(self, question_pk, choice):
+        "Plans where the question with pk <question_pk> is answered with <choice>"
+        return self.filter(**{'data__{}__choice'.format(question_pk): choice})
+
+    def purge_answer(self, question_pk, chunk_size=200):
+        """Remove the answer to a question from all the plans
+
+        The answer is removed from both ``data`` and ``previous_data``, in a
+        single UPDATE where the database has JSON functions, else
+        <chunk_size> plans at a time, fewer if the database limits the
+        number of parameters of a query. Plans are not saved one by one, so
+        they are not revalidated. The removal is added to the answer
+        history, and the validity of the question is deleted.
+
+        Returns a dict of the number of plans changed, answer revisions
+        added and question validities deleted, and the seconds it took.
+        """
+        start = time.monotonic()
+        key = str(question_pk)
+        with transaction.atomic(using=self.db):
+            if has_json_functions(connections[self.db]):
+                answered, changed = self._purge_answer_in_db(key)
+            else:
+                answered, changed = self._purge_answer_in_chunks(key, chunk_size)
+            revisions = AnswerRevision.objects.record_removals(answered, key)
+            _, deleted = QuestionValidity.objects.filter(
+                plan__in=self,
+                question_id=question_pk,
+            ).delete()
+            validities = deleted.get(QuestionValidity._meta.label, 0)
+        report = {
+            'plans': changed,
+            'revisions': revisions,
+            'question_validities': validities,
+            'seconds': time.monotonic() - start,
+        }
+        LOG.info('Purged answers to question %s: %s plans, %s revisions, '
+                 '%s question validities in %.2fs', question_pk,
+                 changed, revisions, validities, report['seconds'])
+        return report
+
+    def _purge_answer_in_db(self, key):
+        # Locked, so that the answer history cannot be added to meanwhile
+        answered = list(self.answered(key).select_for_update().values_list('pk', flat=True))
+        changed = self.filter(
+            Q(data__has_key=key) | Q(previous_data__has_key=key)
+        ).update(
+            data=RemoveKey('data', key),
+            previous_data=RemoveKey('previous_data', key),
+            modified=tznow(),
+        )
+        return answered, changed
+
+    def _purge_answer_in_chunks(self, key, chunk_size):
+        answered = []
+        changed = 0
+        # Two Whens and the IN list per plan
+        chunk_size = max_rows_per_query(5, chunk_size, using=self.db)
+        plans = self.order_by('pk').values_list('pk', 'data', 'previous_data').iterator()
+        while True:
+            chunk = list(islice(plans, chunk_size))
+            if not chunk:
+                break
+            datas, previous_datas = {}, {}
+            for pk, data, previous_data in chunk:
+                if key in data:
+                    answered.append(pk)
+                if key in data or key in previous_data:
+                    data.pop(key, None)
+                    previous_data.pop(key, None)
+                    datas[pk] = data
+                    previous_datas[pk] = previous_data
+            if not datas:
+                continue
+            changed += Plan.objects.filter(pk__in=datas).update(
+                data=Case(
+                    *[When(pk=pk, then=Value(data, output_field=JSONField()))
+                      for pk, data in datas.items()],
+                    output_field=JSONField(),
+                ),
+                previous_data=Case(
+                    *[When(pk=pk, then=Value(data, output_field=JSONField()))
+                      for pk, data in previous_datas.items()],
+                    output_field=JSONField(),
+                ),
+                modified=tznow(),
+            )
+        return answered, changed
 
     def locked(self):
         return self.filter(locked__isnull=False)
@@ -157,6 +280,66 @@ class QuestionValidity(ClonableModel):
         unique_together = ('plan', 'question')
 
 
+class AnswerRevisionQuerySet(models.QuerySet):
+
+    def record_removals(self, plan_pks, question_pk, batch_size=1000):
+        """Record that the answer to a question was removed from many plans
+
+        Returns the number of revisions added.
+        """
+        question_pk = int(question_pk)
+        now = tznow()
+        plan_pks = list(plan_pks)
+        batch_size = max_rows_per_query(1, batch_size, using=self.db)
+        for i in range(0, len(plan_pks), batch_size):
+            batch = plan_pks[i:i + batch_size]
+            latest = dict(self
+                          .filter(plan_id__in=batch, question_id=question_pk)
+                          .order_by()
+                          .values_list('plan_id')
+                          .annotate(latest=Max('revision')))
+            self.bulk_create([
+                AnswerRevision(
+                    plan_id=plan_pk,
+                    question_id=question_pk,
+                    revision=latest.get(plan_pk, 0) + 1,
+                    choice=None,
+                    added=now,
+                )
+                for plan_pk in batch
+            ])
+        return len(plan_pks)
+
+
+class AnswerRevision(models.Model):
+    """A change to the answer to a question in a plan
+
+    The history is append only. The latest revision of each question is
+    what is in ``Plan.data``, a choice of ``None`` means that the answer was
+    removed.
+    """
+    plan = models.ForeignKey('plan.Plan', models.CASCADE, related_name='answer_revisions')
+    # Plans may have answers to questions that are no longer there
+    question = models.ForeignKey('dmpt.Question', models.DO_NOTHING,
+                                 related_name='+', db_constraint=False)
+    revision = models.PositiveIntegerField()
+    choice = JSONField(blank=True, null=True)
+    added = models.DateTimeField(default=tznow)
+    added_by = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL,
+                                 related_name='+', blank=True, null=True)
+
+    objects = AnswerRevisionQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('plan', 'question', 'revision')
+        indexes = [
+            models.Index(fields=['plan', 'added']),
+        ]
+
+    def __str__(self):
+        return 'p{}/q{}: revision {}'.format(self.plan_id, self.question_id, self.revision)
+
+
 class Plan(DeletionMixin, ClonableModel):
     title = models.CharField(
         max_length=255,
@@ -173,6 +356,7 @@ class Plan(DeletionMixin, ClonableModel):
     uuid = models.UUIDField(default=uuid4, editable=False)
     template = models.ForeignKey('dmpt.Template', related_name='plans')
     valid = models.NullBooleanField()
+    valid_section_count = models.PositiveIntegerField(default=0, editable=False)
     last_validated = models.DateTimeField(blank=True, null=True)
     data = JSONField(default={})
     previous_data = JSONField(default={})
@@ -248,14 +432,55 @@ class Plan(DeletionMixin, ClonableModel):
             svs.append(SectionValidity(plan=self, section=section, valid=False))
         SectionValidity.objects.bulk_create(svs)
 
-    def set_sections_as_valid(self, *sections):
+    def set_sections_as_valid(self, *section_pks):
         qs = SectionValidity.objects.filter(plan=self, section_id__in=section_pks)
         qs.update(valid=True)
 
-    def set_sections_as_invalid(self, *sections):
+    def set_sections_as_invalid(self, *section_pks):
         qs = SectionValidity.objects.filter(plan=self, section_id__in=section_pks)
         qs.update(valid=False)
 
+    def update_section_validities(self, valids, invalids, recount=False):
+        """Store the validity of some sections
+
+        Only rows that change are touched, and missing rows are created.
+        ``valid_section_count`` is adjusted in the database by the number of
+        sections that became valid or invalid, so concurrent saves cannot
+        lose each other's changes, then read back. With <recount>, as when
+        all sections are validated as a batch, it is counted anew instead.
+        The plan itself is not saved.
+        """
+        qs = SectionValidity.objects.filter(plan=self, section_id__in=valids | invalids)
+        current = dict(qs.values_list('section_id', 'valid'))
+        missing = [SectionValidity(plan=self, section_id=pk, valid=pk in valids)
+                   for pk in (valids | invalids) - set(current)]
+        if missing:
+            SectionValidity.objects.bulk_create(missing)
+        now_valid = [pk for pk in valids if current.get(pk) is False]
+        now_invalid = [pk for pk in invalids if current.get(pk) is True]
+        if now_valid:
+            self.set_sections_as_valid(*now_valid)
+        if now_invalid:
+            self.set_sections_as_invalid(*now_invalid)
+        if recount:
+            self.valid_section_count = self.count_valid_sections()
+            Plan.objects.filter(pk=self.pk).update(valid_section_count=self.valid_section_count)
+            return
+        delta = (len(now_valid) - len(now_invalid)
+                 + sum(1 for sv in missing if sv.valid))
+        if delta:
+            Plan.objects.filter(pk=self.pk).update(
+                valid_section_count=F('valid_section_count') + delta)
+            self.refresh_from_db(fields=['valid_section_count'])
+
+    def count_valid_sections(self):
+        "Count the valid sections of the plan that are still in its template"
+        return SectionValidity.objects.filter(
+            plan=self,
+            valid=True,
+            section__template=self.template_id,
+        ).count()
+
     def create_question_validities(self):
         qvs = []
         sections = self.template.sections.all()
@@ -272,8 +497,148 @@ class Plan(DeletionMixin, ClonableModel):
         qs = QuestionValidity.objects.filter(plan=self, question_id__in=question_pks)
         qs.update(valid=False)
 
-    def validate(self, recalculate=False, commit=True):
-        valid = self.template.validate_plan(self, recalculate)
+    @transaction.atomic
+    def save_choices(self, choices, user):
+        """Store many answers at once, then save the plan
+
+        <choices> maps question pks to choices. The plan row is locked and
+        its data reloaded first, so that concurrent saves neither lose each
+        other's answers nor collide in the answer history. Unchanged answers
+        are skipped, the others are added to the answer history. The
+        validities of the changed questions are stored with one update,
+        missing ones are created in bulk, and only their sections and the
+        super sections of those are revalidated and marked as visited.
+
+        Returns the pks of the questions whose answers changed.
+        """
+        graph = get_template_graph(self.template)
+        self.data = (Plan.objects.select_for_update()
+                     .values_list('data', flat=True)
+                     .get(pk=self.pk))
+        # IMPORTANT: json casts ints to string as keys in dicts, so use strings
+        choices = {str(pk): choice for pk, choice in choices.items()}
+        unknown = set(int(pk) for pk in choices) - graph.question_pks
+        if unknown:
+            error = 'Template {} has no questions with pks {}'
+            raise ValueError(error.format(self.template_id, sorted(unknown)))
+        changed = [pk for pk, choice in choices.items()
+                   if self.data.get(pk, {}) != choice]
+        if not changed:
+            return set()
+        for question_pk in changed:
+            self.data[question_pk] = choices[question_pk]
+        self.record_answer_revisions({pk: choices[pk] for pk in changed}, user)
+
+        questions = [graph.get_question(pk) for pk in changed]
+        valids = set(q.pk for q in questions if q.validate_data(self.data))
+        # Questions added to the template after the plan have no rows yet
+        get_or_create_validities(QuestionValidity, self, 'question_id',
+                                 (q.pk for q in questions), valids)
+        QuestionValidity.objects.filter(
+            plan=self,
+            question_id__in=[q.pk for q in questions],
+        ).update(valid=Case(
+            When(question_id__in=valids, then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField(),
+        ))
+
+        sections = {}
+        for question in questions:
+            for section in graph.get_section_and_super_sections(question.section_id):
+                sections[section.pk] = section
+        self.visited_sections.add(*sections.values())
+        valid_sections = set()
+        invalid_sections = set()
+        for section_pk in sections:
+            if graph.validate_section_data(section_pk, self.data):
+                valid_sections.add(section_pk)
+            else:
+                invalid_sections.add(section_pk)
+        self.update_section_validities(valid_sections, invalid_sections)
+
+        self.valid = (self.template.check_plan_data(self)
+                      and self.valid_section_count == len(graph.sections))
+        self.last_validated = tznow()
+        # The history has the previous answers, leave previous_data be.
+        # valid_section_count has already been adjusted in the database.
+        self.save(user=user, update_fields=[
+            'data', 'valid', 'last_validated', 'modified', 'modified_by',
+        ])
+        return set(int(pk) for pk in changed)
+
+    def record_answer_revisions(self, choices, user=None):
+        """Append <choices> to the answer history
+
+        <choices> maps question pks to choices, ``None`` for a removed
+        answer. Costs two queries however many choices there are. The plan
+        row should be locked, as ``save_choices()`` does, or concurrent
+        writers may pick the same revision number.
+        """
+        if not choices:
+            return []
+        question_pks = set(int(pk) for pk in choices)
+        latest = dict(self.answer_revisions
+                      .filter(question_id__in=question_pks)
+                      .order_by()
+                      .values_list('question_id')
+                      .annotate(latest=Max('revision')))
+        now = tznow()
+        revisions = [
+            AnswerRevision(
+                plan=self,
+                question_id=int(pk),
+                revision=latest.get(int(pk), 0) + 1,
+                choice=choice,
+                added=now,
+                added_by=user,
+            )
+            for pk, choice in choices.items()
+        ]
+        AnswerRevision.objects.bulk_create(revisions)
+        return revisions
+
+    def get_answer_history(self, question_pk):
+        "Return the revisions of the answer to a question, newest first"
+        return self.answer_revisions.filter(question_id=question_pk).order_by('-revision')
+
+    def get_previous_choice(self, question_pk):
+        "Return the last choice for a question that differs from the current one"
+        current = self.data.get(str(question_pk), None)
+        history = self.get_answer_history(question_pk).values_list('choice', flat=True)
+        for choice in history:
+            if choice is not None and choice != current:
+                return choice
+        return None
+
+    def get_data_at(self, when=None):
+        """Rebuild the answers of the plan as they were at <when>
+
+        Replays the answer history in one query. Without <when> the result
+        is the same as ``data``.
+        """
+        revisions = self.answer_revisions.order_by('question_id', 'revision')
+        if when is not None:
+            revisions = revisions.filter(added__lte=when)
+        data = {}
+        for question_pk, choice in revisions.values_list('question_id', 'choice'):
+            if choice is None:
+                data.pop(str(question_pk), None)
+            else:
+                data[str(question_pk)] = choice
+        return data
+
+    def validate(self, recalculate=False, commit=True, question=None):
+        """Set whether the plan is valid
+
+        If <question> is given, only the validity of the question and its
+        section(s) is recalculated, otherwise <recalculate> recalculates
+        everything.
+        """
+        if question is not None and not recalculate:
+            valid = self.template.validate_plan_question(self, question)
+        else:
+            valid = self.template.validate_plan(self, recalculate)
         self.valid = valid
         self.last_validated = tznow()
         if commit:
@@ -284,6 +649,8 @@ class Plan(DeletionMixin, ClonableModel):
             sv.clone(self)
         for qv in oldplan.question_validity.all():
             qv.clone(self)
+        self.valid_section_count = oldplan.valid_section_count
+        Plan.objects.filter(pk=self.pk).update(valid_section_count=self.valid_section_count)
 
     def copy_users_from(self, oldplan):
         for pa in oldplan.accesses.all():
@@ -296,6 +663,8 @@ class Plan(DeletionMixin, ClonableModel):
             super().save(**kwargs)
             self.create_section_validities()
             self.create_question_validities()
+            # Copied and cloned plans start out with answers
+            self.record_answer_revisions(self.data, self.added_by)
             self.set_adder_as_editor()
             LOG.info('Created plan "%s" (%i)', self, self.pk)
         else:
@@ -306,7 +675,7 @@ class Plan(DeletionMixin, ClonableModel):
                 if topmost:
                     self.visited_sections.add(topmost)
                 # set validated
-                self.validate(recalculate, commit=False)
+                self.validate(recalculate, commit=False, question=question)
             super().save(**kwargs)
             LOG.info('Updated plan "%s" (%i)', self, self.pk)
 
@@ -375,9 +744,34 @@ class Plan(DeletionMixin, ClonableModel):
         if not wait_to_save:
             self.save()
 
+    def get_summary_cache_key(self):
+        """Key the summary on everything it is computed from
+
+        Saving the plan bumps ``modified``, validating it bumps
+        ``last_validated`` and changing the template bumps its ``modified``,
+        so an outdated summary is never looked up.
+        """
+        stamps = (self.modified, self.last_validated, self.template.modified)
+        stamps = [stamp.isoformat() if stamp else '-' for stamp in stamps]
+        return 'easydmp-plan-summary:{}:{}'.format(self.pk, ':'.join(stamps))
+
     def get_summary(self, data=None):
-        if not data:
-            data = self.data.copy()
+        """Summarize the answers, per section
+
+        The summary of the plan's own data is cached, in the cache named by
+        the setting ``EASYDMP_SUMMARY_CACHE``.
+        """
+        if data:
+            return self._get_summary(data)
+        cache = caches[getattr(settings, 'EASYDMP_SUMMARY_CACHE', DEFAULT_CACHE_ALIAS)]
+        key = self.get_summary_cache_key()
+        summary = cache.get(key)
+        if summary is None:
+            summary = self._get_summary(self.data.copy())
+            cache.set(key, summary)
+        return summary
+
+    def _get_summary(self, data):
         valid_sections = (SectionValidity.objects
                   .filter(valid=True, plan=self)
         )
@@ -394,7 +788,7 @@ class Plan(DeletionMixin, ClonableModel):
         data = self.data.copy()
         return {
             'data': data,
-            'output': self.get_summary(data),
+            'output': self.get_summary(),
             'text': self.get_canned_text(data),
             'plan': self,
             'template': self.template,
@@ -414,6 +808,135 @@ class Plan(DeletionMixin, ClonableModel):
             self.published_by = user
             self.save()
 
+    @transaction.atomic
+    def queue_publishing(self, user, timestamp=None):
+        """Lock the plan and queue it for publishing in the background
+
+        Returns the job, or None if the plan cannot be published.
+        """
+        if not self.valid or self.published:
+            return None
+        # Serialize with other requests queueing the same plan
+        Plan.objects.select_for_update().filter(pk=self.pk).exists()
+        job = self.get_publishing_job()
+        if job:
+            return job
+        timestamp = timestamp if timestamp else tznow()
+        if not self.locked:
+            self.lock(user, timestamp)
+        job = PublishingJob.objects.create(plan=self, requested_by=user,
+                                           timestamp=timestamp)
+        LOG.info('Queued plan "%s" (%i) for publishing', self, self.pk)
+        from .publishing import start_publishing
+        transaction.on_commit(start_publishing)
+        return job
+
+    def get_publishing_job(self):
+        "Return the queued or running publishing job, if any"
+        return self.publishing_jobs.active().first()
+
+    @property
+    def is_publishing(self):
+        return self.publishing_jobs.active().exists()
+
+
+class PublishingJobQuerySet(models.QuerySet):
+
+    def queued(self):
+        return self.filter(status=PublishingJob.QUEUED)
+
+    def active(self):
+        return self.filter(status__in=(PublishingJob.QUEUED, PublishingJob.RUNNING))
+
+    def stale(self, timeout=None):
+        """Running jobs started more than <timeout> seconds ago
+
+        Their worker has most likely been killed. <timeout> defaults to the
+        setting ``EASYDMP_PUBLISHING_TIMEOUT``.
+        """
+        if timeout is None:
+            timeout = getattr(settings, 'EASYDMP_PUBLISHING_TIMEOUT', 1800)
+        cutoff = tznow() - timedelta(seconds=timeout)
+        return self.filter(status=PublishingJob.RUNNING, started__lt=cutoff)
+
+    def requeue_stale(self, timeout=None):
+        "Queue stale jobs again, return how many"
+        requeued = self.stale(timeout).update(status=PublishingJob.QUEUED,
+                                              started=None)
+        if requeued:
+            LOG.warning('Queued %i stale publishing jobs again', requeued)
+        return requeued
+
+
+class PublishingJob(models.Model):
+    """A plan waiting to be, or being, published
+
+    Publishing renders the whole plan, which is too slow to do while
+    answering a request. Jobs are run by ``easydmp.plan.publishing``.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    plan = models.ForeignKey(Plan, models.CASCADE, related_name='publishing_jobs')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES,
+                              default=QUEUED, db_index=True)
+    timestamp = models.DateTimeField(help_text='Publish as of this time')
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                     related_name='+', blank=True, null=True,
+                                     on_delete=models.SET_NULL)
+    added = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    objects = PublishingJobQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('added', 'pk')
+
+    def __str__(self):
+        return 'Publish "{}": {}'.format(self.plan, self.status)
+
+    def claim(self):
+        """Mark the job as running, return whether we got it
+
+        Safe when several workers race for the same job.
+        """
+        now = tznow()
+        jobs = PublishingJob.objects.filter(pk=self.pk, status=self.QUEUED)
+        claimed = bool(jobs.update(status=self.RUNNING, started=now))
+        if claimed:
+            self.status = self.RUNNING
+            self.started = now
+        return claimed
+
+    def run(self):
+        """Publish the plan, return whether that succeeded
+
+        The job must have been claimed.
+        """
+        plan = self.plan
+        try:
+            plan.publish(self.requested_by, self.timestamp)
+        except Exception as e:
+            LOG.exception('Publishing plan "%s" (%i) failed', plan, plan.pk)
+            self.error = repr(e)
+        else:
+            if not plan.published:
+                self.error = 'The plan is not valid'
+        self.status = self.FAILED if self.error else self.DONE
+        self.finished = tznow()
+        self.save()
+        return self.status == self.DONE
+
 
 class PlanAccess(ClonableModel):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, models.CASCADE, related_name='plan_accesses')
@@ -440,3 +963,14 @@ class PlanComment(models.Model):
     comment = models.TextField()
     added = models.DateTimeField(auto_now_add=True)
     added_by = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='plan_comments')
+
+
+def uncount_deleted_section(sender, instance, **kwargs):
+    "Keep ``valid_section_count`` of plans in step when a section goes away"
+    Plan.objects.filter(
+        section_validity__section=instance,
+        section_validity__valid=True,
+    ).update(valid_section_count=F('valid_section_count') - 1)
+
+
+pre_delete.connect(uncount_deleted_section, sender='dmpt.Section')
@@ -0,0 +1,60 @@
+"""Publish plans in the background
+
+Publishing jobs are rows of :model:`plan.PublishingJob`, so no broker is
+needed. When a plan is queued, a small thread pool in the web process starts
+draining the queue as soon as the transaction commits. The management
+command ``publish_plans`` drains it too, for cron and for tests.
+
+The size of the pool is set with ``EASYDMP_PUBLISHING_WORKERS``; with 0
+everything is left to the management command. Jobs still running after
+``EASYDMP_PUBLISHING_TIMEOUT`` seconds are presumed dead, and are queued
+again by the next worker to start.
+"""
+
+import logging
+
+from easydmp.utils.workers import WorkerPool
+
+from .models import PublishingJob
+
+
+__all__ = [
+    'run_queued_jobs',
+    'start_publishing',
+]
+
+LOG = logging.getLogger(__name__)
+
+_pool = WorkerPool('EASYDMP_PUBLISHING_WORKERS')
+
+
+def run_queued_jobs(limit=None):
+    """Run queued jobs until the queue is empty, or <limit> jobs have run
+
+    Several workers may run this at the same time. Returns the number of
+    jobs that succeeded and failed.
+    """
+    succeeded = failed = 0
+    while limit is None or succeeded + failed < limit:
+        job = PublishingJob.objects.queued().first()
+        if job is None:
+            break
+        if not job.claim():
+            # Another worker got there first
+            continue
+        if job.run():
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
+
+
+def _drain_queue():
+    # Jobs left running by a killed worker would never finish
+    PublishingJob.objects.requeue_stale()
+    run_queued_jobs()
+
+
+def start_publishing():
+    "Have the worker pool drain the queue"
+    _pool.submit(_drain_queue)
@@ -1,13 +1,15 @@
 from itertools import chain
-from copy import deepcopy
 import logging
 
 from django.contrib import messages
 from django.contrib.auth.mixins import UserPassesTestMixin
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.db import IntegrityError
+from django.db.models import BooleanField, Exists, OuterRef, Subquery
 from django.http import HttpResponseRedirect, Http404, HttpResponseServerError
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.template.loader import get_template
 from django.views.generic.edit import FormMixin
 from django.views.generic import (
     CreateView,
@@ -17,10 +19,13 @@ from django.views.generic import (
     DeleteView,
     RedirectView,
 )
+from django.utils.decorators import method_decorator
 from django.utils.html import mark_safe
 
 from easydmp.utils import pprint_list, utc_epoch
+from easydmp.utils.instrumentation import query_budget
 from easydmp.dmpt.forms import make_form, TemplateForm, NotesForm
+from easydmp.dmpt.graph import get_template_graph
 from easydmp.dmpt.models import Template, Question, Section
 from easydmp.invitation.models import PlanInvitation
 from flow.models import FSA
@@ -49,24 +54,58 @@ def progress(so_far, all):
     return so_far/float(all)*100
 
 
-def has_prevquestion(question, data):
-     return bool(question.get_prev_question(data))
+def has_prevquestion(graph, question, data):
+    return bool(graph.get_prev_question(question, data))
 
 
 def get_section_progress(plan, current_section=None):
-    sections = plan.template.sections.filter(section_depth=1).order_by('position')
-    visited_sections = plan.visited_sections.all()
+    """Describe the progress through the top level sections of a plan
+
+    For each section: whether it is new, visited or the active one, whether
+    it is valid, and how many of the questions in it and below it are
+    answered. Costs one query, given that ``plan.template`` is loaded.
+    """
+    graph = get_template_graph(plan.template)
+    sections = graph.get_top_sections()
+    visited = Plan.visited_sections.through.objects.filter(
+        plan_id=plan.pk,
+        section_id=OuterRef('pk'),
+    )
+    validity = SectionValidity.objects.filter(
+        plan_id=plan.pk,
+        section_id=OuterRef('pk'),
+    ).values('valid')[:1]
+    statuses = (Section.objects
+        .filter(pk__in=[section.pk for section in sections])
+        .annotate(
+            visited=Exists(visited),
+            valid=Subquery(validity, output_field=BooleanField()),
+        )
+        .values_list('pk', 'visited', 'valid')
+    )
+    statuses = {pk: (visited, valid) for pk, visited, valid in statuses}
+    data = plan.data or {}
     section_struct = []
-    current_section = current_section.get_topmost_section()
+    if current_section is not None:
+        current_section = graph.get_topmost_section(current_section.pk)
     for section in sections:
+        visited, valid = statuses.get(section.pk, (False, None))
+        questions = [question.pk
+                     for subsection in graph.get_section_and_sub_sections(section.pk)
+                     for question in graph.get_questions_in_section(subsection.pk)]
+        answered = sum(1 for pk in questions if str(pk) in data)
         section_dict = {
             'label': section.label,
             'title': section.title,
             'full_title': section.full_title(),
             'pk': section.pk,
             'status': 'new',
+            'valid': bool(valid),
+            'questions': len(questions),
+            'answered': answered,
+            'percent_answered': int(progress(answered, len(questions))) if questions else 100,
         }
-        if section in visited_sections:
+        if visited:
             section_dict['status'] = 'visited'
         if section == current_section:
             section_dict['status'] = 'active'
@@ -395,7 +434,8 @@ class LockPlanView(PlanAccessViewMixin, UpdateView):
 class PublishPlanView(PlanAccessViewMixin, UpdateView):
     """Publish a plan
 
-    This makes it read only and undeletable.
+    This makes it read only and undeletable. The plan is locked at once and
+    the html is generated in the background.
     """
 
     template_name = 'easydmp/plan/plan_confirm_publish.html'
@@ -413,7 +453,8 @@ class PublishPlanView(PlanAccessViewMixin, UpdateView):
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
         success_url = self.get_success_url()
-        self.object.publish(request.user)
+        if self.object.queue_publishing(request.user):
+            messages.info(request, 'The plan is being published, this may take a little while.')
         return HttpResponseRedirect(success_url)
 
 
@@ -443,6 +484,7 @@ class CreateNewVersionPlanView(PlanAccessViewMixin, UpdateView):
         return HttpResponseRedirect(success_url)
 
 
+@method_decorator(query_budget(40), name='dispatch')
 class UpdateLinearSectionView(PlanAccessViewMixin, DetailView):
     template_name = 'easydmp/plan/plan_section_update.html'
     model = Plan
@@ -453,20 +495,12 @@ class UpdateLinearSectionView(PlanAccessViewMixin, DetailView):
         self.section_pk = kwargs['section']
         # Check that the section is not branching
         try:
-            self.section = (
-                Section.objects
-                    .prefetch_related('questions')
-                    .get(branching=False, pk=self.section_pk)
-            )
+            self.section = Section.objects.get(branching=False, pk=self.section_pk)
         except Section.DoesNotExist:
             raise Http404(error_message_404)
-        self.questions = (
-            self.section.questions
-            .filter(obligatory=True)
-            .order_by('position')
-        )
+        self.questions = list(self.section.questions.typed().order_by('position'))
         # Check that all questions are obligatory
-        if self.section.questions.count() != self.questions.count():
+        if not all(question.obligatory for question in self.questions):
             # Not a linear section
             raise Http404(error_message_404)
         self.prev_section = self.section.get_prev_section()
@@ -475,7 +509,7 @@ class UpdateLinearSectionView(PlanAccessViewMixin, DetailView):
         self.plan_pk = kwargs[self.pk_url_kwarg]
         self.plan = self.get_object()
         self.object = self.plan
-        self.answers = [Answer(question, self.plan) for question in self.questions]
+        self.answers = Answer.for_questions(self.questions, self.plan)
         return super().dispatch(request, *args, **kwargs)
 
     def get_success_url(self):
@@ -508,7 +542,7 @@ class UpdateLinearSectionView(PlanAccessViewMixin, DetailView):
             return self.forms_invalid(forms)
 
     def forms_valid(self, forms):
-        prev_data = deepcopy(self.plan.data)
+        choices = {}
         for question in forms:
             form = question['form']
             notesform = question['notesform']
@@ -516,14 +550,9 @@ class UpdateLinearSectionView(PlanAccessViewMixin, DetailView):
             notes = notesform.cleaned_data.get('notes', '')
             choice = form.serialize()
             choice['notes'] = notes
-            answer = question['answer']
-            if answer.current_choice != choice:
-                qid = str(answer.question_id)
-                self.plan.previous_data[qid] = answer.current_choice
-                self.plan.data[qid] = choice
-        if prev_data != self.plan.data:
-            self.plan.modified_by = self.request.user
-            self.plan.save()
+            choices[question['answer'].question_id] = choice
+        # Only saves, and revalidates, if anything changed
+        self.plan.save_choices(choices, self.request.user)
         return HttpResponseRedirect(self.get_success_url())
 
     def forms_invalid(self, forms):
@@ -562,7 +591,8 @@ class UpdateLinearSectionView(PlanAccessViewMixin, DetailView):
         context['prev_section'] = self.prev_section
         context['next_section'] = self.next_section
         context['section_progress'] = get_section_progress(self.plan, self.section)
-        context['forms'] = self.get_forms()
+        if 'forms' not in context:
+            context['forms'] = self.get_forms()
         return context
 
     def put(self, *args, **kwargs):
@@ -600,12 +630,12 @@ class AbstractQuestionMixin(PlanAccessViewMixin):
         try:
             sections = self.template.sections.all()
             question = (Question.objects
+                .typed()
                 .select_related('section')
                 .get(pk=question_pk, section__in=sections)
             )
         except Question.DoesNotExist as e:
             raise ValueError("Unknown question id: {}".format(question_pk))
-        question = question.get_instance()
         return question
 
     def get_plan_pk(self):
@@ -618,6 +648,7 @@ class AbstractQuestionMixin(PlanAccessViewMixin):
         return self.template
 
 
+@method_decorator(query_budget(30), name='dispatch')
 class NewQuestionView(AbstractQuestionMixin, UpdateView):
     "Answer a Question"
 
@@ -645,24 +676,24 @@ class NewQuestionView(AbstractQuestionMixin, UpdateView):
 
     def get_initial(self):
         current_data = self.object.data or {}
-        previous_data = self.object.previous_data or {}
         initial = current_data.get(self.question_pk, {})
         if not initial:
-            initial = previous_data.get(self.question_pk, {})
+            initial = self.object.get_previous_choice(self.question_pk) or {}
         return initial
 
     def get_success_url(self):
         question = self.question
         current_data = self.object.data
+        graph = get_template_graph(self.template)
         kwargs = {'plan': self.object.pk}
 
         if 'summary' in self.request.POST:
             return reverse('plan_detail', kwargs=kwargs)
         elif 'prev' in self.request.POST:
-            prev_question = question.get_prev_question(self.object.data)
+            prev_question = graph.get_prev_question(question, current_data)
             kwargs['question'] = prev_question.pk
         elif 'next' in self.request.POST:
-            next_question = question.get_next_question(current_data)
+            next_question = graph.get_next_question(question, current_data)
             if not next_question:
                 # Finished answering all questions
                 return reverse('plan_detail', kwargs=kwargs)
@@ -706,8 +737,9 @@ class NewQuestionView(AbstractQuestionMixin, UpdateView):
     def get_form(self, **_):
         form_kwargs = self.get_form_kwargs()
         question = self.question
+        graph = get_template_graph(self.template)
         generate_kwargs = {
-            'has_prevquestion': has_prevquestion(question, self.object.data),
+            'has_prevquestion': has_prevquestion(graph, question, self.object.data),
         }
         generate_kwargs.update(form_kwargs)
         form = make_form(question, **generate_kwargs)
@@ -839,17 +871,56 @@ class AbstractGeneratedPlanView(DetailView):
         return super().get_context_data(**context)
 
 
-class GeneratedPlanHTMLView(AbstractGeneratedPlanView):
+class StreamingGeneratedPlanMixin:
+    """Stream the generated plan section by section when asked to
+
+    Add "?stream" to the url. The response starts before the canned text of
+    later sections has been generated, and only one section is held in
+    memory at a time.
+
+    The sections are generated after the view has returned, so their
+    queries are not counted by ``InstrumentationMiddleware``, nor against
+    any query budget.
+    """
+    head_template_name = None
+    section_template_name = None
+    foot_template_name = None
+
+    def get(self, request, *args, **kwargs):
+        if 'stream' not in request.GET:
+            return super().get(request, *args, **kwargs)
+        self.object = self.get_object()
+        return StreamingHttpResponse(self.stream(), content_type=self.content_type)
+
+    def stream(self):
+        plan = self.object
+        request = self.request
+        context = {'plan': plan, 'template': plan.template}
+        if self.head_template_name:
+            yield get_template(self.head_template_name).render(context, request=request)
+        section_template = get_template(self.section_template_name)
+        for section in plan.template.iter_canned_text(plan.data):
+            context['section'] = section
+            yield section_template.render(context, request=request)
+        if self.foot_template_name:
+            yield get_template(self.foot_template_name).render(context, request=request)
+
+
+class GeneratedPlanHTMLView(StreamingGeneratedPlanMixin, AbstractGeneratedPlanView):
     "Generate canned HTML of a plan"
 
     template_name = 'easydmp/plan/generated_plan.html'
+    head_template_name = 'easydmp/plan/_generated_plan_head.html'
+    section_template_name = 'easydmp/plan/_generated_plan_section.html'
+    foot_template_name = 'easydmp/plan/_generated_plan_foot.html'
 
 
 # XXX: Remove
-class GeneratedPlanPlainTextView(AbstractGeneratedPlanView):
+class GeneratedPlanPlainTextView(StreamingGeneratedPlanMixin, AbstractGeneratedPlanView):
     "Generate canned plaintext of a Plan"
 
     template_name = 'easydmp/plan/generated_plan.txt'
+    section_template_name = 'easydmp/plan/_generated_plan_section.txt'
     content_type = 'text/plain; charset=UTF-8'
 
 
@@ -861,6 +932,7 @@ class GeneratedPlanPDFView(AbstractGeneratedPlanView):
     content_type = 'text/plain'
 
 
+@method_decorator(query_budget(30), name='dispatch')
 class SectionDetailView(DetailView):
     """Show a section
 
@@ -67,6 +67,7 @@ INSTALLED_APPS = [
 SITE_ID = 1 # For flatpages
 
 MIDDLEWARE = [
+    'easydmp.utils.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -275,3 +276,16 @@ PUBLIC_URLS = ('/api/', '/psa/', '/admin/login/')
 
 EASYDMP_INVITATION_FROM_ADDRESS = getenv('EASYDMP_INVITATION_FROM_ADDRESS', None)
 assert EASYDMP_INVITATION_FROM_ADDRESS, 'Env "EASYDMP_INVITATION_FROM_ADDRESS" not set'
+
+# Server-Timing headers and a log line with query counts per request
+EASYDMP_INSTRUMENTATION = bool(getenv('EASYDMP_INSTRUMENTATION', ''))
+# Raise instead of log when a view runs more queries than its budget
+EASYDMP_QUERY_BUDGET_ENFORCE = False
+# Which of CACHES to store plan summaries in
+EASYDMP_SUMMARY_CACHE = getenv('EASYDMP_SUMMARY_CACHE', 'default')
+# Threads per web process publishing plans, 0 leaves it to "publish_plans"
+EASYDMP_PUBLISHING_WORKERS = int(getenv('EASYDMP_PUBLISHING_WORKERS', '1'))
+# Seconds before a running publishing job is presumed dead and queued again
+EASYDMP_PUBLISHING_TIMEOUT = int(getenv('EASYDMP_PUBLISHING_TIMEOUT', '1800'))
+# Threads per web process rendering section graphs, 0 leaves it to "cache_graphs"
+EASYDMP_GRAPH_RENDER_WORKERS = int(getenv('EASYDMP_GRAPH_RENDER_WORKERS', '1'))
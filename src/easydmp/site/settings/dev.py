@@ -3,6 +3,7 @@ from .base import *
 DEBUG = True
 INTERNAL_IPS = ['127.0.0.1']
 TEMPLATES[0]['OPTIONS']['debug'] = DEBUG
+EASYDMP_INSTRUMENTATION = True
 
 SECRET_KEY = '=%rr$)2d&hl)#u0kgfgt**%-xmz!#r#1-#px-=nwu)j&2#a-2m'
 
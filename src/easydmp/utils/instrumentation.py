@@ -0,0 +1,180 @@
+"""Per-request instrumentation of views
+
+``InstrumentationMiddleware`` records, per request, the number of queries,
+the time spent in the database, which queries were run more than once, and
+how long it took to render templates. The numbers are sent back in a
+``Server-Timing`` header and logged as a single line to the
+``easydmp.utils.instrumentation`` logger. Turn it on with the setting
+``EASYDMP_INSTRUMENTATION``. The content of streaming responses is
+generated after the middleware is done, so it is not measured.
+
+The ``query_budget`` decorator declares how many queries a view may run,
+counted from when the view is called until its response has been rendered.
+The middleware does the counting, so budgets are only checked when it is
+turned on. Overspending is logged, or raises ``QueryBudgetExceeded`` if the
+setting ``EASYDMP_QUERY_BUDGET_ENFORCE`` is true, as it is when testing.
+
+Queries are captured through the debug cursor, the same one that feeds the
+``django.db.backends`` logger and thereby ``easydmp.utils.log.SQLFilter``.
+"""
+
+from collections import Counter
+import functools
+import logging
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from .log import fingerprint_sql
+
+
+__all__ = [
+    'InstrumentationMiddleware',
+    'QueryBudgetExceeded',
+    'QueryRecorder',
+    'query_budget',
+]
+
+LOG = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryRecorder:
+    """Context manager recording the queries run on the default database
+
+    While recording, the connection logs to ``queries`` instead of its own
+    log, which only holds the latest few thousand queries. The queries are
+    added to the connection's log afterwards, so recorders can be nested.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __enter__(self):
+        self._force_debug_cursor = connection.force_debug_cursor
+        self._queries_log = connection.queries_log
+        connection.force_debug_cursor = True
+        connection.queries_log = self.queries
+        return self
+
+    def __exit__(self, *exc_info):
+        connection.queries_log = self._queries_log
+        connection.queries_log.extend(self.queries)
+        connection.force_debug_cursor = self._force_debug_cursor
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        "Time spent in the database, in seconds"
+        return sum(float(query['time']) for query in self.queries)
+
+    def get_duplicates(self):
+        "Return (fingerprint, count) of queries run more than once, most common first"
+        return find_duplicates(self.queries)
+
+
+def find_duplicates(queries):
+    "Return (fingerprint, count) of <queries> run more than once, most common first"
+    fingerprints = Counter(fingerprint_sql(query['sql']) for query in queries)
+    return [(fp, count) for fp, count in fingerprints.most_common() if count > 1]
+
+
+def query_budget(max_queries):
+    """Declare that a view may run at most <max_queries> queries
+
+    The queries of rendering the response count too, since that is where
+    lazy querysets are evaluated. ``InstrumentationMiddleware`` checks the
+    budget once the response is rendered. For class based views, decorate
+    ``dispatch`` with ``method_decorator``.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            recorder = getattr(request, 'query_recorder', None)
+            if recorder is not None:
+                request.query_budget = (view.__qualname__, max_queries, recorder.count)
+            return view(request, *args, **kwargs)
+        wrapped.query_budget = max_queries
+        return wrapped
+    return decorator
+
+
+def _check_query_budget(view_name, max_queries, queries):
+    if len(queries) <= max_queries:
+        return
+    error = 'View {} ran {} queries, the budget is {}. Most duplicated: {}'
+    error = error.format(view_name, len(queries), max_queries, find_duplicates(queries)[:3])
+    if getattr(settings, 'EASYDMP_QUERY_BUDGET_ENFORCE', False):
+        raise QueryBudgetExceeded(error)
+    LOG.warning(error)
+
+
+def format_server_timing(metrics):
+    timings = (
+        'db;dur={:.1f};desc="{} queries"'.format(metrics['db'] * 1000, metrics['queries']),
+        'dup;desc="{} duplicated"'.format(metrics['duplicates']),
+        'render;dur={:.1f}'.format(metrics['render'] * 1000),
+        'total;dur={:.1f}'.format(metrics['total'] * 1000),
+    )
+    return ', '.join(timings)
+
+
+class InstrumentationMiddleware:
+    """Record queries and timings per request
+
+    Put it first in ``MIDDLEWARE`` so that the queries of the other
+    middleware are counted too.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'EASYDMP_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.instrumentation = metrics = {'render': 0.0}
+        start = time.perf_counter()
+        with QueryRecorder() as recorder:
+            request.query_recorder = recorder
+            response = self.get_response(request)
+        # By now even template responses are rendered
+        budget = getattr(request, 'query_budget', None)
+        if budget is not None:
+            view_name, max_queries, start = budget
+            _check_query_budget(view_name, max_queries, recorder.queries[start:])
+        duplicates = recorder.get_duplicates()
+        metrics.update(
+            queries=recorder.count,
+            db=recorder.time,
+            duplicates=sum(count - 1 for _, count in duplicates),
+            total=time.perf_counter() - start,
+        )
+        response['Server-Timing'] = format_server_timing(metrics)
+
+        view_name = getattr(request.resolver_match, 'view_name', None)
+        LOG.info('view=%s method=%s path=%s status=%s queries=%i duplicates=%i '
+                 'db_ms=%.1f render_ms=%.1f total_ms=%.1f',
+                 view_name, request.method, request.path, response.status_code,
+                 metrics['queries'], metrics['duplicates'], metrics['db'] * 1000,
+                 metrics['render'] * 1000, metrics['total'] * 1000,
+                 extra={'instrumentation': metrics, 'view_name': view_name})
+        for fingerprint, count in duplicates:
+            LOG.debug('view=%s duplicated=%i sql=%s', view_name, count, fingerprint)
+        return response
+
+    def process_template_response(self, request, response):
+        start = time.perf_counter()
+
+        def stop(response):
+            request.instrumentation['render'] += time.perf_counter() - start
+
+        response.add_post_render_callback(stop)
+        return response
@@ -1,4 +1,5 @@
 import logging
+import re
 
 
 class SQLFilter(logging.Filter):
@@ -12,3 +13,18 @@ class SQLFilter(logging.Filter):
             if msg in self.keywords:
                 return False
         return True
+
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def fingerprint_sql(sql):
+    """Reduce <sql> to its shape
+
+    Literals are replaced by "?" and lists of literals by "(...)", so that
+    the same query with different parameters gets the same fingerprint.
+    """
+    sql = _SQL_LITERALS.sub('?', sql)
+    sql = _SQL_LISTS.sub('(...)', sql)
+    return ' '.join(sql.split())
@@ -0,0 +1,79 @@
+"""Run work in the background or in parallel
+
+``WorkerPool`` is for slow work after a request has been answered, like
+publishing plans and rendering graphs, in threads of the web process.
+``process_pool()`` is for management commands that spread their work over
+several processes.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from multiprocessing import Pool
+import threading
+
+import django
+from django.conf import settings
+from django.db import connection, connections
+
+
+__all__ = [
+    'WorkerPool',
+    'process_pool',
+]
+
+LOG = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """A thread pool sized by the setting <setting_name>
+
+    The threads are not started before something is submitted. If the
+    setting is missing or 0 there is no pool, and nothing is run.
+    """
+
+    def __init__(self, setting_name):
+        self.setting_name = setting_name
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return getattr(settings, self.setting_name, 0)
+
+    def submit(self, fn, *args):
+        """Have a thread of the pool call <fn> with <args>
+
+        Returns whether there is a pool to run it.
+        """
+        if not self.size:
+            return False
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.size)
+        self._executor.submit(self._run, fn, *args)
+        return True
+
+    @staticmethod
+    def _run(fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            LOG.exception('Worker crashed running %r', fn)
+        finally:
+            # Threads get their own connection, don't leave it dangling
+            connection.close()
+
+
+def _init_process():
+    # Only needed when the pool spawns rather than forks
+    django.setup()
+
+
+def process_pool(processes):
+    """Return a multiprocessing pool of <processes> with Django set up
+
+    The connections of this process are closed first, so that forked
+    children do not share them. Use it as a context manager.
+    """
+    connections.close_all()
+    return Pool(processes, initializer=_init_process)
@@ -0,0 +1,137 @@
+"""Copy FSAs, nodes and edges in a fixed number of queries
+
+``clone_fsas()`` copies any number of FSAs at once: one ``bulk_create``
+for the FSAs, one for the nodes, a single update for ``Node.depends`` and
+one ``bulk_create`` for the edges. It returns maps from old to new primary
+keys, so that callers cloning more, like whole templates, can hook their
+own copies up to the new nodes and edges.
+
+``bulk_create`` skips ``save()`` and signals. The new FSAs get a fresh
+``modified`` timestamp, so no stale transition tables can be cached for them.
+"""
+
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now as utcnow
+
+from easydmp.lib.models import bulk_create_with_pks, update_fk_by_pk
+
+
+__all__ = [
+    'ClonedFSA',
+    'clone_fsas',
+]
+
+
+ClonedFSA = namedtuple('ClonedFSA', ['fsa', 'nodes', 'edges'])
+ClonedFSA.__doc__ = """The copy of an FSA
+
+nodes, edges: dicts from the pks of the original's nodes and edges to the
+pks of the copies
+"""
+
+
+def _map_reused_fsa(fsa, reused, nodes, edges):
+    "Map the nodes and edges of <fsa> to those of <reused> by slug and condition"
+    by_slug = {node.slug: node.pk for node in nodes if node.fsa_id == reused.pk}
+    node_map = {node.pk: by_slug[node.slug] for node in nodes
+                if node.fsa_id == fsa.pk and node.slug in by_slug}
+    by_condition = {(edge.prev_node_id, edge.condition): edge.pk for edge in edges}
+    edge_map = {}
+    for edge in edges:
+        new_prev_pk = node_map.get(edge.prev_node_id, None)
+        if new_prev_pk and (new_prev_pk, edge.condition) in by_condition:
+            edge_map[edge.pk] = by_condition[(new_prev_pk, edge.condition)]
+    return ClonedFSA(reused, node_map, edge_map)
+
+
+@transaction.atomic
+def clone_fsas(fsas_and_slugs):
+    """Clone each FSA in <fsas_and_slugs>, a sequence of (fsa, new slug)
+
+    The same FSA may be cloned several times, under different slugs. If an
+    FSA with the new slug already exists it is reused as is, like
+    ``FSA.clone()`` always did. Returns a list of ``ClonedFSA``, in the same
+    order as <fsas_and_slugs>.
+    """
+    from .models import FSA, Node, Edge
+
+    fsas_and_slugs = list(fsas_and_slugs)
+    if not fsas_and_slugs:
+        return []
+    sources = {}
+    for fsa, slug in fsas_and_slugs:
+        if sources.setdefault(slug, fsa.pk) != fsa.pk:
+            raise ValueError('Cannot clone different FSAs to the same slug "{}"'.format(slug))
+    now = utcnow()
+
+    slugs = [slug for _, slug in fsas_and_slugs]
+    existing = {fsa.slug: fsa for fsa in FSA.objects.filter(slug__in=slugs)}
+    new_fsas = {}
+    for fsa, slug in fsas_and_slugs:
+        if slug not in existing and slug not in new_fsas:
+            new_fsas[slug] = FSA(slug=slug, cloned_from=fsa, cloned_when=now)
+    bulk_create_with_pks(FSA, new_fsas.values(), ['slug'])
+
+    old_fsa_pks = set(fsa.pk for fsa, _ in fsas_and_slugs)
+    reused_fsa_pks = set(fsa.pk for fsa in existing.values())
+    fsa_pks = old_fsa_pks | reused_fsa_pks
+    nodes = list(Node.objects.filter(fsa_id__in=fsa_pks).order_by('pk'))
+    edges = list(Edge.objects
+                 .filter(Q(prev_node__fsa_id__in=fsa_pks) | Q(next_node__fsa_id__in=fsa_pks))
+                 .distinct()
+                 .order_by('pk'))
+
+    old_nodes = {}
+    for node in nodes:
+        old_nodes.setdefault(node.fsa_id, []).append(node)
+    new_nodes = {}  # slug: {old node pk: new node}
+    for fsa, slug in fsas_and_slugs:
+        if slug not in new_fsas or slug in new_nodes:
+            continue
+        new_nodes[slug] = {
+            node.pk: Node(fsa=new_fsas[slug], slug=node.slug, start=node.start,
+                          end=node.end, cloned_from=node, cloned_when=now)
+            for node in old_nodes.get(fsa.pk, ())
+        }
+    bulk_create_with_pks(Node, [node for nodes_ in new_nodes.values()
+                                for node in nodes_.values()], ['fsa', 'slug'])
+
+    node_maps = {slug: {old_pk: node.pk for old_pk, node in nodes_.items()}
+                 for slug, nodes_ in new_nodes.items()}
+    depends = {}
+    for fsa, slug in fsas_and_slugs:
+        node_map = node_maps.get(slug, {})
+        for node in old_nodes.get(fsa.pk, ()):
+            if node.depends_id in node_map:
+                depends[node_map[node.pk]] = node_map[node.depends_id]
+    update_fk_by_pk(Node, 'depends', depends)
+
+    new_edges = {}  # slug: {old edge pk: new edge}
+    for fsa, slug in fsas_and_slugs:
+        if slug not in node_maps or slug in new_edges:
+            continue
+        node_map = node_maps[slug]
+        new_edges[slug] = {
+            edge.pk: Edge(condition=edge.condition,
+                          prev_node_id=node_map.get(edge.prev_node_id, None),
+                          next_node_id=node_map.get(edge.next_node_id, None),
+                          cloned_from=edge, cloned_when=now)
+            for edge in edges
+            if edge.prev_node_id in node_map or edge.next_node_id in node_map
+        }
+    # The same edge is only ever copied between different new nodes
+    bulk_create_with_pks(Edge, [edge for edges_ in new_edges.values()
+                                for edge in edges_.values()],
+                         ['cloned_from', 'prev_node', 'next_node'])
+
+    cloned = []
+    for fsa, slug in fsas_and_slugs:
+        if slug in existing:
+            cloned.append(_map_reused_fsa(fsa, existing[slug], nodes, edges))
+            continue
+        edge_map = {old_pk: edge.pk for old_pk, edge in new_edges[slug].items()}
+        cloned.append(ClonedFSA(new_fsas[slug], node_maps[slug], edge_map))
+    return cloned
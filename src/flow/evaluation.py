@@ -0,0 +1,107 @@
+"""Find the paths many sets of data take through an FSA
+
+Walking an FSA with ``FSA.nextnode()`` decides one step for one set of data
+at a time. A ``PathEvaluator`` turns the transition table of an FSA into a
+rule per node, then moves whole groups of data sets along at once: all data
+sets at a node either share the next node, or are split by the condition
+they have for the node the branch depends on.
+
+The data sets are in the format used by ``FSA.nextnode()``: a dict of node
+slug to condition.
+"""
+
+from collections import namedtuple
+from itertools import islice
+
+
+__all__ = [
+    'EvaluatedPath',
+    'PathEvaluator',
+]
+
+
+EvaluatedPath = namedtuple('EvaluatedPath', ['key', 'nodes', 'complete'])
+EvaluatedPath.__doc__ = """The path taken by one set of data
+
+key: identifies the data set, as passed in
+nodes: the slugs of the nodes visited, in order
+complete: whether the path reached an end. If not, the data lacked the
+    condition for a branch, or had one no edge matches
+"""
+
+_END = object()
+_STUCK = object()
+
+
+class PathEvaluator:
+    "Find the paths taken through the FSA described by a ``TransitionTable``"
+
+    def __init__(self, table):
+        self.start_pk = table.get_startnode().pk
+        self.slugs = {pk: node.slug for pk, node in table.nodes.items()}
+        self.max_length = len(table.nodes)
+        # node pk -> next node pk, _END, or (depends slug, {condition: next})
+        self.rules = {}
+        for pk, node in table.nodes.items():
+            edges = table.next_edges.get(pk, ())
+            next_pks = set(next_pk for _, next_pk in edges)
+            if node.end or not next_pks or next_pks == {None}:
+                self.rules[pk] = _END
+            elif len(next_pks) == 1:
+                self.rules[pk] = next_pks.pop()
+            else:
+                depends = table.nodes[node.depends_id] if node.depends_id else node
+                branches = {}
+                for condition, next_pk in edges:
+                    branches.setdefault(condition, _END if next_pk is None else next_pk)
+                self.rules[pk] = (str(depends.slug), branches)
+
+    def _step(self, rule, data):
+        if not isinstance(rule, tuple):
+            return rule
+        depends, branches = rule
+        if depends not in data:
+            return _STUCK
+        return branches.get(data[depends], _STUCK)
+
+    def evaluate_chunk(self, items):
+        """Find the path of every (key, data) in <items>
+
+        Returns a list of ``EvaluatedPath``, in the same order as <items>.
+        """
+        items = list(items)
+        paths = [[] for _ in items]
+        complete = [False] * len(items)
+        at = {self.start_pk: list(range(len(items)))}
+        for _ in range(self.max_length):
+            if not at:
+                break
+            next_at = {}
+            for pk, members in at.items():
+                slug = self.slugs[pk]
+                rule = self.rules[pk]
+                for i in members:
+                    paths[i].append(slug)
+                    next_pk = self._step(rule, items[i][1])
+                    if next_pk is _END:
+                        complete[i] = True
+                    elif next_pk is not _STUCK:
+                        next_at.setdefault(next_pk, []).append(i)
+            at = next_at
+        # Anything still walking after visiting as many nodes as there are
+        # is going round in a loop, and is left incomplete
+        return [EvaluatedPath(key, path, done)
+                for (key, _), path, done in zip(items, paths, complete)]
+
+    def evaluate(self, items, chunk_size=1000):
+        """Generate the ``EvaluatedPath`` of every (key, data) in <items>
+
+        <items> is consumed <chunk_size> at a time, so it may be a lazy
+        iterator over more data than fits in memory.
+        """
+        items = iter(items)
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                return
+            yield from self.evaluate_chunk(chunk)
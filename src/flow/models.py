@@ -1,24 +1,217 @@
 # encoding: utf-8
 
+from collections import deque
 from functools import lru_cache
 from uuid import uuid4
 
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
 from django.db import models
-from django.db import transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils.timezone import now as utcnow
 
 import graphviz as gv
 
 from .errors import FSANoStartnodeError
 from .errors import FSANoDataError
 from easydmp.lib.graphviz import _prep_dotsource, view_dotsource, render_dotsource_to_file
+from .cloning import clone_fsas
+from .evaluation import PathEvaluator
 from .modelmixins import ClonableModel
+from .paths import PathAnalysis
 
 
 SLUG_LENGTH = 40
 
 
+class TransitionTable:
+    """Compiled, read only view of the nodes and edges of an FSA
+
+    Node.get_next_node() and friends walk the edges through the ORM, costing
+    a query per edge. The table holds all nodes of the FSA by pk and slug,
+    and the edges as lists of (condition, pk) per node, in both directions.
+
+    The table also holds a ``PathAnalysis`` of the FSA, in ``paths``.
+
+    Build with ``TransitionTable.compile()``, or better, fetch a cached copy
+    with ``get_transition_table()``.
+    """
+
+    def __init__(self, nodes, edges):
+        self.nodes = {node.pk: node for node in nodes}
+        self.slugs = {node.slug: node.pk for node in nodes}
+        self.next_edges = {}
+        self.prev_edges = {}
+        for condition, prev_pk, next_pk in edges:
+            if prev_pk is not None:
+                self.next_edges.setdefault(prev_pk, []).append((condition, next_pk))
+            if next_pk is not None:
+                self.prev_edges.setdefault(next_pk, []).append((condition, prev_pk))
+
+    @classmethod
+    def compile(cls, fsa_pk):
+        "Build the table of the FSA with pk <fsa_pk>, in two or three queries"
+        nodes = list(Node.objects.filter(fsa_id=fsa_pk).order_by('pk'))
+        node_pks = set(node.pk for node in nodes)
+        edges = list(
+            Edge.objects
+            .filter(Q(prev_node__fsa_id=fsa_pk) | Q(next_node__fsa_id=fsa_pk))
+            .distinct()
+            .order_by('pk')
+            .values_list('condition', 'prev_node_id', 'next_node_id')
+        )
+        # Edges may lead out of the FSA
+        foreign_pks = set(pk for _, prev_pk, next_pk in edges for pk in (prev_pk, next_pk))
+        foreign_pks -= node_pks
+        foreign_pks.discard(None)
+        if foreign_pks:
+            nodes.extend(Node.objects.filter(pk__in=foreign_pks))
+        table = cls(nodes, edges)
+        table.fsa_pk = fsa_pk
+        table.paths = table.analyze_paths()
+        return table
+
+    def get_graph(self):
+        "Return the slugs of the next nodes per node, ``None`` for no node"
+        graph = {}
+        for node in self.get_nodemap().values():
+            nexts = self.next_edges.get(node.pk, ())
+            graph[node.slug] = list(set(self.nodes[pk].slug if pk else None
+                                        for _, pk in nexts))
+        return graph
+
+    def analyze_paths(self):
+        nodes = self.get_nodemap().values()
+        starts = [node.slug for node in nodes if node.start]
+        ends = [node.slug for node in nodes if node.end]
+        return PathAnalysis(self.get_graph(), starts[0] if starts else None, ends)
+
+    def get_node(self, slug):
+        return self.nodes[self.slugs[slug]]
+
+    def get_startnode(self):
+        for node in self.nodes.values():
+            if node.start and node.fsa_id == self.fsa_pk:
+                return node
+        raise FSANoStartnodeError()
+
+    def get_nodemap(self):
+        return {node.slug: node for node in self.nodes.values()
+                if node.fsa_id == self.fsa_pk}
+
+    def _get(self, pk):
+        return self.nodes[pk] if pk is not None else None
+
+    def get_maximal_previous_nodes(self, node_pk):
+        "Walk the edges backwards from <node_pk>, stopping at start-nodes"
+        found = set()
+        visited = {node_pk}
+        queue = deque([node_pk])
+        while queue:
+            pk = queue.popleft()
+            for _, prev_pk in self.prev_edges.get(pk, ()):
+                if prev_pk is None:
+                    continue
+                found.add(prev_pk)
+                if prev_pk in visited or self.nodes[prev_pk].start:
+                    continue
+                visited.add(prev_pk)
+                queue.append(prev_pk)
+        return [self.nodes[pk] for pk in found]
+
+    def get_next_node(self, node_pk, data):
+        "Same as ``Node.get_next_node()`` used to be"
+        if not data:
+            raise FSANoDataError
+        edges = self.next_edges.get(node_pk, ())
+        next_nodes = set(next_pk for _, next_pk in edges)
+        if len(next_nodes) == 1:  # simple node
+            return self._get(next_nodes.pop())
+        if len(next_nodes) > 1:  # complex node
+            node = self.nodes[node_pk]
+            depends = self.nodes[node.depends_id] if node.depends_id else node
+            condition = data[str(depends.slug)]
+            for edge_condition, next_pk in edges:
+                if edge_condition == condition:
+                    return self._get(next_pk)
+        # end node or overridden
+        return None
+
+    def get_prev_node(self, node_pk, data):
+        "Same as ``Node.get_prev_node()`` used to be"
+        if not data:
+            raise FSANoDataError
+        edges = self.prev_edges.get(node_pk, ())
+        prev_nodes = set(prev_pk for _, prev_pk in edges)
+        if len(prev_nodes) == 1:  # simple node
+            return self._get(prev_nodes.pop())
+        if len(prev_nodes) > 1:  # complex node
+            for edge_condition, prev_pk in edges:
+                if prev_pk is None:
+                    continue
+                prev_slug = self.nodes[prev_pk].slug
+                if prev_slug in data and edge_condition == data[prev_slug]:
+                    return self.nodes[prev_pk]
+        # start node or overridden
+        return None
+
+
+def _has_payload(model):
+    "Check whether some other app hangs a ``payload`` off <model>"
+    try:
+        model._meta.get_field('payload')
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+def _get_cache():
+    return caches[getattr(settings, 'FLOW_TRANSITION_CACHE', DEFAULT_CACHE_ALIAS)]
+
+
+def _get_cache_key(fsa_pk, stamp):
+    return 'flow:transitions:{}:{}'.format(fsa_pk, stamp.isoformat())
+
+
+def get_transition_table(fsa_pk, modified=None):
+    """Return the cached ``TransitionTable`` of the FSA with pk <fsa_pk>
+
+    Tables are stored in the cache named by the setting
+    ``FLOW_TRANSITION_CACHE``, keyed on the ``modified`` timestamp of the
+    FSA. The timestamp is bumped whenever a node or edge of the FSA is saved
+    or deleted, so every process sharing or not sharing the cache sees the
+    change. Code changing nodes or edges without sending signals, like
+    ``bulk_create()`` or ``update()``, must call
+    ``forget_transition_tables()`` itself.
+
+    Looking up the timestamp costs a query, unless it is passed in as
+    <modified> from an FSA that is already loaded. The table is then as
+    fresh as that FSA instance.
+    """
+    stamp = modified
+    if stamp is None:
+        stamp = FSA.objects.filter(pk=fsa_pk).values_list('modified', flat=True).first()
+    if stamp is None:
+        return TransitionTable.compile(fsa_pk)
+    cache = _get_cache()
+    key = _get_cache_key(fsa_pk, stamp)
+    table = cache.get(key)
+    if table is None:
+        table = TransitionTable.compile(fsa_pk)
+        cache.set(key, table)
+    return table
+
+
+def forget_transition_tables(*fsa_pks):
+    "Bump the timestamps of the FSAs, so that their tables are recompiled"
+    fsa_pks = set(fsa_pks)
+    fsa_pks.discard(None)
+    if fsa_pks:
+        FSA.objects.filter(pk__in=fsa_pks).update(modified=utcnow())
+
+
 class Node(ClonableModel):
     """
     Defaults, fallbacks; interface for all nodes
@@ -76,18 +269,13 @@ class Node(ClonableModel):
                     return edge.next_node
         return None
 
+    def get_transition_table(self):
+        fsa = getattr(self, Node.fsa.cache_name, None)
+        modified = fsa.modified if fsa is not None else None
+        return get_transition_table(self.fsa_id, modified)
+
     def get_next_node(self, nodes):
-        if not nodes:
-            raise FSANoDataError
-        edges = self.next_nodes.all()
-        next_nodes = set([edge.next_node for edge in edges])
-        if len(next_nodes) == 1:  # simple node
-            return next_nodes.pop()
-        if len(next_nodes) > 1:  # complex node
-            next_node = self.get_next_node_many(edges, nodes)
-            return next_node
-        # end node or overridden
-        return None
+        return self.get_transition_table().get_next_node(self.pk, nodes)
 
     def get_prev_node_many(self, prev_nodes, data):
         if not data:
@@ -101,17 +289,7 @@ class Node(ClonableModel):
         return None
 
     def get_prev_node(self, nodes):
-        if not nodes:
-            raise FSANoDataError
-        edges = self.prev_nodes.all()
-        prev_nodes = set([edge.prev_node for edge in edges])
-        if len(prev_nodes) == 1:  # simple node
-            return prev_nodes.pop()
-        if len(prev_nodes) > 1:  # complex node
-            prev_node = self.get_prev_node_many(edges, nodes)
-            return prev_node
-        # start node or overridden
-        return None
+        return self.get_transition_table().get_prev_node(self.pk, nodes)
 
 
 class Edge(ClonableModel):
@@ -162,6 +340,8 @@ class FSA(ClonableModel):
     GRAPHVIZ_TMPDIR = '/tmp/flow_graphviz'
 
     slug = models.SlugField(max_length=SLUG_LENGTH, unique=True)
+    # Bumped when nodes or edges change, see get_transition_table()
+    modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'FSA'
@@ -170,40 +350,23 @@ class FSA(ClonableModel):
     def __str__(self):  # pragma: no cover
         return self.slug
 
-    @transaction.atomic
     def clone(self, slug=None):
+        """Copy the FSA with its nodes and edges, and name it <slug>
+
+        If an FSA named <slug> already exists, it is returned as is. See
+        ``flow.cloning.clone_fsas()``, which copies many FSAs at once."""
         slug = slug if slug else str(uuid4())
-        new, created = self.__class__.objects.get_or_create(slug=slug)
-        if not created:
-            return new
-        new.set_cloned_from(self)
-        new.save()
-        # clone nodes
-        mapping = {}
-        for node in self.nodes.all():
-            mapping[node] = node.clone(new)
-        # set depends on nodes
-        for node in new.nodes.all():
-            node.depends = mapping.get(node.depends, None)
-            node.save()
-        # clone edges
-        for edge in Edge.objects.filter(
-            Q(prev_node__in=mapping) | Q(next_node__in=mapping)).distinct():
-            edge.clone(
-                mapping.get(edge.prev_node, None),
-                mapping.get(edge.next_node, None)
-            )
-        return new
+        return clone_fsas([(self, slug)])[0].fsa
+
+    def get_transition_table(self):
+        return get_transition_table(self.pk, self.modified)
 
     @property
     def nodemap(self):
-        return {s.slug: s for s in self.nodes.all()}
+        return self.get_transition_table().get_nodemap()
 
     def get_startnode(self):
-        try:
-            return Node.objects.get(start=True, fsa=self)
-        except Node.DoesNotExist:
-            raise FSANoStartnodeError()
+        return self.get_transition_table().get_startnode()
 
     @property
     def start(self):
@@ -224,97 +387,81 @@ class FSA(ClonableModel):
         node.start = False
         node.save()
 
+    def get_path_analysis(self):
+        "Raises FSANoStartnodeError if the FSA has no start-node"
+        table = self.get_transition_table()
+        table.get_startnode()
+        return table.paths
+
     def generate_graph(self):
-        graph = {}
-        for node in self.nodes.all():
-            goes_to = set()
-            for s in node.next_nodes.all():
-                goes_to.add(s.next_node.slug if s.next_node else None)
-            graph[node.slug] = list(goes_to)
-        return graph
+        return self.get_transition_table().get_graph()
 
-    def _find_all_paths(self, graph, start, path=[]):
-        path = path + [start]
-        if start is None or self.nodes.get(slug=start).end:
-            return [path]
-        if start not in graph:
-            return []
-        paths = []
-        for node in graph[start]:
-            if node not in path:
-                newpaths = self._find_all_paths(graph, node, path)
-                for newpath in newpaths:
-                    paths.append(newpath)
-        return paths
+    def evaluate_paths(self, items, chunk_size=1000):
+        """Generate the path taken by each (key, data) in <items>
+
+        See ``flow.evaluation.PathEvaluator``."""
+        return PathEvaluator(self.get_transition_table()).evaluate(items, chunk_size)
 
     def find_all_paths(self):
-        graph = self.generate_graph()
-        paths = self._find_all_paths(graph, self.start.slug)
-        return [tuple(path) for path in paths]
+        paths = self.get_path_analysis()
+        return [tuple(path) for path in paths.iter_paths()]
 
     def find_paths_to(self, nodeslug):
-        paths = self.find_all_paths()
-        paths_to = []
-        for path in paths:
-            if nodeslug in path:
-                pos = path.index(nodeslug)
-                paths_to.append(path[:pos])
-        paths_to.append(nodeslug)
-        return paths
+        "Find the beginnings of all paths, up to and including <nodeslug>"
+        paths = self.get_path_analysis()
+        return [tuple(path) for path in paths.iter_paths(to=nodeslug)]
 
     def find_paths_from(self, nodeslug):
-        paths = self.find_all_paths()
-        paths_from = []
-        for path in paths:
-            if nodeslug in path:
-                pos = path.index(nodeslug)
-                paths_from.append(path[pos:])
-        return paths_from
+        "Find the ends of all paths, from and including <nodeslug>"
+        paths = self.get_path_analysis()
+        if not any(paths.iter_paths(to=nodeslug)):
+            return []
+        return [tuple(path) for path in paths.iter_paths(start=nodeslug)]
 
     def nextnode(self, curnode, data):
         "Get next node"
-        return self.nodemap[curnode].get_next_node(data)
+        table = self.get_transition_table()
+        return table.get_next_node(table.slugs[curnode], data)
 
     def prevnode(self, curnode, data):
         "Get prev node"
-        return self.nodemap[curnode].get_prev_node(data)
+        table = self.get_transition_table()
+        return table.get_prev_node(table.slugs[curnode], data)
 
     def find_possible_paths_for_data(self, data):
-        paths = self.find_all_paths()
+        "Find all paths that visit every node in <data>"
+        paths = self.get_path_analysis()
         candidate_paths = set()
-        keys = set(data.keys())
-        for path in paths:
-            path = tuple(node for node in path if node)
-            if keys.issubset(path):
-                candidate_paths.add(path)
+        for path in paths.iter_paths(through=data.keys()):
+            candidate_paths.add(tuple(node for node in path if node))
         return candidate_paths
 
-    def get_maximal_previous_nodes(self, nodeslug, visited=None):
-        if not visited:
-            visited = set()
-        node = Node.objects.get(slug=nodeslug, fsa=self)
-        visited.add(node)
-        edges = Edge.objects.filter(next_node=node)
-        nodes = set(edge.prev_node for edge in edges.all())
-        nodes.discard(None)
-        for node in nodes.copy():
-            if node.start:
-                nodes.add(node)
-                visited.add(node)
-                continue
-            if node in visited:
-                continue
-            recnodes = self.get_maximal_previous_nodes(node.slug, visited)
-            nodes = nodes.union(recnodes)
-        return list(nodes)
+    def get_maximal_previous_nodes(self, nodeslug):
+        """Find all nodes before <nodeslug>, not looking past start-nodes"""
+        table = self.get_transition_table()
+        return table.get_maximal_previous_nodes(table.slugs[nodeslug])
+
+    def get_maximal_previous_nodes_many(self, nodeslugs):
+        """Do ``get_maximal_previous_nodes()`` for each of <nodeslugs>
+
+        Returns a dict of slug to list of nodes."""
+        table = self.get_transition_table()
+        return {slug: table.get_maximal_previous_nodes(table.slugs[slug])
+                for slug in nodeslugs}
 
     def order_data(self, data):
         """Sort data according to possible graphs
 
-        Incidentally, removes unknown nodes"""
-        paths = self.find_possible_paths_for_data(data)
-        # All graphs start the same so just pick one
-        keys = paths.pop()
+        Raises KeyError if no path visits all the nodes in <data>."""
+        paths = self.get_path_analysis()
+        if paths.is_dag:
+            if not paths.is_on_a_path(data.keys()):
+                raise KeyError('No path through all of {}'.format(sorted(data)))
+            keys = paths.sort(data.keys())
+        else:
+            keys = next(paths.iter_paths(through=data.keys()), None)
+            if keys is None:
+                raise KeyError('No path through all of {}'.format(sorted(data)))
         ordered_data = [(s, data.get(s)) for s in keys if s in data]
         return ordered_data
 
@@ -322,14 +469,22 @@ class FSA(ClonableModel):
         global gv
         dot = gv.Digraph()
 
-        for node in self.nodes.all():
+        nodes = self.nodes.all()
+        if _has_payload(Node):
+            nodes = nodes.select_related('payload')
+        edges = {}
+        for edge in (Edge.objects.filter(prev_node__fsa=self)
+                     .select_related('next_node').order_by('pk')):
+            edges.setdefault(edge.prev_node_id, []).append(edge)
+
+        for node in nodes:
             node_args = {}
             payload = getattr(node, 'payload', None)
             if payload:
                 node_args['label'] = payload.label
             if node.start:
                 node_args['shape'] = 'doublecircle'
-            for edge in Edge.objects.filter(prev_node=node):
+            for edge in edges.get(node.pk, ()):
                 edge_args = {}
                 if edge.next_node is None:
                     node_args['shape'] = 'doublecircle'
@@ -350,3 +505,41 @@ class FSA(ClonableModel):
         if not dotsource:
             dotsource = self.generate_dotsource()
         return render_dotsource_to_file(format, filename, dotsource, self.GRAPHVIZ_TMPDIR, directory)
+
+
+def remember_loaded_fsa_of_node(sender, instance, **kwargs):
+    # A node moved to another FSA changes the table of the old FSA too
+    instance._loaded_fsa_id = instance.__dict__.get('fsa_id')
+
+
+def remember_loaded_nodes_of_edge(sender, instance, **kwargs):
+    # A re-pointed edge changes the table of the FSAs it used to connect
+    instance._loaded_node_ids = (instance.__dict__.get('prev_node_id'),
+                                 instance.__dict__.get('next_node_id'))
+
+
+def forget_transition_table_via_node(sender, instance, **kwargs):
+    now = utcnow()
+    fsa_pks = {instance.fsa_id, getattr(instance, '_loaded_fsa_id', None)}
+    fsa_pks.discard(None)
+    FSA.objects.filter(pk__in=fsa_pks).update(modified=now)
+    instance._loaded_fsa_id = instance.fsa_id
+    fsa = getattr(instance, Node.fsa.cache_name, None)
+    if fsa is not None:
+        fsa.modified = now
+
+
+def forget_transition_table_via_edge(sender, instance, **kwargs):
+    node_pks = {instance.prev_node_id, instance.next_node_id}
+    node_pks.update(getattr(instance, '_loaded_node_ids', ()))
+    node_pks.discard(None)
+    if node_pks:
+        FSA.objects.filter(nodes__pk__in=node_pks).update(modified=utcnow())
+    instance._loaded_node_ids = (instance.prev_node_id, instance.next_node_id)
+
+
+post_init.connect(remember_loaded_fsa_of_node, sender=Node)
+post_init.connect(remember_loaded_nodes_of_edge, sender=Edge)
+for signal in (post_save, post_delete):
+    signal.connect(forget_transition_table_via_node, sender=Node)
+    signal.connect(forget_transition_table_via_edge, sender=Edge)
@@ -0,0 +1,206 @@
+"""Path analysis for FSAs
+
+Listing every path through an FSA takes time exponential in the number of
+branches, so questions about paths are instead answered from structures
+computed once per FSA, in O(V+E) plus bitset operations:
+
+* a topological order of the nodes,
+* per node, the nodes reachable from it (itself included),
+* per node, the nodes it is reachable from, its ancestors,
+* per node, the nodes every path from the start passes through to get
+  there, its dominators,
+* per node, whether some path from it ends properly.
+
+Sets of nodes are stored as bitsets, plain ints where bit ``n`` is the
+node at position ``n`` in the topological order.
+
+A path ends at an end-node, or by following an edge leading to ``None``,
+in which case ``None`` is the last element of the path. This matches what
+``FSA.find_all_paths()`` has always returned.
+
+Graphs with loops have no topological order. Then only path listing is
+supported, which avoids visiting a node twice in the same path.
+"""
+
+from collections import deque
+
+
+__all__ = [
+    'PathAnalysis',
+]
+
+
+class PathAnalysis:
+    """Precomputed answers to questions about the paths through a graph
+
+    <graph> is an adjacency list in a dict, mapping a node to the nodes that
+    might come next, ``None`` meaning that the path may end there. Paths
+    start at <start> and end at any node in <ends>.
+    """
+
+    def __init__(self, graph, start, ends=()):
+        self.start = start
+        self.ends = frozenset(ends)
+        self.successors = {}
+        self.may_stop = {}
+        for node, nexts in graph.items():
+            nexts = tuple(nexts or ())
+            self.may_stop[node] = node in self.ends or None in nexts
+            if node in self.ends:
+                self.successors[node] = ()
+            else:
+                self.successors[node] = tuple(n for n in dict.fromkeys(nexts)
+                                              if n is not None and n in graph)
+        self.predecessors = {node: [] for node in graph}
+        for node, nexts in self.successors.items():
+            for next in nexts:
+                self.predecessors[next].append(node)
+
+        self.order = self._sort_topologically()
+        self.is_dag = len(self.order) == len(graph)
+        if self.is_dag:
+            self.index = {node: i for i, node in enumerate(self.order)}
+            self._compute_bitsets()
+
+    def _sort_topologically(self):
+        indegree = {node: len(prevs) for node, prevs in self.predecessors.items()}
+        queue = deque(node for node in self.successors if not indegree[node])
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for next in self.successors[node]:
+                indegree[next] -= 1
+                if not indegree[next]:
+                    queue.append(next)
+        return order
+
+    def _compute_bitsets(self):
+        index = self.index
+        self.reach = {}
+        self.live = {}
+        for node in reversed(self.order):
+            reach = 1 << index[node]
+            live = self.may_stop[node]
+            for next in self.successors[node]:
+                reach |= self.reach[next]
+                live = live or self.live[next]
+            self.reach[node] = reach
+            self.live[node] = live
+
+        self.ancestors = {}
+        self.dominators = {}
+        for node in self.order:
+            bit = 1 << index[node]
+            ancestors = bit
+            dominators = None
+            for prev in self.predecessors[node]:
+                ancestors |= self.ancestors[prev]
+                if self.dominators[prev]:
+                    prev_dominators = self.dominators[prev]
+                    dominators = prev_dominators if dominators is None else dominators & prev_dominators
+            self.ancestors[node] = ancestors
+            if node == self.start:
+                self.dominators[node] = bit
+            else:
+                # Unreachable from the start: no dominators
+                self.dominators[node] = (dominators | bit) if dominators else 0
+
+    def _to_nodes(self, bits):
+        return [node for node in self.order if bits & (1 << self.index[node])]
+
+    def _to_bits(self, nodes):
+        bits = 0
+        for node in nodes:
+            bits |= 1 << self.index[node]
+        return bits
+
+    # Queries, DAGs only
+
+    def reaches(self, node, other):
+        "Check whether there is a path from <node> to <other>"
+        return bool(self.reach[node] & (1 << self.index[other]))
+
+    def get_reachable(self, node):
+        "Return the nodes reachable from <node>, in topological order"
+        return self._to_nodes(self.reach[node])
+
+    def get_ancestors(self, node):
+        "Return the nodes <node> is reachable from, in topological order"
+        return self._to_nodes(self.ancestors[node])
+
+    def get_dominators(self, node):
+        "Return the nodes every path from the start to <node> visits"
+        return self._to_nodes(self.dominators[node])
+
+    def sort(self, nodes):
+        "Sort <nodes> in topological order, dropping unknown nodes"
+        return sorted((node for node in nodes if node in self.index),
+                      key=self.index.__getitem__)
+
+    def is_on_a_path(self, nodes):
+        "Check whether some path from the start visits all of <nodes>"
+        if self.start not in self.index:
+            return False
+        if any(node not in self.index for node in nodes):
+            return False
+        current = self.start
+        for node in self.sort(nodes):
+            if not self.reaches(current, node):
+                return False
+            current = node
+        return self.live[current]
+
+    # Path listing
+
+    def iter_paths(self, start=None, through=(), to=None):
+        """Generate the paths from <start> that visit all nodes in <through>
+
+        <start> defaults to the start of the graph. If <to> is given, the
+        paths stop at and include <to>, otherwise they run to their end.
+
+        On DAGs, only branches that can still satisfy the conditions are
+        explored, so the time taken is proportional to the number and
+        length of the paths generated, not the number of paths in total.
+        """
+        start = self.start if start is None else start
+        through = frozenset(through)
+        if start not in self.successors or not through <= set(self.successors):
+            return
+        if to is not None and to not in self.successors:
+            return
+        prune = self.is_dag
+        if prune:
+            required = self._to_bits(through | ({to} if to is not None else set()))
+            if (self.reach[start] & required) != required:
+                return
+
+        def is_viable(node, missing):
+            if not prune:
+                return True
+            if (self.reach[node] & missing) != missing:
+                return False
+            return to is not None or self.live[node]
+
+        stack = [(start, [start], through - {start})]
+        while stack:
+            node, path, missing = stack.pop()
+            if node == to:
+                if not missing:
+                    yield path
+                continue
+            if to is None:
+                if node in self.ends:
+                    if not missing:
+                        yield path
+                    continue
+                if self.may_stop[node] and not missing:
+                    yield path + [None]
+            missing_bits = self._to_bits(missing | ({to} if to is not None else set())) if prune else 0
+            on_path = None if prune else set(path)
+            for next in reversed(self.successors[node]):
+                if on_path is not None and next in on_path:
+                    continue
+                if not is_viable(next, missing_bits):
+                    continue
+                stack.append((next, path + [next], missing - {next}))
@@ -0,0 +1,69 @@
+"""Benchmarks, not part of the test suite
+
+Run from the top directory of the repository with, for instance::
+
+    python -m tests.benchmarks.section_paths
+
+Each benchmark sets up Django with ``tests.test_settings`` and runs against
+a throwaway in-memory test database.
+"""
+
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import sys
+import time
+
+
+__all__ = [
+    'setup_django',
+    'test_database',
+    'timed',
+    'print_table',
+]
+
+
+def setup_django():
+    src = Path(__file__).resolve().parents[2] / 'src'
+    if str(src) not in sys.path:
+        sys.path.insert(0, str(src))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.test_settings')
+    import django
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from django.test.utils import teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def timed(func, *args, **kwargs):
+    "Run func, return (seconds spent, number of queries, result)"
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        spent = time.perf_counter() - start
+    return spent, len(queries), result
+
+
+def print_table(headers, rows):
+    rows = [[str(cell) for cell in row] for row in rows]
+    widths = [max(len(str(h)), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)]
+    line = '  '.join('{:>%i}' % w for w in widths)
+    print(line.format(*headers))
+    print(line.format(*('-' * w for w in widths)))
+    for row in rows:
+        print(line.format(*row))
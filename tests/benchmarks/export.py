@@ -0,0 +1,106 @@
+"""Compare the rendered and the streamed export of a generated plan
+
+Usage: python -m tests.benchmarks.export [SECTIONS [QUESTIONS [ANSWER_SIZE]]]
+
+Defaults to 20 sections of 10 questions, 200 questions in all, each
+answered with 2000 characters. Each mode runs in its own process so that
+the peak RSS of one does not hide the other. Time to first byte is when the
+first chunk of content is available, the peak Python heap is measured with
+tracemalloc in a second run.
+"""
+
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from . import print_table, setup_django, test_database
+
+
+MODES = ('rendered', 'streamed')
+
+
+def export(client, url, mode):
+    "Fetch the export, return time to first byte and total time"
+    start = time.perf_counter()
+    if mode == 'streamed':
+        response = client.get(url + '?stream')
+        chunks = iter(response.streaming_content)
+        size = len(next(chunks))
+        ttfb = time.perf_counter() - start
+        for chunk in chunks:
+            size += len(chunk)
+    else:
+        response = client.get(url)
+        ttfb = time.perf_counter() - start
+        size = len(response.content)
+    assert response.status_code == 200
+    return ttfb, time.perf_counter() - start, size
+
+
+def run(mode, sections, questions, answer_size):
+    from django.test import Client
+    from django.urls import reverse
+    from django.utils.timezone import now
+
+    from easydmp.auth.models import User
+    from easydmp.plan.models import Plan
+    from .fixtures import answer_template, make_linear_template
+
+    template = make_linear_template(sections, questions)
+    user = User.objects.create(username='benchmark')
+    plan = Plan.objects.create(template=template, title='Benchmark',
+                               added_by=user, modified_by=user,
+                               published=now())
+    Plan.objects.filter(pk=plan.pk).update(data=answer_template(template, answer_size))
+    url = reverse('generated_plan_html', kwargs={'plan': plan.pk})
+    client = Client()
+    export(client, url, mode)  # Warm up caches and the template loader
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ttfb, total, size = export(client, url, mode)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    export(client, url, mode)
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(mode, ttfb, total, size, rss_after - rss_before, heap_peak)
+
+
+def main(sections, questions, answer_size):
+    rows = []
+    for mode in MODES:
+        output = subprocess.check_output(
+            [sys.executable, '-m', __spec__.name, '--run', mode,
+             str(sections), str(questions), str(answer_size)],
+            universal_newlines=True,
+        )
+        mode, ttfb, total, size, rss_growth, heap_peak = output.split()[-6:]
+        rows.append((
+            mode,
+            '{:.4f}'.format(float(ttfb)),
+            '{:.4f}'.format(float(total)),
+            size,
+            rss_growth,
+            int(heap_peak) // 1024,
+        ))
+    print('{} sections x {} questions, {} characters per answer'.format(
+        sections, questions, answer_size))
+    print_table(
+        ('mode', 'ttfb s', 'total s', 'bytes', 'peak rss +KiB', 'peak heap KiB'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == '--run':
+        setup_django()
+        with test_database():
+            run(args[1], *(int(arg) for arg in args[2:5]))
+    else:
+        sizes = [int(arg) for arg in args] + [20, 10, 2000][len(args):]
+        main(*sizes)
@@ -0,0 +1,100 @@
+"""Synthetic templates for the benchmarks"""
+
+from easydmp.dmpt.models import BooleanQuestion
+from easydmp.dmpt.models import CannedAnswer
+from easydmp.dmpt.models import ReasonQuestion
+from easydmp.dmpt.models import Section
+from easydmp.dmpt.models import Template
+from flow.models import Edge, FSA, Node
+
+
+def make_template(title='Benchmark'):
+    return Template.objects.create(title=title)
+
+
+def make_branching_section(template, branches, position=1):
+    """Make a section of <branches> diamonds in a row
+
+    Each diamond is a yes/no-question leading to one of two text
+    questions, which both lead to the next diamond. A final text question
+    ends the section. There are 2**<branches> paths through the section.
+    """
+    section = Section.objects.create(
+        template=template,
+        title='Branching {}'.format(position),
+        position=position,
+        branching=True,
+    )
+    fsa = FSA.objects.create(slug='bench-{}-{}'.format(template.pk, position))
+    kwargs = {'section': section, 'obligatory': True}
+
+    def add(cls, pos, start=False):
+        node = Node.objects.create(slug='n{}'.format(pos), fsa=fsa, start=start)
+        return cls.objects.create(question='q{}'.format(pos), position=pos,
+                                  node=node, **kwargs)
+
+    joins = []
+    for i in range(branches):
+        pos = 3 * i + 1
+        branch = add(BooleanQuestion, pos, start=(i == 0))
+        for choice in ('Yes', 'No'):
+            CannedAnswer.objects.create(question=branch, choice=choice)
+        for prev in joins:
+            Edge.objects.create(prev_node=prev.node, next_node=branch.node)
+        yes = add(ReasonQuestion, pos + 1)
+        no = add(ReasonQuestion, pos + 2)
+        Edge.objects.create(condition='True', prev_node=branch.node, next_node=yes.node)
+        Edge.objects.create(condition='False', prev_node=branch.node, next_node=no.node)
+        joins = [yes, no]
+    final = add(ReasonQuestion, 3 * branches + 1)
+    for prev in joins:
+        Edge.objects.create(prev_node=prev.node, next_node=final.node)
+    return section
+
+
+def answer_section(section, choice=True):
+    """Answer every question on one path through <section>
+
+    Every yes/no-question is answered with <choice>. Returns plan data.
+    """
+    data = {}
+    skip = set()
+    for question in section.questions.order_by('position'):
+        if question.position in skip:
+            continue
+        if question.input_type == 'bool':
+            data[str(question.pk)] = {'choice': choice, 'notes': ''}
+            skip.add(question.position + (2 if choice else 1))
+        else:
+            data[str(question.pk)] = {'choice': 'Because', 'notes': ''}
+    return data
+
+
+def make_linear_template(sections, questions, title='Linear'):
+    """Make a template of <sections> sections of <questions> text questions"""
+    template = make_template(title)
+    for position in range(1, sections + 1):
+        section = Section.objects.create(
+            template=template,
+            title='Section {}'.format(position),
+            introductory_text='<p>About section {}</p>'.format(position),
+            position=position,
+        )
+        for pos in range(1, questions + 1):
+            ReasonQuestion.objects.create(
+                section=section,
+                question='Question {}.{}'.format(position, pos),
+                framing_text='<p>{}</p>',
+                position=pos,
+                obligatory=True,
+            )
+    return template
+
+
+def answer_template(template, size=2000):
+    "Answer every question of <template> with <size> characters of text"
+    text = ('All work and no play makes Jack a dull boy. ' * (size // 44 + 1))[:size]
+    data = {}
+    for question in ReasonQuestion.objects.filter(section__template=template):
+        data[str(question.pk)] = {'choice': text, 'notes': 'Noted'}
+    return data
@@ -0,0 +1,99 @@
+"""Compare cloning FSAs node by node with cloning them in bulk
+
+Usage: python -m tests.benchmarks.fsa_clone [SIZES...]
+
+Each FSA is a chain of diamonds, a branching node followed by two nodes
+that join again, and every third node depends on the node before it.
+"""
+
+from collections import deque
+import sys
+from uuid import uuid4
+
+from . import print_table, setup_django, test_database, timed
+
+
+SIZES = (10, 100, 1000)
+
+
+def clone_one_by_one(fsa, slug):
+    "The algorithm of FSA.clone before bulk cloning"
+    from django.db import transaction
+    from django.db.models import Q
+    from flow.models import Edge
+
+    with transaction.atomic():
+        new = fsa.__class__.objects.create(slug=slug)
+        new.set_cloned_from(fsa)
+        new.save()
+        mapping = {}
+        for node in fsa.nodes.all():
+            mapping[node] = node.clone(new)
+        for node in new.nodes.all():
+            node.depends = mapping.get(node.depends, None)
+            node.save()
+        for edge in Edge.objects.filter(
+                Q(prev_node__in=mapping) | Q(next_node__in=mapping)).distinct():
+            edge.clone(
+                mapping.get(edge.prev_node, None),
+                mapping.get(edge.next_node, None)
+            )
+    return new
+
+
+def make_fsa(size):
+    from easydmp.lib.models import bulk_create_with_pks
+    from flow.models import Edge, FSA, Node
+
+    fsa = FSA.objects.create(slug=str(uuid4()))
+    nodes = bulk_create_with_pks(Node, [
+        Node(fsa=fsa, slug='n{}'.format(i), start=(i == 0)) for i in range(size)
+    ], ['fsa', 'slug'])
+    for i, node in enumerate(nodes):
+        if i % 3 == 2:
+            node.depends = nodes[i-1]
+            node.save()
+    edges = []
+    for i in range(0, size - 3, 3):
+        top, left, right, bottom = nodes[i:i+4]
+        edges.extend((
+            Edge(prev_node=top, next_node=left, condition='Yes'),
+            Edge(prev_node=top, next_node=right, condition='No'),
+            Edge(prev_node=left, next_node=bottom),
+            Edge(prev_node=right, next_node=bottom),
+        ))
+    edges.append(Edge(prev_node=nodes[-1]))
+    Edge.objects.bulk_create(edges)
+    return fsa
+
+
+def main(sizes=SIZES):
+    from django.db import connection
+    from flow.models import Edge
+
+    # The old way runs more queries than Django logs by default
+    connection.queries_limit = 100000
+    connection.queries_log = deque(maxlen=connection.queries_limit)
+
+    rows = []
+    for size in sizes:
+        fsa = make_fsa(size)
+        old_spent, old_queries, old = timed(clone_one_by_one, fsa, str(uuid4()))
+        new_spent, new_queries, new = timed(fsa.clone, str(uuid4()))
+        assert new.nodes.count() == old.nodes.count() == size
+        rows.append((
+            size,
+            Edge.objects.filter(prev_node__fsa=fsa).count(),
+            '{:.4f}'.format(old_spent),
+            old_queries,
+            '{:.4f}'.format(new_spent),
+            new_queries,
+        ))
+    print_table(('nodes', 'edges', 'old s', 'old q', 'bulk s', 'bulk q'), rows)
+
+
+if __name__ == '__main__':
+    setup_django()
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    with test_database():
+        main(sizes)
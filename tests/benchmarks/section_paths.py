@@ -0,0 +1,69 @@
+"""Compare path validation by enumeration with the DAG path engine
+
+Usage: python -m tests.benchmarks.section_paths [MAX_BRANCHES_FOR_ENUMERATION]
+
+For each synthetic section, the data answers every question on one path
+except the last one, which is the worst case for enumeration: no path
+matches, so all 2**branches paths are listed and compared.
+"""
+
+import sys
+
+from . import print_table, setup_django, test_database, timed
+
+
+SIZES = (4, 8, 12, 16, 50, 100, 200)
+
+
+def validate_by_enumeration(section, valids):
+    "The algorithm of Section.validate_data before the path engine"
+    for path in section.find_all_paths():
+        if valids == set(path):
+            return True
+    return False
+
+
+def main(max_enumerate=16):
+    from easydmp.dmpt.graph import TemplateGraph
+    from .fixtures import answer_section, make_branching_section, make_template
+
+    rows = []
+    for branches in SIZES:
+        template = make_template('Paths {}'.format(branches))
+        section = make_branching_section(template, branches)
+        data = answer_section(section)
+        valids, _ = section.find_validity_of_questions(data)
+        last = max(valids, key=lambda pk: section.questions.get(pk=pk).position)
+        valids.discard(last)
+
+        old = ('-', '-')
+        if branches <= max_enumerate:
+            spent, queries, result = timed(validate_by_enumeration, section, valids)
+            assert result is False
+            old = ('{:.4f}'.format(spent), queries)
+
+        spent_compile, queries_compile, graph = timed(TemplateGraph.compile, template.pk)
+        spent, queries, result = timed(graph.is_complete_path, section.pk, valids)
+        assert result is False
+        rows.append((
+            branches,
+            section.questions.count(),
+            '2^{}'.format(branches),
+        ) + old + (
+            '{:.4f}'.format(spent_compile),
+            queries_compile,
+            '{:.6f}'.format(spent),
+            queries,
+        ))
+    print_table(
+        ('branches', 'questions', 'paths', 'enum s', 'enum q',
+         'compile s', 'compile q', 'engine s', 'engine q'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    setup_django()
+    max_enumerate = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    with test_database():
+        main(max_enumerate)
@@ -1,11 +1,15 @@
 from datetime import date
 from collections import OrderedDict
+import random
 
 from django import test
 
 from easydmp.dmpt.models import Template, Section, CannedAnswer, Question
 from easydmp.dmpt.models import BooleanQuestion, ChoiceQuestion, DateRangeQuestion
 from easydmp.dmpt.models import MultipleChoiceOneTextQuestion
+from easydmp.dmpt.models import EEStoreMixin
+from easydmp.dmpt.graph import get_template_graph
+from easydmp.dmpt.paths import dfs_paths, is_complete_path
 from flow.models import Edge, Node, FSA
 
 
@@ -207,6 +211,445 @@ class TestQuestionPrevQuestionMethods(CannedData, test.TestCase):
         result = q2.get_prev_question()
         self.assertEqual(result, q1)
 
+
+class TestTemplateGraph(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        fsa = FSA.objects.create(slug='graph')
+        self.q1 = BooleanQuestion.objects.create(position=1, **self.canned_question)
+        self.q2 = DateRangeQuestion.objects.create(position=2, **self.canned_question)
+        self.q3 = DateRangeQuestion.objects.create(position=3, **self.canned_question)
+        self.q4 = DateRangeQuestion.objects.create(position=4, **self.canned_question)
+        nodes = []
+        for i, q in enumerate((self.q1, self.q2, self.q3, self.q4), 1):
+            node = Node.objects.create(slug='n{}'.format(i), fsa=fsa, start=(i == 1))
+            q.node = node
+            q.save()
+            nodes.append(node)
+        Edge.objects.create(condition='Yes', prev_node=nodes[0], next_node=nodes[1])
+        Edge.objects.create(condition='No', prev_node=nodes[0], next_node=nodes[2])
+        Edge.objects.create(prev_node=nodes[1], next_node=nodes[3])
+        Edge.objects.create(prev_node=nodes[2], next_node=nodes[3])
+        self.next_section = Section.objects.create(
+            template=self.template,
+            title='Next',
+            position=2,
+        )
+        self.q5 = DateRangeQuestion.objects.create(
+            section=self.next_section,
+            question='t',
+            position=1,
+        )
+
+    def test_next_and_prev_question_match_models(self):
+        graph = get_template_graph(self.template.pk)
+        answer_sets = (
+            {str(self.q1.pk): {'choice': 'Yes'}},
+            {str(self.q1.pk): {'choice': 'No'}},
+        )
+        for answers in answer_sets:
+            for q in (self.q1, self.q2, self.q3, self.q4, self.q5):
+                q = Question.objects.get(pk=q.pk)
+                self.assertEqual(
+                    graph.get_next_question(q, answers),
+                    q.get_next_question(answers),
+                )
+                self.assertEqual(
+                    graph.get_prev_question(q, answers),
+                    q.get_prev_question(answers),
+                )
+
+    def test_lookups_are_query_free(self):
+        graph = get_template_graph(self.template.pk)
+        answers = {str(self.q1.pk): {'choice': 'No'}}
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.get_next_question(self.q1, answers), self.q3)
+            self.assertEqual(graph.get_next_question(self.q4, answers), self.q5)
+            self.assertEqual(graph.get_prev_question(self.q5, answers), self.q4)
+
+    def test_lookups_do_not_change_the_graph(self):
+        import pickle
+
+        # Graphs are shared between threads
+        graph = get_template_graph(self.template.pk)
+        before = pickle.dumps(graph)
+        answers = {str(self.q1.pk): {'choice': 'No'}}
+        for section in graph.sections:
+            graph.get_section_adjacency(section.pk)
+            graph.validate_section_data(section.pk, answers)
+        for question_pk in graph.question_pks:
+            graph.get_canned_answers(question_pk)
+        self.assertEqual(pickle.dumps(graph), before)
+
+    def test_graph_is_recompiled_on_change(self):
+        graph = get_template_graph(self.template.pk)
+        self.assertIs(graph, get_template_graph(self.template.pk))
+        q6 = DateRangeQuestion.objects.create(
+            section=self.next_section,
+            question='u',
+            position=2,
+        )
+        new_graph = get_template_graph(self.template.pk)
+        self.assertIsNot(graph, new_graph)
+        self.assertEqual(new_graph.get_next_question(self.q5), q6)
+
+    def test_canned_answers_are_query_free(self):
+        CannedAnswer.objects.create(question=self.q1, choice='Yes', canned_text='We do')
+        CannedAnswer.objects.create(question=self.q1, choice='No', canned_text='We do not')
+        template = Template.objects.get(pk=self.template.pk)
+        data = {str(self.q1.pk): {'choice': True}}
+        graph = get_template_graph(template)
+        self.assertEqual(list(graph.get_canned_answers(self.q1.pk)), ['Yes', 'No'])
+        with self.assertNumQueries(0):
+            texts = template.generate_canned_text(data)
+        self.assertEqual(texts[0]['text'][0]['text'], 'We do')
+        q1 = Question.objects.get(pk=self.q1.pk).get_instance()
+        self.assertEqual(q1.get_canned_answer(True), 'We do')
+
+
+class TestSectionNavigation(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.q1 = DateRangeQuestion.objects.create(position=1, **self.canned_question)
+        self.empty = Section.objects.create(template=self.template, title='Empty',
+                                            position=2, super_section=self.section,
+                                            section_depth=2)
+        self.last = Section.objects.create(template=self.template, title='Last',
+                                           position=3)
+        self.q2 = DateRangeQuestion.objects.create(section=self.last, question='t',
+                                                   position=1)
+        self.q3 = DateRangeQuestion.objects.create(section=self.last, question='u',
+                                                   position=2)
+
+    def test_sections(self):
+        self.assertEqual(self.section.get_next_section(), self.empty)
+        self.assertEqual(self.empty.get_next_section(), self.last)
+        self.assertIsNone(self.last.get_next_section())
+        self.assertEqual(self.last.get_prev_section(), self.empty)
+        self.assertIsNone(self.section.get_prev_section())
+        self.assertEqual(self.empty.get_topmost_section(), self.section)
+        self.assertEqual(self.template.first_section, self.section)
+        self.assertEqual(self.template.last_section, self.last)
+        graph = get_template_graph(self.template.pk)
+        self.assertEqual(graph.get_sub_sections(self.section.pk), (self.empty,))
+        self.assertEqual(graph.get_top_sections(), (self.section, self.last))
+
+    def test_questions(self):
+        self.assertEqual(self.section.get_first_question(), self.q1)
+        self.assertIsNone(self.empty.get_first_question())
+        self.assertEqual(self.empty.first_question, self.q2)
+        self.assertEqual(self.empty.last_question, self.q1)
+        self.assertEqual(self.last.get_last_question(), self.q3)
+        self.assertEqual(self.template.first_question, self.q1)
+        self.assertEqual(self.template.last_question, self.q3)
+        self.assertEqual(self.q1.get_first_question_in_next_section(), self.q2)
+        self.assertEqual(self.q2.get_last_question_in_prev_section(), self.q1)
+        self.assertIsNone(self.q3.get_first_question_in_next_section())
+
+    def test_navigation_costs_at_most_one_query(self):
+        get_template_graph(self.template.pk)
+        with self.assertNumQueries(1):
+            self.empty.get_next_section()
+        with self.assertNumQueries(1):
+            self.empty.first_question
+        with self.assertNumQueries(1):
+            self.q1.get_first_question_in_next_section()
+
+
+class TestTemplateCloning(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        fsa = FSA.objects.create(slug='clone')
+        self.q1 = BooleanQuestion.objects.create(position=1, **self.canned_question)
+        self.q2 = DateRangeQuestion.objects.create(position=2, **self.canned_question)
+        self.q3 = DateRangeQuestion.objects.create(position=3, **self.canned_question)
+        nodes = []
+        for i, q in enumerate((self.q1, self.q2, self.q3), 1):
+            node = Node.objects.create(slug='n{}'.format(i), fsa=fsa, start=(i == 1))
+            q.node = node
+            q.save()
+            nodes.append(node)
+        nodes[2].depends = nodes[0]
+        nodes[2].save()
+        yes = Edge.objects.create(condition='Yes', prev_node=nodes[0], next_node=nodes[1])
+        no = Edge.objects.create(condition='No', prev_node=nodes[0], next_node=nodes[2])
+        Edge.objects.create(prev_node=nodes[1], next_node=nodes[2])
+        CannedAnswer.objects.create(question=self.q1, choice='Yes', edge=yes)
+        CannedAnswer.objects.create(question=self.q1, choice='No', edge=no)
+        self.subsection = Section.objects.create(
+            template=self.template,
+            title='Sub',
+            position=2,
+            super_section=self.section,
+        )
+
+    def add_questions(self, count):
+        first = self.subsection.questions.count()
+        for i in range(first, first+count):
+            q = ChoiceQuestion.objects.create(
+                section=self.subsection,
+                question='q{}'.format(i),
+                position=i+1,
+            )
+            CannedAnswer.objects.create(question=q, choice='A')
+            CannedAnswer.objects.create(question=q, choice='B')
+
+    def test_clone_has_same_structure(self):
+        new = self.template._clone(title='Clone', version=2)
+        self.assertEqual(new.sections.count(), 2)
+        subsection = new.sections.get(title='Sub')
+        section = new.sections.get(title='Miscellaneous')
+        self.assertEqual(subsection.super_section, section)
+        q1, q2, q3 = section.questions.order_by('position')
+        self.assertEqual(q1.input_type, 'bool')
+        self.assertNotEqual(q1.node, self.q1.node)
+        self.assertEqual(q1.node.fsa, q3.node.fsa)
+        self.assertEqual(q1.node.fsa.slug, 's{}-clone'.format(section.pk))
+        self.assertEqual(q3.node.depends, q1.node)
+        edges = {edge.condition: edge for edge in q1.node.next_nodes.all()}
+        self.assertEqual(edges['Yes'].next_node, q2.node)
+        self.assertEqual(edges['No'].next_node, q3.node)
+        for ca in q1.canned_answers.all():
+            self.assertEqual(ca.edge, edges[ca.choice])
+        self.assertEqual(q2.node.next_nodes.get().next_node, q3.node)
+
+    def test_questions_inserted_meanwhile_are_not_mixed_up(self):
+        from unittest import mock
+
+        other = Template.objects.create(title='other')
+        other_section = Section.objects.create(template=other, title='other')
+        bulk_create = Question.objects.bulk_create
+
+        def racing_bulk_create(objs):
+            # Another connection inserts a question just before the copies
+            Question.objects.create(section=other_section, question='intruder', position=1)
+            return bulk_create(objs)
+
+        with mock.patch('django.db.connection.features.can_return_ids_from_bulk_insert', False), \
+                mock.patch.object(Question.objects, 'bulk_create', side_effect=racing_bulk_create):
+            new = self.template._clone(title='Clone', version=2)
+        section = new.sections.get(title='Miscellaneous')
+        q1, q2, q3 = section.questions.order_by('position')
+        self.assertEqual(q1.canned_answers.count(), 2)
+        self.assertEqual(q1.node.fsa.slug, 's{}-clone'.format(section.pk))
+        self.assertFalse(other_section.questions.exclude(question='intruder').exists())
+
+    def test_query_count_does_not_grow_with_size(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from easydmp.dmpt.cloning import clone_template
+
+        self.add_questions(2)
+        with CaptureQueriesContext(connection) as small:
+            clone_template(self.template, 'Small', 1)
+        self.add_questions(20)
+        with CaptureQueriesContext(connection) as large:
+            new = clone_template(self.template, 'Large', 1)
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(Question.objects.filter(section__template=new).count(), 25)
+        self.assertEqual(CannedAnswer.objects.filter(question__section__template=new).count(), 46)
+
+
+class TestTypedQuestions(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        from easydmp.eestore.models import EEStoreSource, EEStoreType
+        self.eestore_type = EEStoreType.objects.create(name='things')
+        self.source = EEStoreSource.objects.create(eestore_type=self.eestore_type,
+                                                   name='somewhere')
+        self.fsa = FSA.objects.create(slug='typed')
+
+    def make_question(self, input_type, position=1):
+        from easydmp.dmpt.models import INPUT_TYPE_MAP
+        from easydmp.eestore.models import EEStoreMount
+        question = INPUT_TYPE_MAP[input_type].objects.create(
+            position=position, **self.canned_question)
+        question.node = Node.objects.create(slug='n{}'.format(question.pk), fsa=self.fsa)
+        question.save()
+        CannedAnswer.objects.create(question=question, choice='A', canned_text='a')
+        CannedAnswer.objects.create(question=question, choice='B', canned_text='b')
+        if isinstance(question, EEStoreMixin):
+            mount = EEStoreMount.objects.create(question=question,
+                                                eestore_type=self.eestore_type)
+            mount.sources.add(self.source)
+        return question
+
+    def use(self, question):
+        question.node.slug
+        question.get_canned_answer_index()
+        eestore = getattr(question, 'eestore', None)
+        if eestore is not None:
+            eestore.eestore_type.name
+            list(eestore.sources.all())
+
+    def test_query_count_per_input_type(self):
+        from easydmp.dmpt.models import INPUT_TYPE_MAP
+
+        for input_type, cls in INPUT_TYPE_MAP.items():
+            with self.subTest(input_type=input_type):
+                question = self.make_question(input_type)
+                # question, canned answers, and eestore sources if any
+                num_queries = 3 if issubclass(cls, EEStoreMixin) else 2
+                with self.assertNumQueries(num_queries):
+                    typed = Question.objects.typed().get(pk=question.pk)
+                self.assertIs(type(typed), cls)
+                with self.assertNumQueries(0):
+                    self.use(typed)
+                    self.assertEqual(list(typed.get_canned_answer_index().items()),
+                                     [('A', 'a'), ('B', 'b')])
+                question.delete()
+
+    def test_typed_survives_other_querysets(self):
+        from easydmp.dmpt.models import INPUT_TYPE_MAP
+
+        question = self.make_question('bool')
+        typed = Question.objects.typed().filter(section=self.section)
+        cls = INPUT_TYPE_MAP['bool']
+        self.assertIs(type(typed.order_by('pk').first()), cls)
+        self.assertIs(type(next(typed.iterator())), cls)
+        self.assertEqual(list(typed.values_list('pk', flat=True)), [question.pk])
+        self.assertIs(type(Question.objects.filter(section=self.section).get()), Question)
+
+    def test_query_count_does_not_grow_with_size(self):
+        from easydmp.dmpt.models import INPUT_TYPE_MAP
+
+        for position, input_type in enumerate(INPUT_TYPE_MAP, 1):
+            self.make_question(input_type, position)
+        with self.assertNumQueries(3):
+            questions = list(Question.objects.typed().filter(section=self.section))
+        self.assertEqual(len(questions), len(INPUT_TYPE_MAP))
+        with self.assertNumQueries(0):
+            for question in questions:
+                self.use(question)
+
+
+class TestSectionGraphCache(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = '/api/v1/sections/{}/graph.svg'.format(self.section.pk)
+        from django.contrib.auth import get_user_model
+        user = get_user_model().objects.create(username='graph viewer')
+        self.client.force_login(user)
+
+    def test_api_does_not_render_on_a_miss(self):
+        from unittest import mock
+
+        with mock.patch('easydmp.dmpt.api.views.queue_rendering') as queue, \
+                mock.patch.object(Section, 'is_cached_dotsource_fresh', return_value=False), \
+                mock.patch.object(Section, 'refresh_cached_dotsource') as refresh:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('Retry-After', response)
+        queue.assert_called_once_with(self.section.pk, 'svg')
+        refresh.assert_not_called()
+
+    def test_api_redirects_to_fresh_file(self):
+        from unittest import mock
+
+        with mock.patch.object(Section, 'is_cached_dotsource_fresh', return_value=True):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'],
+                         self.section.get_cached_dotsource_urlpath('svg'))
+
+    def test_template_change_makes_file_stale(self):
+        import os
+        from pathlib import Path
+        from tempfile import TemporaryDirectory
+        from unittest import mock
+
+        with TemporaryDirectory() as tmpdir:
+            paths = (Path(tmpdir) / 'app.dot', Path(tmpdir) / 'site.dot')
+            with mock.patch.object(Section, '_get_cached_dotsource_paths', return_value=paths):
+                self.assertFalse(self.section.is_cached_dotsource_fresh('dot'))
+                self.section.refresh_cached_dotsource('dot')
+                self.assertTrue(self.section.is_cached_dotsource_fresh('dot'))
+                # Pretend the files were written a minute ago
+                stamp = self.template.modified.timestamp() - 60
+                for path in paths:
+                    os.utime(str(path), (stamp, stamp))
+                self.assertFalse(self.section.is_cached_dotsource_fresh('dot'))
+
+    def test_rendering_is_not_queued_without_workers(self):
+        from easydmp.dmpt.rendering import queue_rendering
+
+        self.assertFalse(queue_rendering(self.section.pk, 'svg'))
+
+    def test_api_does_not_render_without_workers(self):
+        from unittest import mock
+
+        with mock.patch.object(Section, 'is_cached_dotsource_fresh', return_value=False), \
+                mock.patch.object(Section, 'refresh_cached_dotsource') as refresh:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('Retry-After', response)
+        refresh.assert_not_called()
+
+    def test_failed_rendering_is_reported(self):
+        from unittest import mock
+        from easydmp.dmpt import rendering
+
+        key = (self.section.pk, 'svg')
+        with mock.patch.object(rendering, 'render_section_graph', side_effect=OSError('no dot')), \
+                mock.patch.object(rendering, '_failed', {}), \
+                mock.patch.object(rendering, '_pending', {key}):
+            rendering._render(key)
+            self.assertEqual(rendering.get_rendering_error(*key), 'no dot')
+            with mock.patch('easydmp.dmpt.api.views.queue_rendering') as queue, \
+                    mock.patch.object(Section, 'is_cached_dotsource_fresh', return_value=False):
+                response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 500)
+            self.assertIn(b'no dot', response.content)
+            queue.assert_not_called()
+            with mock.patch.object(rendering.time, 'monotonic',
+                                   return_value=rendering.time.monotonic() + rendering.FAILURE_TTL + 1):
+                self.assertIsNone(rendering.get_rendering_error(*key))
+
+    def test_old_failures_are_forgotten(self):
+        from unittest import mock
+        from easydmp.dmpt import rendering
+
+        old = (self.section.pk, 'pdf')
+        key = (self.section.pk, 'svg')
+        failed_at = rendering.time.monotonic() - rendering.FAILURE_TTL - 1
+        with mock.patch.object(rendering, 'render_section_graph', side_effect=OSError('no dot')), \
+                mock.patch.object(rendering, '_failed', {old: (failed_at, 'gone')}), \
+                mock.patch.object(rendering, '_pending', {key}):
+            rendering._render(key)
+            self.assertEqual(set(rendering._failed), {key})
+
+
+class TestIsCompletePath(test.SimpleTestCase):
+
+    @staticmethod
+    def make_dag(rnd, size):
+        graph = {}
+        for i in range(1, size+1):
+            later = list(range(i+1, size+1)) + [None]
+            graph[i] = set(rnd.sample(later, rnd.randint(0, min(3, len(later)))))
+        return graph
+
+    def test_same_answer_as_enumerating_paths(self):
+        rnd = random.Random(1)
+        for _ in range(200):
+            graph = self.make_dag(rnd, rnd.randint(1, 10))
+            paths = []
+            for path in dfs_paths(graph, 1):
+                if not path[-1]:
+                    path = path[:-1]
+                paths.append(set(path))
+            candidates = paths + [set(rnd.sample(list(graph), rnd.randint(1, len(graph))))
+                                  for _ in range(5)]
+            for members in candidates:
+                expected = members in paths
+                self.assertEqual(is_complete_path(graph, 1, members), expected,
+                                 (graph, members))
+
 #     def test_branching_nextstate(self):
 #         s1 = BooleanQuestion.objects.create(name='S1', **self.canned_question)
 #         s2 = ChoiceQuestion.objects.create(name='S2', **self.canned_question)
@@ -2,12 +2,16 @@
 
 from __future__ import unicode_literals
 
+from collections import Counter
 from django import test
 from datetime import date
+import random
 
 from flow.models import Node
 from flow.models import Edge
 from flow.models import FSA
+from flow.models import forget_transition_tables
+from flow.paths import PathAnalysis
 
 
 def generate_nodes(start, **canned_data):
@@ -171,6 +175,14 @@ class TestFSA(CannedData, test.TestCase):
         self.assertEqual(set(paths), set((route1, route2)))
         self.assertNotEqual(route1, route2)
 
+    def test_find_paths_to_and_from(self):
+        self.generate_nodes()
+        self.assertEqual(
+            set(self.fsa.find_paths_to('s4')),
+            {('start', 's1', 's2', 's4'), ('start', 's1', 's3', 's4')},
+        )
+        self.assertEqual(self.fsa.find_paths_from('s4'), [('s4', 's5', None)])
+
     def test_get_maximal_previous_nodes(self):
         self.generate_nodes()
         result = self.fsa.get_maximal_previous_nodes('s4')
@@ -199,3 +211,310 @@ class TestFSA(CannedData, test.TestCase):
         source = self.fsa.generate_dotsource()
         self.assertIn('start [shape=doublecircle]', source)
         self.assertIn('s5 [shape=doublecircle]', source)
+
+    def test_generate_dotsource_query_count(self):
+        self.generate_nodes()
+        with self.assertNumQueries(2):
+            source = self.fsa.generate_dotsource()
+        self.assertIn('s1 -> s3 [label=False]', source)
+
+    def test_identical_graphs_are_rendered_once(self):
+        from pathlib import Path
+        import tempfile
+        from unittest import mock
+
+        def render(self, cleanup=False):
+            path = Path(self.directory) / '{}.{}'.format(self.filename, self.format)
+            path.write_text(self.source)
+            return str(path)
+
+        self.generate_nodes()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.fsa.GRAPHVIZ_TMPDIR = tmpdir
+            with mock.patch('graphviz.Source.render', autospec=True, side_effect=render) as rendered:
+                first = self.fsa.render_dotsource_to_file('svg', 'first')
+                second = self.fsa.render_dotsource_to_file('svg', 'second.svg', directory='sub')
+                self.assertEqual(rendered.call_count, 1)
+                self.fsa.render_dotsource_to_file('png', 'first')
+                self.assertEqual(rendered.call_count, 2)
+            self.assertEqual(first.name, 'first.svg')
+            self.assertEqual(second, Path(tmpdir).resolve() / 'sub' / 'second.svg')
+            self.assertEqual(first.read_text(), second.read_text())
+
+
+class TestTransitionTable(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.nodes = generate_nodes(self.start, **self.canned_data)
+        # The edges have bumped the timestamp since
+        self.fsa.refresh_from_db()
+
+    def test_lookups_cost_no_queries_once_compiled(self):
+        self.fsa.get_transition_table()
+        # The timestamp of a loaded FSA is used as is
+        with self.assertNumQueries(0):
+            self.assertEqual(self.fsa.nextnode('s1', {'s1': 'False'}), self.nodes['s3'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.nodes['s4'].get_next_node({'s4': ''}), self.nodes['s5'])
+        # Else only the timestamp is looked up
+        s4 = Node.objects.get(pk=self.nodes['s4'].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(s4.get_next_node({'s4': ''}), self.nodes['s5'])
+        table = self.fsa.get_transition_table()
+        with self.assertNumQueries(0):
+            self.assertEqual(table.get_next_node(self.nodes['s5'].pk, {'s5': ''}), None)
+            self.assertEqual(table.get_startnode(), self.start)
+            self.assertEqual(set(table.get_nodemap()), {'start', 's1', 's2', 's3', 's4', 's5'})
+
+    def test_table_is_forgotten_on_change(self):
+        self.assertEqual(self.fsa.nextnode('s4', {'s4': ''}), self.nodes['s5'])
+        s6 = Node.objects.create(slug='s6', **self.canned_data)
+        Edge.objects.create(condition='x', prev_node=self.nodes['s4'], next_node=s6)
+        self.assertEqual(self.fsa.nextnode('s4', {'s4': 'x'}), s6)
+        s6.delete()
+        self.assertEqual(self.fsa.nextnode('s4', {'s4': ''}), self.nodes['s5'])
+
+    def test_table_is_keyed_on_timestamp(self):
+        # Another process changing the FSA only changes its timestamp here
+        self.assertEqual(self.fsa.nextnode('s1', {'s1': 'False'}), self.nodes['s3'])
+        Edge.objects.filter(condition='False').update(condition='No')
+        self.assertEqual(self.fsa.nextnode('s1', {'s1': 'False'}), self.nodes['s3'])
+        forget_transition_tables(self.fsa.pk)
+        self.fsa.refresh_from_db()
+        self.assertEqual(self.fsa.nextnode('s1', {'s1': 'No'}), self.nodes['s3'])
+
+    def test_repointed_edge_forgets_old_fsa(self):
+        other = FSA.objects.create(slug='other')
+        elsewhere = Node.objects.create(fsa=other, slug='elsewhere', start=True)
+        self.assertEqual(self.fsa.nextnode('s4', {'s4': ''}), self.nodes['s5'])
+        edge = Edge.objects.get(prev_node=self.nodes['s4'])
+        edge.prev_node = elsewhere
+        edge.next_node = None
+        # The edge, the timestamps of both FSAs, and of their templates
+        with self.assertNumQueries(3):
+            edge.save()
+        self.fsa.refresh_from_db()
+        self.assertEqual(self.fsa.get_transition_table().next_edges.get(self.nodes['s4'].pk), None)
+
+
+class TestFSAClone(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.nodes = generate_nodes(self.start, **self.canned_data)
+        self.nodes['s4'].depends = self.nodes['s1']
+        self.nodes['s4'].save()
+
+    def test_clone(self):
+        new = self.fsa.clone('copy')
+        self.assertEqual(new.slug, 'copy')
+        self.assertEqual(new.cloned_from, self.fsa)
+        self.assertEqual(set(new.nodemap), set(self.fsa.nodemap))
+        self.assertEqual(set(new.find_all_paths()), set(self.fsa.find_all_paths()))
+        s4 = new.nodemap['s4']
+        self.assertEqual(s4.depends, new.nodemap['s1'])
+        self.assertEqual(s4.cloned_from, self.nodes['s4'])
+        edge = Edge.objects.get(prev_node=new.nodemap['s1'], condition='False')
+        self.assertEqual(edge.next_node, new.nodemap['s3'])
+        self.assertEqual(edge.cloned_from.prev_node, self.nodes['s1'])
+        self.assertEqual(self.fsa.clone('copy'), new)
+
+    def test_rows_inserted_meanwhile_are_not_mixed_up(self):
+        from unittest import mock
+
+        other = FSA.objects.create(slug='other')
+        bulk_create = Node.objects.bulk_create
+
+        def racing_bulk_create(objs):
+            # Another connection inserts a node just before the copies
+            Node.objects.create(fsa=other, slug='intruder')
+            return bulk_create(objs)
+
+        with mock.patch('django.db.connection.features.can_return_ids_from_bulk_insert', False), \
+                mock.patch.object(Node.objects, 'bulk_create', side_effect=racing_bulk_create):
+            new = self.fsa.clone('copy')
+        for slug, node in new.nodemap.items():
+            self.assertEqual(node.fsa_id, new.pk)
+            self.assertEqual(node.cloned_from.slug, slug)
+        self.assertEqual(set(new.find_all_paths()), set(self.fsa.find_all_paths()))
+
+    def test_query_count_does_not_grow_with_size(self):
+        with self.assertNumQueries(15):
+            self.fsa.clone('small')
+        previous = self.nodes['s5']
+        for i in range(50):
+            node = Node.objects.create(slug='x{}'.format(i), **self.canned_data)
+            Edge.objects.create(prev_node=previous, next_node=node)
+            previous = node
+        with self.assertNumQueries(15):
+            self.fsa.clone('large')
+
+
+class TestPathEvaluator(CannedData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.nodes = generate_nodes(self.start, **self.canned_data)
+
+    def walk(self, data):
+        "Find the path one step at a time"
+        path = ['start']
+        while True:
+            try:
+                node = self.fsa.nextnode(path[-1], data)
+            except KeyError:
+                return path, False
+            if node is None:
+                return path, True
+            path.append(node.slug)
+
+    def test_same_as_stepping(self):
+        datas = [
+            {'s1': 'True'},
+            {'s1': 'False', 's2': ''},
+            {'s2': ''},
+            {'s1': 'Maybe'},
+        ]
+        items = list(enumerate(datas))
+        with self.assertNumQueries(2):
+            results = list(self.fsa.evaluate_paths(items, chunk_size=3))
+        self.assertEqual([result.key for result in results], [0, 1, 2, 3])
+        for result, data in zip(results, datas):
+            path, complete = self.walk(data)
+            self.assertEqual(result.nodes, path)
+            if data.get('s1') in ('True', 'False'):
+                self.assertTrue(complete)
+                self.assertTrue(result.complete)
+        self.assertEqual(results[0].nodes, ['start', 's1', 's2', 's4', 's5'])
+        self.assertFalse(results[2].complete)
+        self.assertFalse(results[3].complete)
+
+
+def get_maximal_previous_nodes_reference(fsa, nodeslug, visited=None):
+    "How FSA.get_maximal_previous_nodes() used to work"
+    if not visited:
+        visited = set()
+    node = Node.objects.get(slug=nodeslug, fsa=fsa)
+    visited.add(node)
+    edges = Edge.objects.filter(next_node=node)
+    nodes = set(edge.prev_node for edge in edges.all())
+    nodes.discard(None)
+    for node in nodes.copy():
+        if node.start:
+            nodes.add(node)
+            visited.add(node)
+            continue
+        if node in visited:
+            continue
+        recnodes = get_maximal_previous_nodes_reference(fsa, node.slug, visited)
+        nodes = nodes.union(recnodes)
+    return list(nodes)
+
+
+class TestMaximalPreviousNodes(test.TestCase):
+
+    def make_fsa(self, rnd, number):
+        fsa = FSA.objects.create(slug='random{}'.format(number))
+        size = rnd.randint(1, 12)
+        nodes = [Node.objects.create(fsa=fsa, slug='n{}'.format(i), start=(i == 0 or rnd.random() < 0.1))
+                 for i in range(size)]
+        edges = set()
+        for _ in range(rnd.randint(0, size * 2)):
+            # Loops included
+            prev, next = rnd.choice(nodes + [None]), rnd.choice(nodes + [None])
+            if (prev, next) not in edges and (prev or next):
+                Edge.objects.create(prev_node=prev, next_node=next)
+                edges.add((prev, next))
+        return fsa, nodes
+
+    def test_same_as_recursive_version(self):
+        rnd = random.Random(4321)
+        for number in range(40):
+            fsa, nodes = self.make_fsa(rnd, number)
+            slugs = [node.slug for node in nodes]
+            with self.assertNumQueries(2):
+                many = fsa.get_maximal_previous_nodes_many(slugs)
+            for slug in slugs:
+                expected = set(get_maximal_previous_nodes_reference(fsa, slug))
+                self.assertEqual(set(fsa.get_maximal_previous_nodes(slug)), expected)
+                self.assertEqual(set(many[slug]), expected)
+
+
+def find_all_paths_reference(graph, start, ends, path=[]):
+    "How FSA._find_all_paths() used to list paths"
+    path = path + [start]
+    if start is None or start in ends:
+        return [path]
+    if start not in graph:
+        return []
+    paths = []
+    for node in graph[start]:
+        if node not in path:
+            paths.extend(find_all_paths_reference(graph, node, ends, path))
+    return paths
+
+
+class TestPathAnalysis(test.SimpleTestCase):
+
+    @staticmethod
+    def make_dag(rnd, size):
+        graph = {}
+        for i in range(size):
+            nexts = set(rnd.sample(range(i+1, size), min(size-i-1, rnd.randint(0, 3))))
+            if not nexts or rnd.random() < 0.2:
+                nexts.add(None)
+            graph[i] = list(nexts)
+        ends = set(rnd.sample(range(size), rnd.randint(0, min(size, 2))))
+        return graph, ends
+
+    def test_matches_path_listing(self):
+        rnd = random.Random(1234)
+        for _ in range(200):
+            graph, ends = self.make_dag(rnd, rnd.randint(1, 9))
+            paths = PathAnalysis(graph, 0, ends)
+            self.assertTrue(paths.is_dag)
+            expected = find_all_paths_reference(graph, 0, ends)
+            self.assertEqual(
+                Counter(map(tuple, paths.iter_paths())),
+                Counter(map(tuple, expected)),
+            )
+            keys = set(rnd.sample(list(graph), rnd.randint(0, len(graph))))
+            expected_through = set(tuple(p) for p in expected if keys <= set(p))
+            self.assertEqual(set(map(tuple, paths.iter_paths(through=keys))), expected_through)
+            self.assertEqual(paths.is_on_a_path(keys), bool(expected_through))
+            for path in expected_through:
+                self.assertEqual(paths.sort(keys), [n for n in path if n in keys])
+            for node in graph:
+                paths_to = list(map(tuple, paths.iter_paths(to=node)))
+                expected_to = set(p[:p.index(node)+1] for p in map(tuple, expected) if node in p)
+                self.assertTrue(expected_to <= set(paths_to))
+                dominators = set.intersection(*map(set, paths_to)) if paths_to else set()
+                self.assertEqual(set(paths.get_dominators(node)), dominators)
+
+    def test_dominators(self):
+        graph = {'a': ['b', 'c'], 'b': ['d'], 'c': ['d'], 'd': ['e'], 'e': [None]}
+        paths = PathAnalysis(graph, 'a')
+        self.assertEqual(paths.get_dominators('e'), ['a', 'd', 'e'])
+        self.assertEqual(paths.get_ancestors('d'), ['a', 'b', 'c', 'd'])
+        self.assertEqual(paths.get_reachable('c'), ['c', 'd', 'e'])
+
+    def test_loops_fall_back_to_listing(self):
+        graph = {'a': ['b'], 'b': ['a', 'c'], 'c': [None]}
+        paths = PathAnalysis(graph, 'a')
+        self.assertFalse(paths.is_dag)
+        self.assertEqual(list(paths.iter_paths()), [['a', 'b', 'c', None]])
+
+    def test_scales_past_path_listing(self):
+        # 2**100 paths through a ladder of 100 diamonds
+        graph = {}
+        for i in range(100):
+            graph['t{}'.format(i)] = ['l{}'.format(i), 'r{}'.format(i)]
+            graph['l{}'.format(i)] = ['t{}'.format(i+1)]
+            graph['r{}'.format(i)] = ['t{}'.format(i+1)]
+        graph['t100'] = [None]
+        paths = PathAnalysis(graph, 't0')
+        keys = ['r{}'.format(i) for i in range(100)]
+        self.assertTrue(paths.is_on_a_path(keys))
+        self.assertFalse(paths.is_on_a_path(['l5', 'r5']))
+        self.assertEqual(len(list(paths.iter_paths(through=keys))), 1)
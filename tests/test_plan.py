@@ -1,13 +1,25 @@
+from datetime import timedelta
+from io import StringIO
+import json
+from unittest import mock
+
 from django import test
+from django.core.management import call_command
 from django.utils.timezone import now as utcnow
 from django.urls import reverse
 
 from easydmp.dmpt.models import Template, Section, BooleanQuestion, CannedAnswer
+from easydmp.dmpt.models import ChoiceQuestion
+from easydmp.dmpt.graph import get_template_graph
 from easydmp.auth.models import User
+from easydmp.lib.fields import has_json_functions
 
 from easydmp.plan import views
-from easydmp.plan.models import Plan
+from easydmp.plan.models import Answer, Plan, PublishingJob, QuestionValidity
 from easydmp.plan.views import AbstractGeneratedPlanView
+from easydmp.utils.instrumentation import InstrumentationMiddleware, QueryBudgetExceeded
+from easydmp.utils.instrumentation import QueryRecorder, query_budget
+from flow.models import Edge, FSA, Node
 
 
 URLS = {
@@ -113,3 +125,703 @@ class GeneratedViewTestCase(test.TestCase):
         kwargs = {'plan': plan.pk}
         response = c.get(reverse(self.urlname, kwargs=kwargs))
         self.assertEqual(response.status_code, 404, '{} should be hidden'.format(self.urlname))
+
+    def test_streamed_is_same_as_rendered(self):
+        plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+            published=utcnow(),
+        )
+        question = BooleanQuestion.objects.get()
+        Plan.objects.filter(pk=plan.pk).update(data={str(question.pk): {'choice': True}})
+
+        c = test.Client()
+        for urlname in (self.urlname, 'generated_plan_text'):
+            url = reverse(urlname, kwargs={'plan': plan.pk})
+            rendered = c.get(url)
+            streamed = c.get(url + '?stream')
+            self.assertTrue(streamed.streaming)
+            self.assertEqual(streamed['Content-Type'], rendered['Content-Type'])
+            self.assertEqual(b''.join(streamed.streaming_content).strip(),
+                             rendered.content.strip())
+
+    def test_streamed_templates_get_the_request(self):
+        plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+            published=utcnow(),
+        )
+        url = reverse(self.urlname, kwargs={'plan': plan.pk})
+        with mock.patch('easydmp.plan.views.get_template') as get_template:
+            get_template.return_value.render.return_value = ''
+            response = test.Client().get(url + '?stream')
+            b''.join(response.streaming_content)
+        calls = get_template.return_value.render.call_args_list
+        self.assertTrue(calls)
+        for call in calls:
+            self.assertIsNotNone(call[1]['request'])
+
+
+class ValidationData(object):
+
+    def setUp(self):
+        self.template = Template.objects.create(title='test template')
+        self.questions = []
+        for position in (1, 2):
+            section = Section.objects.create(template=self.template,
+                                             title='section {}'.format(position),
+                                             position=position)
+            q = BooleanQuestion.objects.create(section=section, obligatory=True)
+            CannedAnswer.objects.create(question=q, choice='Yes')
+            CannedAnswer.objects.create(question=q, choice='No')
+            self.questions.append(q)
+        self.user = User.objects.create(username='test user')
+        self.plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+        )
+
+    def answer(self, question, choice):
+        plan = Plan.objects.get(pk=self.plan.pk)
+        Answer(question, plan).save_choice({'choice': choice}, self.user)
+        return Plan.objects.get(pk=self.plan.pk)
+
+
+class IncrementalValidationTestCase(ValidationData, test.TestCase):
+
+    def test_counter_follows_answers(self):
+        plan = self.answer(self.questions[0], True)
+        self.assertEqual(plan.valid_section_count, 1)
+        self.assertFalse(plan.valid)
+        plan = self.answer(self.questions[1], False)
+        self.assertEqual(plan.valid_section_count, 2)
+        self.assertTrue(plan.valid)
+        self.assertEqual(plan.section_validity.filter(valid=True).count(), 2)
+
+    def test_incremental_matches_recalculation(self):
+        self.answer(self.questions[0], True)
+        plan = self.answer(self.questions[1], False)
+        incremental = set(plan.section_validity.values_list('section', 'valid'))
+        plan.validate(recalculate=True)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertEqual(plan.valid_section_count, 2)
+        self.assertTrue(plan.valid)
+        self.assertEqual(set(plan.section_validity.values_list('section', 'valid')), incremental)
+
+    def test_deleted_valid_section_is_not_counted(self):
+        # Sections without questions are always valid
+        empty = Section.objects.create(template=self.template,
+                                       title='empty', position=3)
+        plan = self.answer(self.questions[0], True)
+        plan.validate(recalculate=True)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertEqual(plan.valid_section_count, 2)
+        empty.delete()
+        plan = self.answer(self.questions[0], False)
+        self.assertEqual(plan.valid_section_count, 1)
+        self.assertFalse(plan.valid)
+
+    def test_counter_survives_stale_instances(self):
+        first = Plan.objects.get(pk=self.plan.pk)
+        second = Plan.objects.get(pk=self.plan.pk)
+        Answer(self.questions[0], first).save_choice({'choice': True}, self.user)
+        Answer(self.questions[1], second).save_choice({'choice': True}, self.user)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertEqual(plan.valid_section_count, 2)
+
+    def test_set_invalid_decrements_counter(self):
+        plan = self.answer(self.questions[0], True)
+        Answer(self.questions[0], plan).set_invalid()
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertEqual(plan.valid_section_count, 0)
+        self.assertFalse(plan.valid)
+
+
+class SaveChoicesTestCase(ValidationData, test.TestCase):
+
+    def test_save_many_answers(self):
+        plan = Plan.objects.get(pk=self.plan.pk)
+        q1, q2 = self.questions
+        changed = plan.save_choices({q1.pk: {'choice': True}, str(q2.pk): {'choice': False}},
+                                    self.user)
+        self.assertEqual(changed, {q1.pk, q2.pk})
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertTrue(plan.valid)
+        self.assertEqual(plan.valid_section_count, 2)
+        self.assertEqual(plan.data[str(q2.pk)], {'choice': False})
+        self.assertEqual(plan.get_answer_history(q2.pk).get().choice, {'choice': False})
+        self.assertEqual(plan.question_validity.filter(valid=True).count(), 2)
+        self.assertEqual(plan.visited_sections.count(), 2)
+        validities = set(plan.section_validity.values_list('section', 'valid'))
+        plan.validate(recalculate=True)
+        self.assertEqual(set(plan.section_validity.values_list('section', 'valid')),
+                         validities)
+
+    def test_unchanged_answers_are_not_saved(self):
+        plan = self.answer(self.questions[0], True)
+        changed = plan.save_choices({self.questions[0].pk: {'choice': True}}, self.user)
+        self.assertEqual(changed, set())
+        self.assertEqual(Plan.objects.get(pk=plan.pk).modified, plan.modified)
+
+    def test_stale_instance_keeps_other_answers(self):
+        q1, q2 = self.questions
+        stale = Plan.objects.get(pk=self.plan.pk)
+        self.answer(q1, True)
+        stale.save_choices({q2.pk: {'choice': False}}, self.user)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertEqual(plan.data, {str(q1.pk): {'choice': True},
+                                     str(q2.pk): {'choice': False}})
+        self.assertTrue(plan.valid)
+
+    def test_question_added_after_plan_gets_validity(self):
+        q1, _ = self.questions
+        new = BooleanQuestion.objects.create(section=q1.section, position=2)
+        self.assertFalse(QuestionValidity.objects.filter(question=new).exists())
+        plan = Plan.objects.get(pk=self.plan.pk)
+        plan.save_choices({new.pk: {'choice': True}}, self.user)
+        self.assertTrue(QuestionValidity.objects.get(plan=plan, question=new).valid)
+
+    def test_unknown_question(self):
+        plan = Plan.objects.get(pk=self.plan.pk)
+        with self.assertRaises(ValueError):
+            plan.save_choices({0: {'choice': True}}, self.user)
+
+
+class AnswerHistoryTestCase(ValidationData, test.TestCase):
+
+    def test_history_rebuilds_data(self):
+        q1, q2 = self.questions
+        plan = self.answer(q1, True)
+        first = plan.modified
+        plan = self.answer(q1, False)
+        plan = self.answer(q2, True)
+        self.assertEqual(plan.get_data_at(), plan.data)
+        self.assertEqual(plan.get_data_at(first), {str(q1.pk): {'choice': True}})
+        self.assertEqual([r.revision for r in plan.get_answer_history(q1.pk)], [2, 1])
+        self.assertEqual(plan.get_previous_choice(q1.pk), {'choice': True})
+
+    def test_removed_answers(self):
+        q1, _ = self.questions
+        plan = self.answer(q1, True)
+        Plan.objects.purge_answer(str(q1.pk))
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertEqual(plan.get_data_at(), {})
+        self.assertIsNone(plan.get_answer_history(q1.pk).first().choice)
+        self.assertEqual(plan.get_previous_choice(q1.pk), {'choice': True})
+
+    def test_write_does_not_grow_with_plan(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        q1, q2 = self.questions
+        plan = self.answer(q2, True)
+        plan.data.update({str(pk): {'choice': 'x' * 100} for pk in range(1000, 1100)})
+        plan.save()
+        plan = Plan.objects.select_related('template').get(pk=plan.pk)
+        with CaptureQueriesContext(connection) as queries:
+            plan.save_choices({q1.pk: {'choice': True}}, self.user)
+        plan_updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "plan_plan"')]
+        # The counter of valid sections, then the answers
+        self.assertEqual(len(plan_updates), 2)
+        for sql in plan_updates:
+            self.assertNotIn('previous_data', sql)
+
+    def test_new_plans_with_answers_start_with_history(self):
+        data = {str(self.questions[0].pk): {'choice': True}}
+        plan = Plan.objects.create(
+            template=self.template, title='copy', data=data,
+            added_by=self.user,
+            modified_by=self.user,
+        )
+        self.assertEqual(plan.get_data_at(), data)
+
+
+class PlanJSONQueryTestCase(ValidationData, test.TestCase):
+
+    def make_plan(self, data):
+        return Plan.objects.create(
+            template=self.template, title='test plan', data=data,
+            added_by=self.user,
+            modified_by=self.user,
+        )
+
+    def test_answered(self):
+        q1, q2 = self.questions
+        plan = self.make_plan({str(q1.pk): {'choice': True}})
+        self.assertEqual(list(Plan.objects.answered(q1.pk)), [plan])
+        self.assertFalse(Plan.objects.answered(q2.pk).exists())
+
+    def test_with_choice(self):
+        q1, q2 = self.questions
+        yes = self.make_plan({str(q1.pk): {'choice': True},
+                              str(q2.pk): {'choice': ['a', 'b']}})
+        no = self.make_plan({str(q1.pk): {'choice': False},
+                             str(q2.pk): {'choice': 'a'}})
+        self.assertEqual(list(Plan.objects.with_choice(q1.pk, True)), [yes])
+        self.assertEqual(list(Plan.objects.with_choice(q1.pk, False)), [no])
+        self.assertEqual(list(Plan.objects.with_choice(q2.pk, 'a')), [no])
+        self.assertEqual(list(Plan.objects.with_choice(q2.pk, ['a', 'b'])), [yes])
+
+    def test_json_functions_per_database(self):
+        self.assertTrue(has_json_functions(mock.Mock(vendor='sqlite')))
+        self.assertTrue(has_json_functions(mock.Mock(vendor='postgresql')))
+        # Falls back to doing the work in Python
+        self.assertFalse(has_json_functions(mock.Mock(vendor='mysql')))
+
+    def test_data_survives_roundtrip(self):
+        data = {str(self.questions[0].pk): {'choice': 'Yes', 'notes': 'æøå'}}
+        plan = self.make_plan(data)
+        self.assertEqual(Plan.objects.get(pk=plan.pk).data, data)
+
+
+class PurgeAnswerTestCase(ValidationData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.q1, self.q2 = self.questions
+        self.answer(self.q1, True)
+        self.other = Plan.objects.create(
+            template=self.template, title='other plan',
+            data={str(self.q2.pk): {'choice': False}},
+            previous_data={str(self.q1.pk): {'choice': False}},
+            added_by=self.user,
+            modified_by=self.user,
+        )
+
+    def assertPurged(self, report):
+        self.assertEqual(report['plans'], 2)
+        self.assertEqual(report['revisions'], 1)
+        self.assertEqual(report['question_validities'], 2)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertEqual(plan.data, {})
+        self.assertEqual(plan.previous_data, {})
+        self.assertIsNone(plan.get_answer_history(self.q1.pk).first().choice)
+        other = Plan.objects.get(pk=self.other.pk)
+        self.assertEqual(other.data, {str(self.q2.pk): {'choice': False}})
+        self.assertEqual(other.previous_data, {})
+        self.assertFalse(other.question_validity.filter(question=self.q1).exists())
+
+    def test_purge_in_db(self):
+        # However many plans there are
+        with self.assertNumQueries(9):
+            report = Plan.objects.purge_answer(self.q1.pk)
+        self.assertPurged(report)
+
+    def test_purge_in_chunks(self):
+        with mock.patch('easydmp.plan.models.has_json_functions', return_value=False):
+            report = Plan.objects.purge_answer(self.q1.pk, chunk_size=1)
+        self.assertPurged(report)
+
+    def test_chunks_are_capped_by_query_params(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        data = {str(self.q1.pk): {'choice': True}}
+        for i in range(4):
+            Plan.objects.create(template=self.template, title='plan {}'.format(i),
+                                data=data, added_by=self.user, modified_by=self.user)
+        # Room for two plans per chunk
+        with mock.patch('easydmp.plan.models.has_json_functions', return_value=False), \
+                mock.patch.object(connection.features, 'max_query_params', 12, create=True), \
+                CaptureQueriesContext(connection) as queries:
+            report = Plan.objects.purge_answer(self.q1.pk)
+        self.assertEqual(report['plans'], 6)
+        self.assertEqual(report['revisions'], 5)
+        plan_updates = [q for q in queries if q['sql'].startswith('UPDATE "plan_plan"')]
+        self.assertEqual(len(plan_updates), 3)
+        self.assertFalse(Plan.objects.answered(self.q1.pk).exists())
+
+    def test_nothing_to_purge(self):
+        report = Plan.objects.filter(pk=self.other.pk).purge_answer(self.q2.pk + 100)
+        self.assertEqual((report['plans'], report['revisions']), (0, 0))
+
+
+class SectionProgressTestCase(ValidationData, test.TestCase):
+
+    def test_progress(self):
+        self.answer(self.questions[0], True)
+        plan = Plan.objects.select_related('template').get(pk=self.plan.pk)
+        second = self.questions[1].section
+        get_template_graph(plan.template)
+        with self.assertNumQueries(1):
+            progress = views.get_section_progress(plan, second)
+        first, active = progress
+        self.assertEqual(first['status'], 'visited')
+        self.assertTrue(first['valid'])
+        self.assertEqual((first['answered'], first['questions']), (1, 1))
+        self.assertEqual(first['percent_answered'], 100)
+        self.assertEqual(active['status'], 'active')
+        self.assertFalse(active['valid'])
+        self.assertEqual(active['percent_answered'], 0)
+
+
+class RevalidatePlansCommandTestCase(ValidationData, test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        data = {str(q.pk): {'choice': True} for q in self.questions}
+        Plan.objects.filter(pk=self.plan.pk).update(data=data)
+
+    def test_revalidate(self):
+        call_command('revalidate_plans', jobs=1, stdout=StringIO())
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertTrue(plan.valid)
+        self.assertEqual(plan.valid_section_count, 2)
+        self.assertFalse(plan.question_validity.filter(valid=False).exists())
+
+    def make_plans(self, count):
+        data = {str(self.questions[0].pk): {'choice': True}}
+        return [Plan.objects.create(template=self.template, title='plan {}'.format(i),
+                                    data=data, added_by=self.user, modified_by=self.user)
+                for i in range(count)]
+
+    def test_chunks_read_their_own_plans(self):
+        from easydmp.plan.management.commands.revalidate_plans import validate_chunk
+
+        half = self.make_plans(3)
+        first, _, last = half
+        template_pk, result = validate_chunk((self.template.pk, first.pk, last.pk, None))
+        self.assertEqual([plan_pk for plan_pk, _ in result], [plan.pk for plan in half])
+        _, valid_sections = result[0][1]
+        self.assertEqual(valid_sections, {self.questions[0].section_id})
+        _, result = validate_chunk((self.template.pk, first.pk, last.pk, utcnow()))
+        self.assertEqual(result, [])
+
+    def test_revalidate_in_chunks(self):
+        plans = self.make_plans(3)
+        out = StringIO()
+        call_command('revalidate_plans', jobs=1, chunk_size=2, stdout=out)
+        self.assertIn('4 plans of 1 templates', out.getvalue())
+        self.assertTrue(Plan.objects.get(pk=self.plan.pk).valid)
+        for plan in Plan.objects.filter(pk__in=[p.pk for p in plans]):
+            self.assertFalse(plan.valid)
+            self.assertEqual(plan.valid_section_count, 1)
+
+    def test_writes_are_capped_by_query_params(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        plans = self.make_plans(3)
+        # Room for two plans per UPDATE
+        with mock.patch.object(connection.features, 'max_query_params', 12, create=True), \
+                CaptureQueriesContext(connection) as queries:
+            call_command('revalidate_plans', jobs=1, stdout=StringIO())
+        updates = [q for q in queries if q['sql'].startswith('UPDATE "plan_questionvalidity"')]
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(Plan.objects.get(pk=self.plan.pk).valid)
+        for plan in Plan.objects.filter(pk__in=[p.pk for p in plans]):
+            self.assertFalse(plan.valid)
+            self.assertEqual(plan.valid_section_count, 1)
+
+    def test_questions_are_validated_once(self):
+        from easydmp.plan.management.commands.revalidate_plans import validate_plan_data
+
+        graph = get_template_graph(self.template)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        with mock.patch.object(BooleanQuestion, 'validate_data', autospec=True,
+                               return_value=True) as validate:
+            validate_plan_data(graph, plan.data)
+        self.assertEqual(validate.call_count, len(self.questions))
+
+    def test_revalidate_with_pool(self):
+        self.make_plans(3)
+        out = StringIO()
+        call_command('revalidate_plans', jobs=2, chunk_size=1, stdout=out)
+        self.assertIn('4 plans of 1 templates', out.getvalue())
+        self.assertTrue(Plan.objects.get(pk=self.plan.pk).valid)
+        self.assertEqual(Plan.objects.filter(valid_section_count=1).count(), 3)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('revalidate_plans', jobs=1, dry_run=True, stdout=out)
+        self.assertIn('1 changed', out.getvalue())
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertFalse(plan.valid)
+        self.assertEqual(plan.valid_section_count, 0)
+
+
+class PlanPathsCommandTestCase(test.TestCase):
+
+    def setUp(self):
+        self.template = Template.objects.create(title='test template')
+        section = Section.objects.create(template=self.template, title='test section')
+        fsa = FSA.objects.create(slug='paths')
+        self.questions = []
+        for position in (1, 2, 3):
+            node = Node.objects.create(fsa=fsa, slug='n{}'.format(position),
+                                       start=(position == 1))
+            question = ChoiceQuestion.objects.create(section=section, position=position,
+                                                     node=node, obligatory=True)
+            self.questions.append(question)
+        q1, q2, q3 = self.questions
+        for choice, next_question in (('Yes', q2), ('No', q3)):
+            edge = Edge.objects.create(condition=choice, prev_node=q1.node,
+                                       next_node=next_question.node)
+            CannedAnswer.objects.create(question=q1, choice=choice, edge=edge)
+        Edge.objects.create(prev_node=q2.node, next_node=None)
+        Edge.objects.create(prev_node=q3.node, next_node=None)
+        user = User.objects.create(username='test user')
+        self.plans = []
+        for choice in ('Yes', 'No'):
+            self.plans.append(Plan.objects.create(
+                template=self.template, title='plan {}'.format(choice),
+                added_by=user, modified_by=user,
+                data={str(q1.pk): {'choice': choice}},
+            ))
+
+    def test_jsonl(self):
+        out = StringIO()
+        call_command('plan_paths', format='jsonl', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        q1, q2, q3 = self.questions
+        self.assertEqual(
+            [(row['plan'], row['questions'], row['complete']) for row in rows],
+            [(self.plans[0].pk, [q1.pk, q2.pk], True),
+             (self.plans[1].pk, [q1.pk, q3.pk], True)],
+        )
+        self.assertEqual(rows[0]['nodes'], ['n1', 'n2'])
+
+    def test_csv(self):
+        out = StringIO()
+        call_command('plan_paths', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'plan,template,section,fsa,complete,nodes,questions')
+        self.assertTrue(lines[2].endswith(',paths,True,n1 n3,{} {}'.format(
+            self.questions[0].pk, self.questions[2].pk)))
+
+
+class QueryBudgetTestCase(test.TestCase):
+    "The views declare query budgets, which are enforced when testing"
+
+    def setUp(self):
+        self.template = create_template(True)
+        self.question = BooleanQuestion.objects.get()
+        self.empty_section = Section.objects.create(template=self.template,
+                                                    title='empty', position=2)
+        self.user = User.objects.create(username='test user')
+        self.plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+        )
+        self.client.force_login(self.user)
+
+    def get(self, urlname, **kwargs):
+        response = self.client.get(reverse(urlname, kwargs=kwargs))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('queries', response['Server-Timing'])
+        return response
+
+    def test_new_question(self):
+        self.get('new_question', plan=self.plan.pk, question=self.question.pk)
+
+    def test_section_detail(self):
+        self.get('section_detail', plan=self.plan.pk, section=self.empty_section.pk)
+
+    def test_answer_linear_section(self):
+        self.get('answer_linear_section', plan=self.plan.pk, section=self.question.section_id)
+
+    def get_through_middleware(self, view):
+        from django.template.response import SimpleTemplateResponse
+        from django.template import engines
+
+        template = engines['django'].from_string('{% for plan in plans %}{{ plan }}{% endfor %}')
+
+        def render(request):
+            response = SimpleTemplateResponse(template, {'plans': view(request)})
+            response.render()
+            return response
+        return InstrumentationMiddleware(render)(test.RequestFactory().get('/'))
+
+    def test_budget_exceeded(self):
+        @query_budget(1)
+        def view(request):
+            list(Plan.objects.all())
+            return Plan.objects.all()
+
+        # The second query is only run when rendering
+        with self.assertRaises(QueryBudgetExceeded):
+            self.get_through_middleware(view)
+
+    def test_budget_kept(self):
+        @query_budget(1)
+        def view(request):
+            return Plan.objects.all()
+
+        response = self.get_through_middleware(view)
+        self.assertIn('1 queries', response['Server-Timing'])
+
+    def test_recorder_survives_full_connection_log(self):
+        from django.db import connection
+
+        for _ in range(connection.queries_log.maxlen):
+            connection.queries_log.append({'sql': 'SELECT 0', 'time': '0.000'})
+        with QueryRecorder() as recorder:
+            list(Plan.objects.all())
+            list(Plan.objects.all())
+        self.assertEqual(recorder.count, 2)
+        self.assertEqual(len(recorder.get_duplicates()), 1)
+
+
+class LinearSectionTestCase(test.TestCase):
+
+    def setUp(self):
+        self.template = Template.objects.create(title='linear template')
+        self.section = Section.objects.create(template=self.template, title='linear')
+        self.user = User.objects.create(username='test user')
+        self.client.force_login(self.user)
+
+    def add_questions(self, count):
+        first = self.section.questions.count()
+        for position in range(first + 1, first + count + 1):
+            q = BooleanQuestion.objects.create(section=self.section, position=position,
+                                               obligatory=True)
+            CannedAnswer.objects.create(question=q, choice='Yes')
+            CannedAnswer.objects.create(question=q, choice='No')
+
+    def get(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        # A new plan per request, so that the validities are there
+        plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+        )
+        url = reverse('answer_linear_section',
+                      kwargs={'plan': plan.pk, 'section': self.section.pk})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_questions(self):
+        # Every first request compiles the template graph and fills other
+        # per-process caches, so count the second
+        self.add_questions(2)
+        self.get()
+        small = self.get()
+        self.add_questions(20)
+        self.get()
+        large = self.get()
+        self.assertEqual(small, large)
+
+    def test_missing_validities_are_created(self):
+        from easydmp.plan.models import QuestionValidity, SectionValidity
+
+        self.add_questions(3)
+        plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+        )
+        plan.question_validity.all().delete()
+        plan.section_validity.all().delete()
+        questions = list(self.section.questions.order_by('position'))
+        answers = Answer.for_questions(questions, plan)
+        self.assertEqual([a.question for a in answers], questions)
+        self.assertEqual(QuestionValidity.objects.filter(plan=plan).count(), 3)
+        self.assertEqual(SectionValidity.objects.filter(plan=plan).count(), 1)
+        self.assertTrue(all(a.question_validity.pk for a in answers))
+        self.assertEqual(len(set(a.section_validity.pk for a in answers)), 1)
+
+
+    def test_validities_created_meanwhile_are_used(self):
+        from unittest import mock
+        from easydmp.plan.models import QuestionValidity
+
+        self.add_questions(2)
+        plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+        )
+        questions = list(self.section.questions.order_by('position'))
+        real_filter = QuestionValidity.objects.filter
+        # Another request creates the rows right after they were looked for
+        lookups = [QuestionValidity.objects.none()]
+        with mock.patch.object(QuestionValidity.objects, 'filter',
+                               side_effect=lambda **kw: lookups.pop() if lookups else real_filter(**kw)):
+            answers = Answer.for_questions(questions, plan)
+        self.assertEqual(set(a.question_validity.pk for a in answers),
+                         set(plan.question_validity.values_list('pk', flat=True)))
+
+    def test_existing_validities_are_not_created(self):
+        self.add_questions(2)
+        plan = Plan.objects.create(
+            template=self.template, title='test plan',
+            added_by=self.user,
+            modified_by=self.user,
+        )
+        questions = list(self.section.questions.order_by('position'))
+        with self.assertNumQueries(2):
+            answers = Answer.for_questions(questions, plan)
+        self.assertEqual(set(a.question_validity.pk for a in answers),
+                         set(plan.question_validity.values_list('pk', flat=True)))
+
+
+class SummaryCacheTestCase(ValidationData, test.TestCase):
+
+    def get_answers(self, summary):
+        return [value['answer'] for section in summary.values()
+                for value in section['data'].values()]
+
+    def test_summary_is_cached_until_saved(self):
+        plan = self.answer(self.questions[0], True)
+        summary = plan.get_summary()
+        self.assertEqual(self.get_answers(summary).count(None), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(plan.get_summary()), list(summary))
+        old_key = plan.get_summary_cache_key()
+        plan = self.answer(self.questions[1], True)
+        self.assertNotEqual(plan.get_summary_cache_key(), old_key)
+        self.assertNotIn(None, self.get_answers(plan.get_summary()))
+
+
+class PublishingQueueTestCase(ValidationData, test.TestCase):
+
+    def test_unpublishable_plan_is_not_queued(self):
+        self.assertIsNone(self.plan.queue_publishing(self.user))
+        self.assertFalse(PublishingJob.objects.exists())
+
+    def test_queue_and_drain(self):
+        self.answer(self.questions[0], True)
+        plan = self.answer(self.questions[1], True)
+        job = plan.queue_publishing(self.user)
+        self.assertEqual(job.status, PublishingJob.QUEUED)
+        self.assertEqual(plan.queue_publishing(self.user), job)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertTrue(plan.locked)
+        self.assertTrue(plan.is_publishing)
+        self.assertIsNone(plan.published)
+
+        out = StringIO()
+        call_command('publish_plans', stdout=out)
+        self.assertIn('Published 1 plans, 0 failed', out.getvalue())
+        job.refresh_from_db()
+        self.assertEqual(job.status, PublishingJob.DONE)
+        plan = Plan.objects.get(pk=self.plan.pk)
+        self.assertFalse(plan.is_publishing)
+        self.assertEqual(plan.published, job.timestamp)
+        self.assertTrue(plan.generated_html)
+
+    def test_stale_running_jobs_are_queued_again(self):
+        self.answer(self.questions[0], True)
+        plan = self.answer(self.questions[1], True)
+        job = plan.queue_publishing(self.user)
+        job.claim()
+        call_command('publish_plans', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, PublishingJob.RUNNING)
+
+        PublishingJob.objects.filter(pk=job.pk).update(started=utcnow() - timedelta(hours=1))
+        out = StringIO()
+        call_command('publish_plans', '--timeout=60', stdout=out)
+        self.assertIn('Published 1 plans, 0 failed', out.getvalue())
+        job.refresh_from_db()
+        self.assertEqual(job.status, PublishingJob.DONE)
+        self.assertFalse(Plan.objects.get(pk=self.plan.pk).is_publishing)
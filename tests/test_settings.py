@@ -26,8 +26,15 @@ TEMPLATES = base_settings.TEMPLATES
 
 LOGIN_URL = base_settings.LOGIN_URL
 
+STATIC_URL = base_settings.STATIC_URL
+
 ROOT_URLCONF = 'easydmp.site.urls'
 
 # 3rd party
 
 EASYDMP_INVITATION_FROM_ADDRESS = getattr(base_settings, 'EASYDMP_INVITATION_FROM_ADDRESS', 'foo@example.com')
+
+EASYDMP_INSTRUMENTATION = True
+EASYDMP_QUERY_BUDGET_ENFORCE = True
+EASYDMP_PUBLISHING_WORKERS = 0
+EASYDMP_GRAPH_RENDER_WORKERS = 0